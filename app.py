@@ -1,15 +1,38 @@
+import atexit
+import contextvars
+import hmac
+import json
+import math
 import os
 import time
 from datetime import datetime, timezone
 from functools import wraps
 
+import eventlet
 import firebase_admin
+from eventlet import tpool
 from firebase_admin import credentials, auth, firestore
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Blueprint, Flask, current_app, g, render_template, request, redirect, url_for, session, jsonify
 from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
-from firebase_admin import firestore as fs_admin
-from google.cloud.firestore_v1.base_query import FieldFilter
-from firebase_admin import firestore
+
+from bus import make_bus
+from compress import Compressor
+from directory import Directory
+from group_index import GroupIndex
+from message_schema import new_message, now_ms, preview
+from metrics import Metrics
+from presence import PresenceEngine, PresenceFanout
+from profiles import ProfileCache
+from ratelimit import RateLimiter
+from recent import RecentMessages
+from search import SearchIndex
+from storage import storage_from_env
+from storage_executor import CircuitBreaker, StorageExecutor, StorageOverloaded
+from storage_trace import StorageTracer
+from token_cache import TokenCache
+from typing_state import TypingState
+from unread import UnreadCache
+from write_behind import WriteBehindQueue
 
 
 
@@ -20,22 +43,188 @@ from firebase_admin import firestore
 APP_NAME = "AcerTax Connect"
 SERVICE_ACCOUNT_PATH = os.environ.get("FIREBASE_SERVICE_ACCOUNT", "firebase_service_account.json")
 SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "change-this-in-prod")
+# "firestore" (default) or "local" (SQLite, see storage.py)
+STORAGE_BACKEND = os.environ.get("ACERTAX_STORAGE", "firestore").lower()
+# Emit new_message before the storage write completes (see write_behind.py)
+WRITE_BEHIND = os.environ.get("ACERTAX_WRITE_BEHIND", "0") == "1"
+# each worker journals to <this>.<pid>.<start ms> and replays dead workers' files
+WRITE_BEHIND_JOURNAL = os.environ.get("ACERTAX_WRITE_BEHIND_JOURNAL", "write_behind.journal")
+# History page size (?limit= can ask for up to HISTORY_MAX_PAGE)
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE = 200
+# Newest messages kept in memory per thread, and the memory budget for all of them
+RECENT_MESSAGES_PER_ROOM = int(os.environ.get("RECENT_MESSAGES_PER_ROOM", "200"))
+RECENT_MESSAGES_MAX_MB = float(os.environ.get("RECENT_MESSAGES_MAX_MB", "64"))
+# How often the /api/users snapshot is rebuilt from Auth + profiles
+DIRECTORY_REFRESH_SECONDS = float(os.environ.get("DIRECTORY_REFRESH_SECONDS", "300"))
+# last_seen write interval / how long a socket may go without a heartbeat
+PRESENCE_FLUSH_SECONDS = float(os.environ.get("PRESENCE_FLUSH_SECONDS", "30"))
+PRESENCE_TIMEOUT_SECONDS = float(os.environ.get("PRESENCE_TIMEOUT_SECONDS", "90"))
+# presence_delta frames are batched over this window
+PRESENCE_FANOUT_SECONDS = float(os.environ.get("PRESENCE_FANOUT_SECONDS", "0.5"))
+# Verified ID tokens kept in memory / how often Google's signing keys are re-fetched
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_KEY_REFRESH_SECONDS = float(os.environ.get("TOKEN_KEY_REFRESH_SECONDS", "3600"))
+# typing_update frames are batched over this window
+TYPING_FLUSH_SECONDS = float(os.environ.get("TYPING_FLUSH_SECONDS", "0.3"))
+# On-disk full-text index behind /api/search (see search.py)
+SEARCH_INDEX_PATH = os.environ.get("SEARCH_INDEX_PATH", "search.db")
+SEARCH_MAX_PAGE = 50
+# Responses at least this big are gzip/brotli-compressed (see compress.py)
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+# Shared Socket.IO queue for running several workers (see bus.py); unset = one worker
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE", "")
+# Storage calls run on eventlet's thread pool (storage_executor.py), at
+# most STORAGE_MAX_CONCURRENCY at a time (keep it under
+# EVENTLET_THREADPOOL_SIZE, default 20) with STORAGE_MAX_QUEUE more
+# waiting; "0" makes them inline on the hub again
+STORAGE_EXECUTOR = os.environ.get("STORAGE_EXECUTOR", "1") == "1"
+STORAGE_MAX_CONCURRENCY = int(os.environ.get("STORAGE_MAX_CONCURRENCY", "16"))
+STORAGE_MAX_QUEUE = int(os.environ.get("STORAGE_MAX_QUEUE", "256"))
+# Deadline per storage call, queue wait included; STORAGE_TIMEOUTS (JSON,
+# op -> seconds) overrides single ops
+STORAGE_READ_TIMEOUT_SECONDS = float(os.environ.get("STORAGE_READ_TIMEOUT_SECONDS", "5"))
+STORAGE_WRITE_TIMEOUT_SECONDS = float(os.environ.get("STORAGE_WRITE_TIMEOUT_SECONDS", "10"))
+STORAGE_TIMEOUTS = json.loads(os.environ.get("STORAGE_TIMEOUTS") or "{}")
+# Fail storage calls fast for STORAGE_BREAKER_COOLDOWN_SECONDS once half
+# of the last 20 took longer than STORAGE_SLOW_MS or failed
+STORAGE_SLOW_MS = float(os.environ.get("STORAGE_SLOW_MS", "1000"))
+STORAGE_BREAKER_COOLDOWN_SECONDS = float(os.environ.get("STORAGE_BREAKER_COOLDOWN_SECONDS", "5"))
+# Record the storage calls of each request/socket event (storage_trace.py):
+# "1" adds an X-Storage-Trace header / log line and counts budget
+# overruns, "strict" also fails the call that goes over budget
+STORAGE_TRACE = os.environ.get("STORAGE_TRACE", "0").lower()
+# Most storage calls a handler may make, caches cold; STORAGE_BUDGETS
+# (JSON) adds to / overrides these
+STORAGE_BUDGETS = {
+    "main.session_login": 2,        # profile get + create on first login
+    "main.api_users": 1,
+    "main.api_groups": 0,
+    "main.api_create_group": 1,
+    "main.api_group_detail": 1,     # one batched get for uncached members
+    "main.api_history_dm": 2,       # cleared_before + one page (0 once the thread is cached)
+    "main.api_history_group": 2,
+    "main.api_delete_chat": 1,
+    "main.api_unread": 1,
+    "main.api_bootstrap": 2,        # unread counts + watermarks, concurrently
+    "main.api_mark_read": 1,
+    "main.api_delete_group": 2,     # group + thread counter
+    "main.api_search": 0,
+    "connect": 3,                   # profile get + create + online
+    "disconnect": 1,
+    "heartbeat": 0,
+    "presence_subscribe": 0,
+    "join_dm": 0,
+    "join_group": 0,
+    "send_dm": 1,
+    "send_group": 1,
+    "typing_dm": 0,
+    "typing_group": 0,
+    **json.loads(os.environ.get("STORAGE_BUDGETS") or "{}"),
+}
+# Token buckets per uid and Socket.IO event, [per second, burst], by
+# profile role ("default" for roles not listed). RATE_LIMITS (JSON)
+# replaces whole roles, e.g. '{"integration": {"send_group": [5, 50]}}';
+# an event a role does not list is not limited for it.
+RATE_LIMITS = {
+    "default": {
+        "send_dm": [2, 20],
+        "send_group": [1, 10],          # each one also bumps every member's unread count
+        "typing_dm": [5, 10],           # chat.js sends at most one every 400 ms, plus the stops
+        "typing_group": [5, 10],
+        "presence_subscribe": [0.5, 5],
+    },
+    **json.loads(os.environ.get("RATE_LIMITS") or "{}"),
+}
+# Bearer token /metrics requires; unset = /metrics is disabled (404), as it
+# shares the public port
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+# Accept "uid:email" as an ID token. Local storage only: load tests and
+# the multi-worker check, never a real deployment.
+DEV_TOKENS = os.environ.get("ACERTAX_DEV_TOKENS", "0") == "1"
+# eventlet's cap on simultaneous connections; a polling client holds two
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "10000"))
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "5002"))
+DEBUG = os.environ.get("FLASK_DEBUG", "1") == "1"
 
 # -----------------------------
-# Init Flask + SocketIO
+# Flask + SocketIO
 # -----------------------------
-app = Flask(__name__)
-app.secret_key = SECRET_KEY
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="eventlet")
+# Routes live on a blueprint and socket handlers on an unbound SocketIO;
+# create_app() builds the app and this worker's state.
+bp = Blueprint("main", __name__)
+socketio = SocketIO()
+
+# Per-worker state, set up by create_app()
+store = None
+group_index = None
+write_behind = None
+token_cache = None
+profiles = None
+directory = None
+presence = None
+presence_fanout = None
+typing_state = None
+unread_cache = None
+search_index = None
+recent = None
+rate_limiter = None
+metrics = None
+compressor = None
+storage_executor = None
+storage_tracer = None
+bus = None
 
 # -----------------------------
-# Init Firebase Admin
+# Firebase (initialized on first use, per process)
 # -----------------------------
-if not firebase_admin._apps:
-    cred = credentials.Certificate(SERVICE_ACCOUNT_PATH)
-    firebase_admin.initialize_app(cred)
+# taken on the storage thread pool too, so a real lock even when patched
+_firebase_lock = eventlet.patcher.original("threading").Lock()
+
+def firebase_configured() -> bool:
+    """
+    Auth needs Firebase Admin; with the local storage backend it is
+    optional so the app can run without a Firebase project.
+    """
+    return STORAGE_BACKEND == "firestore" or os.path.exists(SERVICE_ACCOUNT_PATH)
+
+def firebase_app():
+    """The Firebase Admin app, created on the first call in this process."""
+    with _firebase_lock:
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.Certificate(SERVICE_ACCOUNT_PATH))
+        return firebase_admin.get_app()
+
+def firestore_client():
+    return firestore.client(app=firebase_app())
+
+def verify_id_token(token: str):
+    return auth.verify_id_token(token, app=firebase_app())
+
+def list_auth_users():
+    """(uid, email) for every Firebase Auth account (paginated)."""
+    page = auth.list_users(app=firebase_app())
+    while page:
+        for u in page.users:
+            yield u.uid, (u.email or "").lower()
+        page = page.get_next_page()
+
+def fetch_signing_keys():
+    """
+    Fetch the ID token signing certs through Firebase Admin's own
+    cache-control session, so verify_id_token() finds them cached.
+    """
+    from firebase_admin import _token_gen
+    verifier = auth._get_client(firebase_app())._token_verifier
+    verifier.request(_token_gen.ID_TOKEN_CERT_URI)
 
-db = firestore.client()
+def verify_dev_token(token: str):
+    """ACERTAX_DEV_TOKENS: "uid:email" stands in for a Firebase ID token."""
+    uid, _, email = token.partition(":")
+    if not uid or "@" not in email:
+        raise ValueError("bad dev token")
+    return {"uid": uid, "email": email, "exp": time.time() + 3600}
 
 # -----------------------------
 # Helpers
@@ -47,22 +236,80 @@ def login_required(view):
     @wraps(view)
     def wrapped(*args, **kwargs):
         if not session.get("user"):
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         return view(*args, **kwargs)
     return wrapped
 
-def verify_firebase_id_token(id_token: str):
-    try:
-        decoded = auth.verify_id_token(id_token)
-        return decoded  # contains uid, email, etc.
-    except Exception:
+def socket_event(event: str):
+    """socketio.on(event), with the handler's duration recorded for /metrics."""
+    def decorator(handler):
+        @wraps(handler)
+        def timed(*args, **kwargs):
+            refused = rate_limited(event)
+            if refused:
+                return refused
+            t0 = time.perf_counter()
+            trace = storage_tracer.begin(event) if storage_tracer else None
+            failed = True
+            try:
+                result = handler(*args, **kwargs)
+                failed = False
+                return result
+            except StorageOverloaded as e:
+                # backpressure: refuse the connection, or tell the client
+                # in the ack why the event failed and when to retry
+                if event == "connect":
+                    return False
+                return {"ok": False, "error": e.code, "retry_after_ms": int(e.retry_after * 1000)}
+            finally:
+                metrics.observe_event(event, time.perf_counter() - t0, failed)
+                if trace:
+                    end_storage_trace(*trace)
+        socketio.on(event)(timed)
+        return handler
+    return decorator
+
+def rate_limited(event: str):
+    """The rate_limited ack if this socket's user is over their limit for event, else None."""
+    u = request.environ.get("acertax_user")
+    if u is None or rate_limiter is None:
         return None
+    wait = rate_limiter.check(u["uid"], u.get("role"), event)
+    if wait:
+        return {"ok": False, "error": "rate_limited", "retry_after_ms": math.ceil(wait * 1000)}
+    return None
+
+def begin_storage_trace():
+    g.storage_trace = storage_tracer.begin(request.endpoint or "unmatched")
+
+def end_storage_trace(trace, token):
+    storage_tracer.end(trace, token)
+    if trace.over_budget:
+        current_app.logger.warning("storage over budget in %s: %s", trace.name, trace.summary())
+    else:
+        current_app.logger.info("storage in %s: %s", trace.name, trace.summary())
+    return trace
+
+def storage_trace_header(response):
+    item = g.pop("storage_trace", None)
+    if item is not None:
+        response.headers["X-Storage-Trace"] = end_storage_trace(*item).summary()
+    return response
+
+def storage_overloaded(e):
+    """Storage refused or gave up on a call: 503 with Retry-After."""
+    resp = jsonify({"ok": False, "error": e.code})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(max(1, math.ceil(e.retry_after)))
+    return resp
+
+def verify_firebase_id_token(id_token: str):
+    # contains uid, email, etc.; None if the token is invalid/expired
+    return token_cache.get(id_token)
 
 def ensure_user_profile(uid: str, email: str):
-    doc_ref = db.collection("users").document(uid)
-    doc = doc_ref.get()
-    if not doc.exists:
-        doc_ref.set({
+    if profiles.get(uid) is None:
+        profile = {
             "email": email.lower(),
             "role": "employee",
             "display_name": email.split("@")[0],
@@ -70,13 +317,43 @@ def ensure_user_profile(uid: str, email: str):
             "last_seen": utc_now_iso(),
             "created_at": utc_now_iso(),
             "first_login": True,
-        }, merge=True)
+        }
+        store.set_user(uid, profile)
+        profiles.put(uid, profile)
+        directory.apply(uid, profile)
 
 def set_presence(uid: str, online: bool):
-    db.collection("users").document(uid).set({
+    fields = {
         "online": online,
         "last_seen": utc_now_iso(),
-    }, merge=True)
+    }
+    store.set_user(uid, fields)
+    profiles.update(uid, fields)
+    directory.apply(uid, fields)
+
+def presence_transition(uid: str, online: bool):
+    """
+    A user's first socket connected or last socket went away (or was
+    swept): persist it and queue it for the sockets watching this uid.
+    """
+    set_presence(uid, online)
+    presence_fanout.publish(uid, online)
+
+def presence_remote(uid: str, online: bool):
+    """Another worker persisted a transition; refresh what we serve."""
+    fields = {"online": online}
+    profiles.update(uid, fields)
+    directory.apply(uid, fields)
+    presence_fanout.publish(uid, online)
+
+def on_remote_group(msg: dict):
+    """A group was created/deleted on another worker."""
+    if msg.get("group") is None:
+        group_index.remove(msg.get("group_id"))
+        unread_cache.drop_thread(thread_id_group(msg.get("group_id")))
+        recent.drop(thread_id_group(msg.get("group_id")))
+    else:
+        group_index.put(msg["group_id"], msg["group"])
 
 def dm_room_id(uid1: str, uid2: str) -> str:
     a, b = sorted([uid1, uid2])
@@ -89,61 +366,387 @@ def thread_id_dm(uid1, uid2):
 def thread_id_group(group_id):
     return f"group_{group_id}"
 
-def incr_unread(uid: str, thread_id: str, payload: dict):
+def user_room(uid: str) -> str:
+    """Personal room every socket of uid joins on connect."""
+    return f"user_{uid}"
+
+def deliver_message(msg: dict, thread_id: str, thread: dict, room: str, recipients) -> str:
+    """
+    Persist msg (bumping its thread) and emit new_message to room.
+    In write-behind mode the emit goes out first and the write is queued;
+    if the queue is full we fall back to writing inline.
+    """
+    msg_id = store.new_message_id()
+    payload = {**msg, "id": msg_id}
+    if write_behind:
+        emit("new_message", payload, room=room)
+        if not write_behind.submit(msg_id, msg, thread_id, thread):
+            store.add_message(msg, thread_id, thread, msg_id)
+    else:
+        store.add_message(msg, thread_id, thread, msg_id)
+        emit("new_message", payload, room=room)
+    recent.add(thread_id, payload)
+    bus.publish("recent", {"thread_id": thread_id, "msg": payload})
+    search_index.add(msg_id, msg, thread)
+    push_unread(thread_id, thread, recipients, msg.get("ts"), msg_id)
+    return msg_id
+
+def push_unread(thread_id: str, thread: dict, recipients, ts=None, msg_id: str = None):
     """
-    payload can include: type, other_uid, group_id, label
+    Bump each recipient's cached count for message (ts, msg_id) and push
+    unread_delta to their personal room, so every tab sees it without
+    polling /api/unread (including tabs that never joined the thread's
+    room).
     """
-    ref = db.collection("users").document(uid).collection("unread").document(thread_id)
-    ref.set({
-        **payload,
-        "count": firestore.Increment(1),
-        "updated_ts": firestore.SERVER_TIMESTAMP,
-    }, merge=True)
+    recipients = list(recipients)
+    for uid in recipients:
+        unread_cache.incr(uid, thread_id, thread, ts=ts, msg_id=msg_id)
+        emit("unread_delta", {"thread_id": thread_id, "delta": 1}, room=user_room(uid))
+    if recipients:
+        bus.publish("unread", {"thread_id": thread_id, "thread": thread, "uids": recipients,
+                               "ts": ts, "id": msg_id})
 
 def clear_unread(uid: str, thread_id: str):
-    ref = db.collection("users").document(uid).collection("unread").document(thread_id)
-    ref.set({"count": 0, "updated_ts": firestore.SERVER_TIMESTAMP}, merge=True)
+    """
+    Unread counts are derived from the thread's seq minus the user's
+    read watermark, so clearing just advances the watermark. All of the
+    user's tabs are told the thread is read.
+    """
+    _mark_read(uid, thread_id)
+    unread_cache.clear(uid, thread_id)
+    socketio.emit("unread_delta", {"thread_id": thread_id, "count": 0}, to=user_room(uid))
+    bus.publish("unread", {"thread_id": thread_id, "clear": uid})
+
+def _mark_read(uid: str, thread_id: str):
+    # mark_read copies the thread's seq; with write-behind, messages of
+    # the thread still queued here would be missing from it and show up
+    # as unread again once the cache entry expires, so wait for them
+    if not (write_behind and write_behind.after(thread_id, lambda: store.mark_read(uid, thread_id))):
+        store.mark_read(uid, thread_id)
+
+def clear_chat(uid: str, thread_id: str):
+    """Hide everything in thread_id so far from uid (history and search)."""
+    ts = now_ms()
+    store.clear_thread(uid, thread_id, ts)
+    search_index.clear(uid, thread_id, ts)
+    recent.clear(uid, thread_id, ts)
+    bus.publish("recent", {"thread_id": thread_id, "clear": uid, "ts": ts})
+
+def on_remote_recent(msg: dict):
+    """A message was sent / a chat cleared on another worker."""
+    if msg.get("clear"):
+        recent.clear(msg["clear"], msg.get("thread_id"), msg.get("ts") or 0)
+    elif msg.get("msg"):
+        recent.add_relayed(msg.get("thread_id"), msg["msg"])
+
+def on_remote_unread(msg: dict):
+    """Keep this worker's unread cache in step with the others."""
+    thread_id = msg.get("thread_id")
+    if msg.get("clear"):
+        unread_cache.clear(msg["clear"], thread_id)
+        # the reader's worker has written its watermark; redo it after
+        # messages of the thread still queued on this one
+        if write_behind:
+            uid = msg["clear"]
+            write_behind.after(thread_id, lambda: store.mark_read(uid, thread_id))
+        return
+    for uid in msg.get("uids") or ():
+        unread_cache.incr(uid, thread_id, msg.get("thread") or {}, ts=msg.get("ts"), msg_id=msg.get("id"))
+
+def _cursor_arg(name: str):
+    """A "ts:id" history cursor as (ts, id); raises ValueError if malformed."""
+    v = request.args.get(name) or ""
+    if not v:
+        return None
+    ts, msg_id = v.split(":", 1)
+    if not msg_id:
+        raise ValueError(v)
+    return int(ts), msg_id
+
+def _cursor(key):
+    """(ts, id) as the "ts:id" string _cursor_arg reads back."""
+    return f"{key[0]}:{key[1]}" if key else None
 
-def _ts_sort_key(d: dict):
+def run_concurrently(*calls):
     """
-    Sort key for messages where ts may be:
-      - int/float (milliseconds)
-      - ISO string
+    Run blocking calls (storage I/O) at the same time and return their
+    results in order. The calling greenlet waits without blocking the
+    hub, and each call keeps the caller's context (the storage trace).
+    With the storage executor the calls are green threads whose storage
+    ops it bounds; without it they go to eventlet's OS thread pool.
     """
-    ts = d.get("ts")
-    if isinstance(ts, (int, float)):
-        return float(ts)
-    if isinstance(ts, str):
-        try:
-            # handle "Z"
-            s = ts.replace("Z", "+00:00")
-            dt = datetime.fromisoformat(s)
-            return dt.timestamp() * 1000.0
-        except Exception:
-            return 0.0
-    return 0.0
+    if storage_executor is None:
+        calls = [lambda fn=fn: tpool.execute(fn) for fn in calls]
+    waiting = [eventlet.spawn(contextvars.copy_context().run, fn) for fn in calls]
+    return [gt.wait() for gt in waiting]
+
+def etag_response(tag, build):
+    """
+    build() unless the client already has version `tag` of the resource
+    (If-None-Match), in which case a 304 without building it. Tags come
+    from in-memory change counters; None means the version is not known
+    without storage work, so the response is built and sent untagged.
+    """
+    if tag is not None and request.if_none_match.contains_weak(tag):
+        resp = current_app.response_class(status=304)
+    else:
+        resp = build()
+    if tag is not None:
+        resp.set_etag(tag, weak=True)
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+def history_page(thread_id: str, uid: str):
+    """
+    One page of a thread's history, keyset-paginated on (ts, id).
+    Query args: limit, before=<cursor> (older page), after=<cursor>
+    (newer page), cursors as returned by the previous page ("ts:id").
+    Returns messages oldest-first plus the cursors for the next pages.
+    Messages before uid's "delete chat" watermark are excluded by the query.
+    The ETag is the thread's newest message plus that watermark, so
+    reopening an unchanged thread is a 304.
+    """
+    try:
+        limit = int(request.args.get("limit") or HISTORY_PAGE_SIZE)
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    limit = max(1, min(limit, HISTORY_MAX_PAGE))
+    try:
+        before = _cursor_arg("before")
+        after = _cursor_arg("after")
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad cursor"}), 400
+    version = recent.version(thread_id, uid)
+    tag = f"h-{thread_id}-{version}" if version else None
+    return etag_response(tag, lambda: _history_body(thread_id, uid, limit, before, after))
+
+def _history_body(thread_id, uid, limit, before, after):
+    # one extra row tells us whether there is another page; the newest
+    # pages usually come from the in-memory ring
+    if after is None:
+        page = recent.list_messages(thread_id, uid, limit + 1, before=before)
+    else:
+        since = recent.cleared_before(uid, thread_id)
+        page = store.list_messages(thread_id, limit=limit + 1, after=after, since=since)
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    msgs = list(page)
+    if after is None:
+        msgs.reverse()
+    if msgs:
+        before = (int(msgs[0].get("ts") or 0), msgs[0]["id"])
+        after = (int(msgs[-1].get("ts") or 0), msgs[-1]["id"])
+    return jsonify({
+        "ok": True,
+        "messages": msgs,
+        "has_more": has_more,
+        # pass back as ?before= for older messages / ?after= for newer ones
+        "before": _cursor(before),
+        "after": _cursor(after),
+    })
 
 
+# -----------------------------
+# App factory
+# -----------------------------
+def create_app(config=None):
+    """
+    Build the Flask app and Socket.IO server. Nothing here touches the
+    network, opens a database or starts a thread, so it is cheap and safe
+    to call before forking (gunicorn --preload) or from tools and tests.
+    This process's state and background tasks are built by
+    start_worker() on its first request or socket connect.
+
+    config is applied to app.config; "STORE" injects a Storage instead
+    of building one from ACERTAX_STORAGE.
+
+    For N workers: run N processes (each with its own PORT, or
+    `gunicorn -k eventlet -w N 'app:create_app()'`) behind a load
+    balancer with sticky sessions, all with the same SOCKETIO_MESSAGE_QUEUE.
+    """
+    global metrics, compressor, bus, _worker
+
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    app.config.update(config or {})
+    app.register_blueprint(bp)
+    app.before_request(start_worker)
+    app.register_error_handler(StorageOverloaded, storage_overloaded)
+    _worker = None
+
+    # Route/handler latency, emitted packets and socket gauges for /metrics
+    metrics = Metrics()
+    metrics.instrument_app(app)
+    compressor = Compressor(min_size=COMPRESS_MIN_BYTES)
+    compressor.instrument_app(app)
+
+    client_manager, bus = make_bus(SOCKETIO_MESSAGE_QUEUE)
+    options = {"client_manager": client_manager} if client_manager else {}
+    socketio.init_app(app, cors_allowed_origins="*", async_mode="eventlet", **options)
+    metrics.instrument_socketio(socketio.server)
+    metrics.stats_gauges("acertax", component_stats)
+
+    if STORAGE_TRACE in ("1", "strict"):
+        app.before_request(begin_storage_trace)
+        app.after_request(storage_trace_header)
+    return app
+
+_worker = None  # (pid, app) start_worker() last ran for
+# green: _start_worker does storage I/O and starts tasks, which yield to
+# the hub, and a second request arriving meanwhile must wait, not block it
+_worker_lock = eventlet.semaphore.Semaphore()
+
+def start_worker(app=None):
+    """
+    Build this process's caches and start its background tasks, once
+    per process and app. Runs from before_request and on_connect, so a
+    forked worker sets itself up on first use; call it directly to pay
+    the cost before serving (gunicorn post_fork, __main__).
+    """
+    app = app or current_app._get_current_object()
+    if _worker == (os.getpid(), app):
+        return
+    with _worker_lock:
+        if _worker != (os.getpid(), app):
+            _start_worker(app)
+
+def _start_worker(app):
+    global store, group_index, write_behind, token_cache, profiles, directory
+    global presence, presence_fanout, typing_state, unread_cache, search_index, recent, rate_limiter
+    global storage_executor, storage_tracer, _worker
+
+    injected = app.config.get("STORE")
+    if DEV_TOKENS and STORAGE_BACKEND != "local" and injected is None:
+        raise RuntimeError("ACERTAX_DEV_TOKENS is only allowed with ACERTAX_STORAGE=local")
+
+    store = injected or storage_from_env(firestore_client)
+    storage_executor = None
+    if STORAGE_EXECUTOR:
+        storage_executor = StorageExecutor(
+            max_concurrency=STORAGE_MAX_CONCURRENCY,
+            max_queue=STORAGE_MAX_QUEUE,
+            read_timeout=STORAGE_READ_TIMEOUT_SECONDS,
+            write_timeout=STORAGE_WRITE_TIMEOUT_SECONDS,
+            timeouts=STORAGE_TIMEOUTS,
+            breaker=CircuitBreaker(slow_ms=STORAGE_SLOW_MS, cooldown=STORAGE_BREAKER_COOLDOWN_SECONDS),
+        )
+        store = storage_executor.wrap(store)
+    storage_tracer = None
+    if STORAGE_TRACE in ("1", "strict"):
+        storage_tracer = StorageTracer(STORAGE_BUDGETS, strict=STORAGE_TRACE == "strict")
+        store = storage_tracer.wrap(store)
+
+    # group_id -> members cache, kept fresh by the storage change feed
+    # (and by other workers over the bus)
+    group_index = GroupIndex(store)
+    group_index.start()
+    bus.subscribe("group", on_remote_group)
+
+    write_behind = None
+    if WRITE_BEHIND:
+        write_behind = WriteBehindQueue(store, WRITE_BEHIND_JOURNAL)
+        write_behind.start()
+        atexit.register(write_behind.stop)
+
+    # Decoded ID tokens keyed by hash, valid until their exp
+    token_cache = TokenCache(
+        verify_dev_token if DEV_TOKENS else verify_id_token,
+        fetch_keys=fetch_signing_keys if firebase_configured() else None,
+        max_size=TOKEN_CACHE_SIZE,
+        key_refresh_interval=TOKEN_KEY_REFRESH_SECONDS,
+    )
+
+    # users/{uid} docs shared by login, presence and per-member lookups
+    profiles = ProfileCache(store)
+
+    # Materialized /api/users
+    directory = Directory(
+        store,
+        list_auth_users=list_auth_users if firebase_configured() else None,
+        ensure_profile=ensure_user_profile,
+        refresh_interval=DIRECTORY_REFRESH_SECONDS,
+    )
+
+    # Per-uid socket ref-counts across workers; only online/offline
+    # transitions are written
+    presence = PresenceEngine(
+        store,
+        on_transition=presence_transition,
+        on_remote=presence_remote,
+        flush_interval=PRESENCE_FLUSH_SECONDS,
+        heartbeat_timeout=PRESENCE_TIMEOUT_SECONDS,
+        bus=bus,
+    )
+
+    # Presence changes go only to sockets that subscribed to that uid.
+    # Every worker runs its own fan-out for its own sockets, so these
+    # emits skip the message queue.
+    presence_fanout = PresenceFanout(
+        emit=lambda event, payload, sid: socketio.emit(event, payload, to=sid, ignore_queue=True),
+        interval=PRESENCE_FANOUT_SECONDS,
+    )
+
+    # Per-room typing sets, broadcast as one typing_update per room per window
+    typing_state = TypingState(
+        emit=lambda event, payload, room: socketio.emit(event, payload, to=room, ignore_queue=True),
+        interval=TYPING_FLUSH_SECONDS,
+        bus=bus,
+    )
+
+    # Per-user unread counts, maintained from the message/read paths
+    unread_cache = UnreadCache(store)
+    bus.subscribe("unread", on_remote_unread)
+
+    # Newest messages per thread, so opening a thread skips storage
+    recent = RecentMessages(
+        store,
+        per_room=RECENT_MESSAGES_PER_ROOM,
+        max_bytes=int(RECENT_MESSAGES_MAX_MB * 1024 * 1024),
+    )
+    bus.subscribe("recent", on_remote_recent)
+
+    # Per-uid limits on socket events; each worker has its own buckets
+    rate_limiter = RateLimiter(RATE_LIMITS)
+
+    # Full-text index, fed in batches from deliver_message
+    search_index = SearchIndex(SEARCH_INDEX_PATH)
+
+    # start listening on the bus now rather than on the first socket
+    # connect, so cache updates from other workers arrive from the start
+    if not socketio.server.manager_initialized:
+        socketio.server.manager_initialized = True
+        socketio.server.manager.initialize()
+
+    directory.start()
+    socketio.start_background_task(presence.run, socketio.sleep)
+    socketio.start_background_task(presence_fanout.run, socketio.sleep)
+    socketio.start_background_task(token_cache.run, socketio.sleep)
+    socketio.start_background_task(typing_state.run, socketio.sleep)
+    socketio.start_background_task(search_index.run, socketio.sleep)
+    socketio.start_background_task(metrics.run, socketio.sleep)
+    socketio.start_background_task(rate_limiter.run, socketio.sleep)
+    _worker = (os.getpid(), app)
 
 # -----------------------------
 # Routes
 # -----------------------------
-@app.get("/")
+@bp.get("/")
 def root():
     if session.get("user"):
-        return redirect(url_for("chat"))
-    return redirect(url_for("login"))
+        return redirect(url_for("main.chat"))
+    return redirect(url_for("main.login"))
 
-@app.get("/login")
+@bp.get("/login")
 def login():
     return render_template("login.html", app_name=APP_NAME)
 
-@app.get("/chat")
+@bp.get("/chat")
 @login_required
 def chat():
     return render_template("chat.html", app_name=APP_NAME, user=session["user"])
 
-@app.post("/session_login")
+@bp.post("/session_login")
 def session_login():
     """
     Frontend signs in with Firebase Auth and sends ID token here.
@@ -165,7 +768,7 @@ def session_login():
     ensure_user_profile(uid, email)
 
     # pull profile
-    profile = db.collection("users").document(uid).get().to_dict() or {}
+    profile = profiles.get(uid) or {}
     session["user"] = {
         "uid": uid,
         "email": email,
@@ -174,12 +777,12 @@ def session_login():
     }
     return jsonify({"ok": True, "first_login": profile.get("first_login", False)})
 
-@app.post("/logout")
+@bp.post("/logout")
 def logout():
     session.clear()
     return jsonify({"ok": True})
 
-@app.post("/api/change_password")
+@bp.post("/api/change_password")
 @login_required
 def api_change_password():
     data = request.get_json(force=True)
@@ -187,77 +790,50 @@ def api_change_password():
     if len(new_password) < 6:
         return jsonify({"ok": False, "error": "Password must be at least 6 characters"}), 400
     uid = session["user"]["uid"]
-    auth.update_user(uid, password=new_password)
-    db.collection("users").document(uid).update({"first_login": False})
+    auth.update_user(uid, password=new_password, app=firebase_app())
+    store.update_user(uid, {"first_login": False})
+    profiles.update(uid, {"first_login": False})
     session["user"]["first_login"] = False
     return jsonify({"ok": True})
 
-from firebase_admin import auth
-
-@app.get("/api/users")
+@bp.get("/api/users")
 @login_required
 def api_users():
     """
     Return user list from Firebase Auth (all employees),
     merged with Firestore profile data (role, online, last_seen, display_name).
+    Served from the in-memory directory snapshot; clients that send the
+    ETag back get a 304.
     """
-    # 1) Pull Firestore profiles
-    fs_profiles = {}
-    for doc in db.collection("users").stream():
-        fs_profiles[doc.id] = doc.to_dict() or {}
+    etag, body = directory.snapshot()
+    return etag_response(etag, lambda: current_app.response_class(body, mimetype="application/json"))
 
-    # 2) Pull all Firebase Auth users (paginated)
-    users_out = []
-    page = auth.list_users()
-    while page:
-        for u in page.users:
-            email = (u.email or "").lower()
-            if not email.endswith("@acertax.com"):
-                continue  # only company users
-
-            prof = fs_profiles.get(u.uid, {})
-
-            # If profile missing, create a basic one (so it appears immediately)
-            if not prof:
-                ensure_user_profile(u.uid, email)
-                prof = db.collection("users").document(u.uid).get().to_dict() or {}
-
-            users_out.append({
-                "uid": u.uid,
-                "email": email,
-                "display_name": prof.get("display_name") or (email.split("@")[0]),
-                "online": bool(prof.get("online", False)),
-                "last_seen": prof.get("last_seen"),
-                "role": prof.get("role", "employee"),
-            })
-
-        page = page.get_next_page()
 
-    # sort online first, then name
-    users_out.sort(key=lambda x: (not x["online"], (x["display_name"] or "").lower()))
-    return jsonify({"ok": True, "users": users_out})
-
-
-@app.get("/api/groups")
+@bp.get("/api/groups")
 @login_required
 def api_groups():
     """
     Returns groups where current user is a member.
     """
     uid = session["user"]["uid"]
+    tag = f"groups-{group_index.epoch}-{group_index.version}-{uid}" if group_index.warm else None
+    return etag_response(tag, lambda: _groups_body(uid))
+
+def _groups_body(uid):
+    return jsonify({"ok": True, "groups": _groups_list(uid)})
+
+def _groups_list(uid):
     groups = []
-    q = db.collection("groups").where("members", "array_contains", uid)
-    for doc in q.stream():
-        d = doc.to_dict()
+    for group_id, d in group_index.groups_for(uid):
         groups.append({
-            "group_id": doc.id,
+            "group_id": group_id,
             "name": d.get("name", "Unnamed Group"),
             "members": d.get("members", []),
         })
     groups.sort(key=lambda g: g["name"])
-    return jsonify({"ok": True, "groups": groups})
+    return groups
 
-@app.post("/api/create_group")
+@bp.post("/api/create_group")
 @login_required
 def api_create_group():
     """
@@ -274,23 +850,26 @@ def api_create_group():
     if creator not in member_uids:
         member_uids.append(creator)
 
-    doc_ref = db.collection("groups").document()
-    doc_ref.set({
+    group = {
         "name": name,
         "members": list(sorted(set(member_uids))),
         "created_by": creator,
         "created_at": utc_now_iso(),
-    })
-    return jsonify({"ok": True, "group_id": doc_ref.id})
+    }
+    group_id = store.create_group(group)
+    group_index.put(group_id, group)
+    bus.publish("group", {"group_id": group_id, "group": group})
+    return jsonify({"ok": True, "group_id": group_id})
 
 # -----------------------------
 # Socket.IO
 # -----------------------------
-@socketio.on("connect")
-def on_connect():
+@socket_event("connect")
+def on_connect(auth=None):
     """
     Requires: client sends auth token in querystring: ?token=...
     """
+    start_worker()
     token = request.args.get("token", "")
     decoded = verify_firebase_id_token(token)
     if not decoded:
@@ -302,29 +881,53 @@ def on_connect():
         return disconnect()
 
     ensure_user_profile(uid, email)
-    set_presence(uid, True)
 
     # store on socket session
     session_user = {
         "uid": uid,
         "email": email,
+        "role": (profiles.get(uid) or {}).get("role", "employee"),
     }
     # Using Flask session inside SocketIO is limited; store in request context:
     # We'll attach to the socket environ.
     request.environ["acertax_user"] = session_user
+    join_room(user_room(uid))
 
-    emit("presence_update", {"uid": uid, "online": True}, broadcast=True)
+    presence.connect(uid, request.sid)
 
-@socketio.on("disconnect")
+@socket_event("disconnect")
 def on_disconnect():
     u = request.environ.get("acertax_user")
     if not u:
         return
-    uid = u["uid"]
-    set_presence(uid, False)
-    emit("presence_update", {"uid": uid, "online": False}, broadcast=True)
+    presence.disconnect(u["uid"], request.sid)
+    presence_fanout.unsubscribe(request.sid)
+    if not presence.online_anywhere(u["uid"]):
+        typing_state.drop(u["uid"])
+
+@socket_event("heartbeat")
+def on_heartbeat(data=None):
+    u = request.environ.get("acertax_user")
+    if not u:
+        return disconnect()
+    presence.heartbeat(u["uid"], request.sid)
 
-@socketio.on("join_dm")
+@socket_event("presence_subscribe")
+def presence_subscribe(data):
+    """
+    Client sends the uids it displays: {"uids": [...]}. Replaces any
+    earlier subscription of this socket; the ack carries their current
+    state so the client starts in sync.
+    """
+    u = request.environ.get("acertax_user")
+    if not u:
+        return disconnect()
+    uids = [x for x in (data or {}).get("uids") or [] if isinstance(x, str)]
+    presence_fanout.subscribe(request.sid, uids)
+    entries = directory.entries
+    return {"ok": True, "online": {x: bool(entries.get(x, {}).get("online")) for x in uids}}
+
+@socket_event("join_dm")
 def join_dm(data):
     u = request.environ.get("acertax_user")
     if not u:
@@ -334,7 +937,7 @@ def join_dm(data):
     join_room(room)
     emit("joined_room", {"room": room})
 
-@socketio.on("join_group")
+@socket_event("join_group")
 def join_group(data):
     u = request.environ.get("acertax_user")
     if not u:
@@ -343,7 +946,7 @@ def join_group(data):
     join_room(f"group_{group_id}")
     emit("joined_room", {"room": f"group_{group_id}"})
 
-@socketio.on("send_dm")
+@socket_event("send_dm")
 def send_dm(data):
     u = request.environ.get("acertax_user")
     if not u:
@@ -355,33 +958,17 @@ def send_dm(data):
         return
 
     room = dm_room_id(u["uid"], to_uid)
-
-    msg = {
-        "type": "dm",
-        "room": room,
-        "from_uid": u["uid"],
-        "to_uid": to_uid,
-        "text": text,
-        "ts": int(time.time() * 1000),
-        "deleted_for": [],
-
-    }
-
-    # Save to Firestore
-    db.collection("messages").add(msg)
-
-    # Persist unread for recipient (works even if they are offline/logged out)
     tid = thread_id_dm(u["uid"], to_uid)
-    incr_unread(
-        to_uid,
-        tid,
-        {"type": "dm", "other_uid": u["uid"]}
-    )
+    msg = new_message(tid, u["uid"], text)
 
-    # Emit to room (both users)
-    emit("new_message", msg, room=room)
+    # Save to Firestore and emit to room (both users); bumping the thread
+    # seq is what makes it unread for the recipient (works even if they
+    # are offline/logged out)
+    recipients = [to_uid] if to_uid != u["uid"] else []
+    msg_id = deliver_message(msg, tid, {"type": "dm", "members": sorted([u["uid"], to_uid])}, room, recipients)
+    return {"ok": True, "id": msg_id}
 
-@socketio.on("send_group")
+@socket_event("send_group")
 def send_group(data):
     u = request.environ.get("acertax_user")
     if not u:
@@ -393,93 +980,46 @@ def send_group(data):
         return
 
     # Validate membership (basic)
-    gdoc = db.collection("groups").document(group_id).get()
-    if not gdoc.exists:
+    gdoc = group_index.get(group_id)
+    if gdoc is None:
         return
-    members = (gdoc.to_dict() or {}).get("members", [])
+    members = gdoc.get("members", [])
     if u["uid"] not in members:
         return
 
     room = f"group_{group_id}"
-
-    msg = {
-        "type": "group",
-        "group_id": group_id,
-        "room": room,
-        "from_uid": u["uid"],
-        "text": text,
-        "ts": int(time.time() * 1000),
-        "deleted_for": [],
-
-    }
-
-    db.collection("messages").add(msg)
-
     tid = thread_id_group(group_id)
-    for m in members:
-        if m == u["uid"]:
-            continue
-        incr_unread(
-            m,
-            tid,
-            {"type": "group", "group_id": group_id}
-        )
+    msg = new_message(tid, u["uid"], text)
 
-    emit("new_message", msg, room=room)
+    # One write regardless of group size; members' unread counts are
+    # computed from their read watermarks
+    recipients = [m for m in members if m != u["uid"]]
+    msg_id = deliver_message(msg, tid, {"type": "group", "group_id": group_id}, room, recipients)
+    return {"ok": True, "id": msg_id}
 
-@app.get("/api/history/dm/<other_uid>")
+@bp.get("/api/history/dm/<other_uid>")
 @login_required
 def api_history_dm(other_uid):
     uid = session["user"]["uid"]
-    room = dm_room_id(uid, other_uid)
-
-    msgs = []
-    q = (db.collection("messages")
-         .where(filter=FieldFilter("room", "==", room))
-         .limit(200))
-
-    for doc in q.stream():
-        d = doc.to_dict() or {}
-        deleted_for = d.get("deleted_for", [])
-        if uid in deleted_for:
-            continue
-        d["id"] = doc.id
-        msgs.append(d)
+    return history_page(thread_id_dm(uid, other_uid), uid)
 
-    msgs.sort(key=_ts_sort_key)
-    return jsonify({"ok": True, "messages": msgs})
 
-
-@app.get("/api/history/group/<group_id>")
+@bp.get("/api/history/group/<group_id>")
 @login_required
 def api_history_group(group_id):
     uid = session["user"]["uid"]
 
     # membership check
-    gdoc = db.collection("groups").document(group_id).get()
-    if not gdoc.exists:
+    gdoc = group_index.get(group_id)
+    if gdoc is None:
         return jsonify({"ok": False, "error": "Group not found"}), 404
-    members = (gdoc.to_dict() or {}).get("members", [])
+    members = gdoc.get("members", [])
     if uid not in members:
         return jsonify({"ok": False, "error": "Not a member"}), 403
 
-    msgs = []
-    q = (db.collection("messages")
-         .where(filter=FieldFilter("group_id", "==", group_id))
-         .limit(200))
-
-    for doc in q.stream():
-        d = doc.to_dict() or {}
-        deleted_for = d.get("deleted_for", [])
-        if uid in deleted_for:
-            continue
-        d["id"] = doc.id
-        msgs.append(d)
+    return history_page(thread_id_group(group_id), uid)
 
-    msgs.sort(key=_ts_sort_key)
-    return jsonify({"ok": True, "messages": msgs})
-
-@app.post("/api/delete_chat")
+@bp.post("/api/delete_chat")
 @login_required
 def api_delete_chat():
     data = request.get_json(force=True)
@@ -488,19 +1028,8 @@ def api_delete_chat():
 
     if chat_type == "dm":
         other_uid = data.get("other_uid")
-        room = dm_room_id(uid, other_uid)
-
-        q = db.collection("messages").where(filter=FieldFilter("room", "==", room)).limit(500)
-        batch = db.batch()
-        count = 0
-        for doc in q.stream():
-            batch.update(doc.reference, {"deleted_for": fs_admin.ArrayUnion([uid])})
-            count += 1
-            if count % 400 == 0:
-                batch.commit()
-                batch = db.batch()
-        if count % 400 != 0:
-            batch.commit()
+        # one watermark write, however long the thread is
+        clear_chat(uid, thread_id_dm(uid, other_uid))
 
         return jsonify({"ok": True})
 
@@ -508,47 +1037,34 @@ def api_delete_chat():
         group_id = data.get("group_id")
 
         # membership check
-        gdoc = db.collection("groups").document(group_id).get()
-        if not gdoc.exists:
+        gdoc = group_index.get(group_id)
+        if gdoc is None:
             return jsonify({"ok": False, "error": "Group not found"}), 404
-        members = (gdoc.to_dict() or {}).get("members", [])
+        members = gdoc.get("members", [])
         if uid not in members:
             return jsonify({"ok": False, "error": "Not a member"}), 403
 
-        q = db.collection("messages").where(filter=FieldFilter("group_id", "==", group_id)).limit(500)
-        batch = db.batch()
-        count = 0
-        for doc in q.stream():
-            batch.update(doc.reference, {"deleted_for": fs_admin.ArrayUnion([uid])})
-            count += 1
-            if count % 400 == 0:
-                batch.commit()
-                batch = db.batch()
-        if count % 400 != 0:
-            batch.commit()
+        clear_chat(uid, thread_id_group(group_id))
 
         return jsonify({"ok": True})
 
     return jsonify({"ok": False, "error": "Invalid type"}), 400
 
-@socketio.on("typing_dm")
+@socket_event("typing_dm")
 def typing_dm(data):
     u = request.environ.get("acertax_user")
     if not u:
         return disconnect()
     other_uid = data.get("other_uid")
+    if not other_uid or not isinstance(other_uid, str):
+        return
     is_typing = bool(data.get("is_typing", False))
     room = dm_room_id(u["uid"], other_uid)
-    # broadcast to the room, but not to the sender
-    emit("typing_update", {
-        "type": "dm",
-        "room": room,
-        "from_uid": u["uid"],
-        "is_typing": is_typing
-    }, room=room, include_self=False)
+    # coalesced; clients skip their own uid in the typing_update list
+    typing_state.set(room, u["uid"], is_typing, {"type": "dm"})
 
 
-@socketio.on("typing_group")
+@socket_event("typing_group")
 def typing_group(data):
     u = request.environ.get("acertax_user")
     if not u:
@@ -556,41 +1072,77 @@ def typing_group(data):
     group_id = data.get("group_id")
     is_typing = bool(data.get("is_typing", False))
 
-    # validate membership
-    gdoc = db.collection("groups").document(group_id).get()
-    if not gdoc.exists:
-        return
-    members = (gdoc.to_dict() or {}).get("members", [])
-    if u["uid"] not in members:
+    # validate membership (in-memory only; typing is too chatty for reads)
+    if not group_index.is_member(group_id, u["uid"]):
         return
 
     room = f"group_{group_id}"
-    emit("typing_update", {
-        "type": "group",
-        "room": room,
-        "group_id": group_id,
-        "from_uid": u["uid"],
-        "is_typing": is_typing
-    }, room=room, include_self=False)
-
-@app.get("/api/unread")
+    typing_state.set(room, u["uid"], is_typing, {"type": "group", "group_id": group_id})
+
+@bp.get("/api/unread")
 @login_required
 def api_unread():
     uid = session["user"]["uid"]
+    group_tids = [thread_id_group(gid) for gid, _ in group_index.groups_for(uid)]
+    version = unread_cache.version(uid, group_tids)
+    tag = f"unread-{version}-{group_index.version}-{uid}" if version else None
+    return etag_response(tag, lambda: _unread_body(uid, group_tids))
+
+def _unread_body(uid, group_tids):
     out = []
-    for doc in db.collection("users").document(uid).collection("unread").stream():
-        d = doc.to_dict() or {}
+    for thread_id, d, count in unread_cache.get(uid, group_tids):
+        others = [m for m in d.get("members", []) if m != uid]
         out.append({
-            "thread_id": doc.id,
+            "thread_id": thread_id,
             "type": d.get("type"),
-            "other_uid": d.get("other_uid"),
+            "other_uid": others[0] if others else None,
             "group_id": d.get("group_id"),
-            "count": int(d.get("count") or 0),
+            "count": count,
         })
     return jsonify({"ok": True, "items": out})
 
+@bp.get("/api/bootstrap")
+@login_required
+def api_bootstrap():
+    """
+    Everything the sidebar needs after login in one response: the user
+    directory, uid's groups, unread counts (threads with any) and a
+    preview of each thread's newest message. The two storage reads,
+    unread counts and "delete chat" watermarks, run concurrently; the
+    watermarks are also cached for the history routes.
+    """
+    uid = session["user"]["uid"]
+    groups = _groups_list(uid)
+    group_tids = [thread_id_group(g["group_id"]) for g in groups]
+    unread, marks = run_concurrently(
+        lambda: unread_cache.get(uid, group_tids),
+        lambda: store.cleared_map(uid),
+    )
 
-@app.post("/api/mark_read")
+    counts = {}
+    previews = {}
+    known = {tid: 0 for tid in group_tids}
+    for thread_id, d, count in unread:
+        known[thread_id] = 0
+        if count:
+            counts[thread_id] = count
+        # threads/{id}.last, unless this worker has seen a newer message
+        last = d.get("last")
+        newest = recent.newest(thread_id)
+        if newest and (not last or int(newest.get("ts") or 0) > int(last.get("ts") or 0)):
+            last = preview(newest.get("id"), newest)
+        if last and int(last.get("ts") or 0) > marks.get(thread_id, 0):
+            previews[thread_id] = {"from_uid": last.get("from_uid"), "text": last.get("text"), "ts": last.get("ts")}
+    known.update(marks)
+    recent.prime_watermarks(uid, known)
+
+    etag, users = directory.users_json()
+    rest = json.dumps({"groups": groups, "unread": counts, "previews": previews}, separators=(",", ":"))
+    body = b'{"ok":true,"users_etag":' + json.dumps(etag).encode() + b',"users":' + users + b"," + rest[1:].encode()
+    return current_app.response_class(body, mimetype="application/json")
+
+
+@bp.post("/api/mark_read")
 @login_required
 def api_mark_read():
     uid = session["user"]["uid"]
@@ -603,26 +1155,26 @@ def api_mark_read():
     return jsonify({"ok": True})
 
 
-@app.get("/api/group/<group_id>")
+@bp.get("/api/group/<group_id>")
 @login_required
 def api_group_detail(group_id):
     uid = session["user"]["uid"]
 
-    gdoc = db.collection("groups").document(group_id).get()
-    if not gdoc.exists:
+    d = group_index.get(group_id)
+    if d is None:
         return jsonify({"ok": False, "error": "Group not found"}), 404
 
-    d = gdoc.to_dict() or {}
     members = d.get("members", [])
 
     if uid not in members:
         return jsonify({"ok": False, "error": "Not a member"}), 403
 
     # Map member uids -> names/emails from Firestore users collection
+    # (one batched read for whatever is not cached)
+    loaded = profiles.get_many(members)
     member_profiles = []
     for mid in members:
-        udoc = db.collection("users").document(mid).get()
-        ud = udoc.to_dict() or {}
+        ud = loaded.get(mid) or {}
         member_profiles.append({
             "uid": mid,
             "email": ud.get("email", ""),
@@ -643,7 +1195,7 @@ def api_group_detail(group_id):
         }
     })
 
-@app.post("/api/delete_group")
+@bp.post("/api/delete_group")
 @login_required
 def api_delete_group():
     uid = session["user"]["uid"]
@@ -654,12 +1206,10 @@ def api_delete_group():
     if not group_id:
         return jsonify({"ok": False, "error": "group_id required"}), 400
 
-    gref = db.collection("groups").document(group_id)
-    gdoc = gref.get()
-    if not gdoc.exists:
+    d = group_index.get(group_id)
+    if d is None:
         return jsonify({"ok": False, "error": "Group not found"}), 404
 
-    d = gdoc.to_dict() or {}
     members = d.get("members", [])
 
     if uid not in members:
@@ -672,15 +1222,114 @@ def api_delete_group():
         return jsonify({"ok": False, "error": "Only group creator/admin can delete"}), 403
 
     # delete group doc
-    gref.delete()
+    store.delete_group(group_id)
+    group_index.remove(group_id)
+    bus.publish("group", {"group_id": group_id, "group": None})
 
-    # optional: soft-clean unread counters for this group for all members
-    tid = thread_id_group(group_id)
-    for m in members:
-        db.collection("users").document(m).collection("unread").document(tid).delete()
+    # drop the thread counter; members' read watermarks are left orphaned
+    store.delete_thread(thread_id_group(group_id))
+    unread_cache.drop_thread(thread_id_group(group_id))
+    search_index.drop_thread(thread_id_group(group_id))
+    recent.drop(thread_id_group(group_id))
 
     return jsonify({"ok": True})
 
+@bp.get("/api/search")
+@login_required
+def api_search():
+    """
+    ?q=words (each matched as a word prefix), limit, before=<cursor from
+    the previous page>. Only threads the user can read, minus cleared
+    history; newest first.
+    """
+    uid = session["user"]["uid"]
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"ok": False, "error": "q required"}), 400
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 20), SEARCH_MAX_PAGE))
+    except ValueError:
+        limit = 20
+    before = None
+    cursor = request.args.get("before") or ""
+    if cursor:
+        try:
+            ts, doc = cursor.split(":")
+            before = (int(ts), int(doc))
+        except ValueError:
+            return jsonify({"ok": False, "error": "bad cursor"}), 400
+
+    group_tids = [thread_id_group(gid) for gid, _ in group_index.groups_for(uid)]
+    hits, nxt = search_index.search(uid, q, group_tids, limit=limit, before=before)
+    return jsonify({
+        "ok": True,
+        "results": hits,
+        "before": f"{nxt[0]}:{nxt[1]}" if nxt else None,
+    })
+
+def component_stats() -> dict:
+    """Every component's stats(), for /api/stats and /metrics."""
+    return {
+        "group_index": group_index.stats(),
+        "write_behind": write_behind.stats() if write_behind else None,
+        "directory": directory.stats(),
+        "profiles": profiles.stats(),
+        "presence": presence.stats(),
+        "presence_fanout": presence_fanout.stats(),
+        "token_cache": token_cache.stats(),
+        "typing": typing_state.stats(),
+        "unread": unread_cache.stats(),
+        "search": search_index.stats(),
+        "compression": compressor.stats(),
+        "recent": recent.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "metrics": metrics.stats(),
+        "storage_executor": storage_executor.stats() if storage_executor else None,
+        "storage_trace": storage_tracer.stats() if storage_tracer else None,
+        "bus": bus.stats(),
+    }
+
+@bp.get("/api/stats")
+@login_required
+def api_stats():
+    """
+    In-process cache counters (hits/misses etc.) for capacity tuning.
+    """
+    return jsonify({"ok": True, **component_stats()})
+
+@bp.get("/metrics")
+def metrics_endpoint():
+    """
+    Prometheus scrape target (text format); needs "Authorization:
+    Bearer <METRICS_TOKEN>", and is not served at all without a token
+    configured.
+    """
+    if not METRICS_TOKEN:
+        return jsonify({"ok": False, "error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"ok": False, "error": "Unauthorized"}), 401
+    return current_app.response_class(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _after_fork():
+    """
+    In a forked child, drop the parent's Firebase app (its gRPC channels
+    and HTTP sessions belong to the parent), give the bus a worker id and
+    connections of its own, and build this process's own state on first
+    use.
+    """
+    global _worker, _worker_lock
+    _worker = None
+    _worker_lock = eventlet.semaphore.Semaphore()
+    firebase_admin._apps.clear()
+    if bus is not None:
+        bus.after_fork()
+    if socketio.server is not None:
+        socketio.server.manager_initialized = False
+
+os.register_at_fork(after_in_child=_after_fork)
 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5002, debug=True)
+    flask_app = create_app()
+    start_worker(flask_app)
+    socketio.run(flask_app, host=HOST, port=PORT, debug=DEBUG, max_size=MAX_CONNECTIONS)
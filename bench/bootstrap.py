@@ -0,0 +1,129 @@
+"""
+Sidebar load after login: /api/users + /api/groups + /api/unread one
+after the other (what chat.js used to do) vs. one /api/bootstrap.
+
+    python bench/bootstrap.py [--latency-ms 40] [--users 300] [--runs 20]
+
+Uses local storage behind a proxy that sleeps --latency-ms in every
+storage call (a blocking sleep, like a Firestore round-trip), injected
+through create_app(config={"STORE": ...}). Each run starts with cold
+unread caches for the user, as right after login. Prints median wall
+time per approach. Bootstrap makes two storage reads (unread counts and
+watermarks); it exits 1 if they took two latencies, i.e. did not
+overlap.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SlowStorage:
+    """Storage proxy adding a fixed blocking delay to every call."""
+
+    def __init__(self, inner, delay: float):
+        self.inner = inner
+        self.delay = delay
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr) or name in ("new_message_id", "watch_groups"):
+            return attr
+
+        def slow(*args, **kwargs):
+            time.sleep(self.delay)
+            return attr(*args, **kwargs)
+        return slow
+
+
+def scenario(latency_ms: int, n_users: int, runs: int) -> dict:
+    """Run in a child process (env already set)."""
+    sys.path.insert(0, ROOT)
+    import app as A
+    from storage import storage_from_env
+
+    base = storage_from_env()
+    flask_app = A.create_app({"STORE": SlowStorage(base, latency_ms / 1000.0)})
+    A.start_worker(flask_app)
+    base.set_users([(f"u{i:04d}", {"email": f"u{i:04d}@acertax.com", "display_name": f"User {i}",
+                                   "online": False, "role": "employee"}) for i in range(n_users)])
+    A.directory.refresh()
+
+    me = "u0000"
+    c = flask_app.test_client()
+    c.post("/session_login", json={"idToken": f"{me}:{me}@acertax.com"})
+    for k in range(5):
+        c.post("/api/create_group", json={"name": f"group {k}", "members": [f"u{k + 1:04d}"]})
+    sock = A.socketio.test_client(flask_app, query_string=f"token={me}:{me}@acertax.com")
+    for k in range(1, 20):
+        sock.emit("send_dm", {"to_uid": f"u{k:04d}", "text": f"hello {k}"})
+
+    def sequential():
+        for url in ("/api/users", "/api/groups", "/api/unread"):
+            c.get(url)
+
+    def bootstrap():
+        c.get("/api/bootstrap")
+
+    out = {}
+    for name, fn in (("sequential", sequential), ("bootstrap", bootstrap)):
+        samples = []
+        for _ in range(runs):
+            A.unread_cache.users.clear()
+            t0 = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - t0) * 1000.0)
+        out[name] = round(statistics.median(samples), 2)
+    out["bootstrap_bytes"] = len(c.get("/api/bootstrap", headers={"Accept-Encoding": "gzip"}).data)
+    sock.disconnect()
+    return out
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        print(json.dumps(scenario(*map(int, sys.argv[2:]))))
+        return
+
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--latency-ms", type=int, default=40)
+    p.add_argument("--users", type=int, default=300)
+    p.add_argument("--runs", type=int, default=20)
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="acertax-bootstrap-")
+    env = {
+        **os.environ,
+        "ACERTAX_STORAGE": "local",
+        "ACERTAX_LOCAL_DB": os.path.join(tmp, "chat.db"),
+        "SEARCH_INDEX_PATH": os.path.join(tmp, "search.db"),
+        "ACERTAX_DEV_TOKENS": "1",
+        "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+        "FLASK_DEBUG": "0",
+    }
+    env.pop("SOCKETIO_MESSAGE_QUEUE", None)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child",
+                           str(args.latency_ms), str(args.users), str(args.runs)],
+                          cwd=tmp, env=env, capture_output=True, text=True)
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit("scenario failed")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["latency_ms"] = args.latency_ms
+
+    for k, v in result.items():
+        print(f"{k:18} {v}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    sys.exit(0 if result["bootstrap"] < 2 * args.latency_ms else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Bytes and time for the page-load / thread-switch GETs, fresh vs.
+revalidated with If-None-Match, with and without gzip.
+
+    python bench/conditional_get.py [--users 500] [--messages 200] [--repeat 200]
+
+Builds a fresh app with local storage (users, one group, a DM with
+--messages messages), then for /api/users, /api/groups, /api/unread and
+both history routes reports the median latency and body size of
+
+  - full   a plain GET
+  - gzip   the same with Accept-Encoding: gzip
+  - 304    a GET carrying the ETag from the previous response
+
+and the storage calls the 304 made (STORAGE_TRACE=1). Exits 1 if any
+route does not answer the revalidation with a 304 or makes a storage
+call doing it.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def token(uid: str) -> str:
+    return f"{uid}:{uid}@acertax.com"
+
+
+def scenario(n_users: int, n_messages: int, repeat: int) -> dict:
+    """Run in a child process (env already set)."""
+    sys.path.insert(0, ROOT)
+    import app as A
+
+    flask_app = A.create_app()
+    A.start_worker(flask_app)
+    A.store.set_users([(f"u{i:04d}", {"email": f"u{i:04d}@acertax.com", "display_name": f"User {i}",
+                                      "online": False, "role": "employee"}) for i in range(n_users)])
+    A.directory.refresh()
+    me, other = "u0000", "u0001"
+    c = flask_app.test_client()
+    c.post("/session_login", json={"idToken": token(me)})
+    sock = A.socketio.test_client(flask_app, query_string=f"token={token(other)}")
+    gid = c.post("/api/create_group", json={"name": "bench", "members": [other]}).get_json()["group_id"]
+    for i in range(n_messages):
+        sock.emit("send_dm", {"to_uid": me, "text": f"message {i} with some ordinary chat text in it"})
+        sock.emit("send_group", {"group_id": gid, "text": f"group message {i} with some text"})
+
+    def timed(url, headers):
+        samples = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            r = c.get(url, headers=headers)
+            samples.append((time.perf_counter() - t0) * 1000.0)
+        return r, round(statistics.median(samples), 3)
+
+    out = {}
+    for url in ("/api/users", "/api/groups", "/api/unread", f"/api/history/dm/{other}", f"/api/history/group/{gid}"):
+        c.get(url)  # warm the caches the ETag comes from
+        full, full_ms = timed(url, {})
+        gz, gz_ms = timed(url, {"Accept-Encoding": "gzip"})
+        nm, nm_ms = timed(url, {"If-None-Match": full.headers.get("ETag") or '"none"'})
+        route = url.split("/")[2] if "history" not in url else "history_" + url.split("/")[3]
+        out[route] = {
+            "full_bytes": len(full.data), "full_ms": full_ms,
+            "gzip_bytes": len(gz.data), "gzip_ms": gz_ms,
+            "not_modified_status": nm.status_code, "not_modified_ms": nm_ms,
+            "not_modified_trace": nm.headers.get("X-Storage-Trace", ""),
+        }
+    sock.disconnect()
+    return out
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        print(json.dumps(scenario(*map(int, sys.argv[2:]))))
+        return
+
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--messages", type=int, default=200)
+    p.add_argument("--repeat", type=int, default=200)
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="acertax-etag-")
+    env = {
+        **os.environ,
+        "ACERTAX_STORAGE": "local",
+        "ACERTAX_LOCAL_DB": os.path.join(tmp, "chat.db"),
+        "SEARCH_INDEX_PATH": os.path.join(tmp, "search.db"),
+        "ACERTAX_DEV_TOKENS": "1",
+        "RATE_LIMITS": '{"default": {}}',  # setup sends faster than a person would
+        "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+        "FLASK_DEBUG": "0",
+        "STORAGE_TRACE": "1",
+        "HISTORY_PAGE_SIZE": str(min(args.messages, 200)),
+    }
+    env.pop("SOCKETIO_MESSAGE_QUEUE", None)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child",
+                           str(args.users), str(args.messages), str(args.repeat)],
+                          cwd=tmp, env=env, capture_output=True, text=True)
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit("scenario failed")
+    results = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    failures = []
+    print(f"{'route':16} {'full':>16} {'gzip':>16} {'304':>10}")
+    for route, r in results.items():
+        ok = r["not_modified_status"] == 304 and "calls=0 " in r["not_modified_trace"] + " "
+        if not ok:
+            failures.append(route)
+        print(f"{route:16} {r['full_bytes']:>8}B {r['full_ms']:>5.2f}ms {r['gzip_bytes']:>8}B {r['gzip_ms']:>5.2f}ms "
+              f"{r['not_modified_ms']:>8.2f}ms" + ("" if ok else f" got {r['not_modified_status']}"))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "failures": failures}, f, indent=2)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
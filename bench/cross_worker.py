@@ -0,0 +1,200 @@
+"""
+Multi-worker smoke check: two app workers sharing a local:// bus and one
+SQLite file, with clients connected to different workers.
+
+    python bench/cross_worker.py [--json out.json]
+
+Checks that a DM, a group message, a typing update and a presence change
+made on one worker reach a client on the other, and that the other
+worker's cached history includes the DM. Runs twice: with two separate
+app.py processes, and "preload" style, where one process builds the app
+with create_app() and then forks the second worker (as gunicorn
+--preload does). Exits 1 if anything does not arrive in either setup.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# create_app() once, then fork a worker per extra port; every process
+# (the parent included) serves one port
+PRELOAD = """
+import os, sys
+import app as A
+
+flask_app = A.create_app()
+ports = sys.argv[1:]
+port = ports[0]
+for other in ports[1:]:
+    if os.fork() == 0:
+        port = other
+        break
+A.start_worker(flask_app)
+A.socketio.run(flask_app, host="127.0.0.1", port=int(port))
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 20.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+class Client:
+    """A Socket.IO client that records what it receives."""
+
+    def __init__(self, port: int, uid: str):
+        self.uid = uid
+        self.events = []
+        self.cond = threading.Condition()
+        self.sio = socketio.Client()
+        self.sio.on("*", self._record)
+        self.sio.connect(f"http://127.0.0.1:{port}?token={uid}:{uid}@acertax.com", transports=["polling"])
+
+    def _record(self, event, *args):
+        with self.cond:
+            self.events.append((event, args[0] if args else None))
+            self.cond.notify_all()
+
+    def wait_for(self, match, timeout: float = 5.0) -> bool:
+        end = time.time() + timeout
+        with self.cond:
+            while True:
+                if any(match(e, p) for e, p in self.events):
+                    return True
+                left = end - time.time()
+                if left <= 0:
+                    return False
+                self.cond.wait(left)
+
+
+def http_session(port: int, uid: str) -> requests.Session:
+    s = requests.Session()
+    r = s.post(f"http://127.0.0.1:{port}/session_login", json={"idToken": f"{uid}:{uid}@acertax.com"})
+    r.raise_for_status()
+    return s
+
+
+def run_checks(p1: int, p2: int) -> dict:
+    results = {}
+    alice = Client(p1, "alice")
+    bob = Client(p2, "bob")
+    time.sleep(0.5)
+
+    # DM: room emit crosses the message queue
+    alice.sio.emit("join_dm", {"other_uid": "bob"})
+    bob.sio.emit("join_dm", {"other_uid": "alice"})
+    time.sleep(0.3)
+    alice.sio.emit("send_dm", {"to_uid": "bob", "text": "hi from worker 1"})
+    results["dm"] = bob.wait_for(lambda e, p: e == "new_message" and p.get("text") == "hi from worker 1")
+
+    # history: worker 2's cached ring must pick up a message sent on worker 1
+    bob_http = http_session(p2, "bob")
+    bob_http.get(f"http://127.0.0.1:{p2}/api/history/dm/alice")
+    alice.sio.emit("send_dm", {"to_uid": "bob", "text": "second from worker 1"})
+    bob.wait_for(lambda e, p: e == "new_message" and p.get("text") == "second from worker 1")
+    time.sleep(0.2)
+    msgs = bob_http.get(f"http://127.0.0.1:{p2}/api/history/dm/alice").json()["messages"]
+    results["history"] = [m.get("text") for m in msgs] == ["hi from worker 1", "second from worker 1"]
+
+    # typing: state is shared over the bus, each worker emits locally
+    alice.sio.emit("typing_dm", {"other_uid": "bob", "is_typing": True})
+    results["typing"] = bob.wait_for(lambda e, p: e == "typing_update" and "alice" in p.get("uids", ()))
+
+    # group created on worker 1 must be known to worker 2's group index
+    gid = http_session(p1, "alice").post(
+        f"http://127.0.0.1:{p1}/api/create_group", json={"name": "xw", "members": ["bob"]}
+    ).json()["group_id"]
+    time.sleep(0.3)
+    alice.sio.emit("join_group", {"group_id": gid})
+    bob.sio.emit("join_group", {"group_id": gid})
+    time.sleep(0.3)
+    bob.sio.emit("send_group", {"group_id": gid, "text": "hi from worker 2"})
+    results["group"] = alice.wait_for(lambda e, p: e == "new_message" and p.get("text") == "hi from worker 2")
+
+    # presence: carol logs in on worker 1, bob watches from worker 2
+    bob.sio.call("presence_subscribe", {"uids": ["carol"]})
+    carol = Client(p1, "carol")
+    results["presence"] = bob.wait_for(
+        lambda e, p: e == "presence_delta" and {"uid": "carol", "online": True} in p.get("updates", ()))
+
+    for c in (alice, bob, carol):
+        c.sio.disconnect()
+    return results
+
+
+def run_setup(preload: bool) -> dict:
+    tmp = tempfile.mkdtemp(prefix="acertax-xw-")
+    bus_port, p1, p2 = free_port(), free_port(), free_port()
+    env = {
+        **os.environ,
+        "ACERTAX_STORAGE": "local",
+        "ACERTAX_LOCAL_DB": os.path.join(tmp, "chat.db"),
+        "SEARCH_INDEX_PATH": os.path.join(tmp, "search.db"),
+        "ACERTAX_DEV_TOKENS": "1",
+        "SOCKETIO_MESSAGE_QUEUE": f"local://127.0.0.1:{bus_port}",
+        "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+        "FLASK_DEBUG": "0",
+        "PRESENCE_FANOUT_SECONDS": "0.1",
+        "TYPING_FLUSH_SECONDS": "0.1",
+    }
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, "bus.py", "--port", str(bus_port)], cwd=ROOT, env=env))
+        wait_port(bus_port)
+        if preload:
+            # own session, so the forked worker is stopped with the parent
+            procs.append(subprocess.Popen([sys.executable, "-c", PRELOAD, str(p1), str(p2)], cwd=ROOT, env=env,
+                                          start_new_session=True))
+        else:
+            for port in (p1, p2):
+                procs.append(subprocess.Popen([sys.executable, "app.py"], cwd=ROOT, env={**env, "PORT": str(port)}))
+        wait_port(p1)
+        wait_port(p2)
+        return run_checks(p1, p2)
+    finally:
+        if preload:
+            os.killpg(procs[-1].pid, signal.SIGTERM)
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(timeout=10)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args()
+
+    results = {"processes": run_setup(False), "preload": run_setup(True)}
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if all(all(r.values()) for r in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+"""
+Load test for the Socket.IO message path.
+
+    python bench/load_test.py [--clients 1000] [--rate 0.5] [--duration 30]
+                              [--json out.json] [--compare baseline.json]
+
+Starts one app.py worker on local storage (a fresh SQLite file, dev
+tokens), creates the groups over HTTP, then runs --clients Socket.IO
+clients spread over --procs client processes. Each client connects,
+joins one DM (clients are paired lt00000/lt00001, ...) and the groups it
+is a member of, and then sends --rate messages per second for
+--duration seconds, --group-ratio of them to a random group of its own.
+
+Reported:
+    connect_ms     time for connect() to return (handshake + auth)
+    latency_ms     send to receipt of new_message, over every receiving
+                   socket (sender included, as the room emit includes it)
+    send_lag_ms    how far behind schedule sends went out; if this grows
+                   the client processes, not the server, are saturated
+    messages       sent / expected deliveries / received / lost
+    throughput     sends and deliveries per second of the send window
+    server         worker CPU % and RSS over the run, plus /api/stats
+
+Sends follow a fixed schedule (open loop), so a slow server shows up as
+latency rather than as fewer sends. --url points the clients at a
+running worker instead; it must have ACERTAX_DEV_TOKENS=1.
+"""
+import sys
+
+if __name__ == "__main__" and "--child" in sys.argv:
+    # client processes run thousands of sync socketio.Clients as green threads
+    import eventlet
+    eventlet.monkey_patch()
+
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMPARE_KEYS = [
+    "connect_ms.p50", "connect_ms.p99",
+    "latency_ms.p50", "latency_ms.p95", "latency_ms.p99", "latency_ms.max",
+    "throughput.sends_per_s", "throughput.deliveries_per_s",
+    "messages.lost", "clients.connect_errors", "disconnects", "server.cpu_pct",
+]
+
+
+def uid_for(i: int) -> str:
+    return f"lt{i:05d}"
+
+
+def token_for(i: int) -> str:
+    return f"{uid_for(i)}:{uid_for(i)}@acertax.com"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 30.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    v = sorted(values)
+
+    def rank(p):
+        return round(v[min(len(v) - 1, max(0, math.ceil(p / 100.0 * len(v)) - 1))], 2)
+
+    return {
+        "count": len(v),
+        "mean": round(sum(v) / len(v), 2),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": round(v[-1], 2),
+    }
+
+
+# -----------------------------
+# Client process (--child)
+# -----------------------------
+class SimClient:
+    def __init__(self, spec: dict, sink: dict):
+        import socketio
+
+        self.idx = spec["idx"]
+        self.partner = spec["partner"]
+        self.groups = spec["groups"]
+        self.sink = sink
+        self.joined = 0
+        self.connected = False
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("new_message", self.on_message)
+        self.sio.on("joined_room", self.on_joined)
+        self.sio.on("disconnect", self.on_disconnect)
+
+    def on_message(self, msg):
+        parts = (msg or {}).get("text", "").split(" ")
+        if len(parts) == 4 and parts[0] == "lt":
+            self.sink["latency_ms"].append(round((time.time() - float(parts[1])) * 1000.0, 3))
+            self.sink["received"] += 1
+
+    def on_joined(self, _):
+        self.joined += 1
+
+    def on_disconnect(self, *args):
+        if self.connected and not self.sink["stopping"]:
+            self.sink["disconnects"] += 1
+        self.connected = False
+
+    def connect(self, url: str, transports):
+        t0 = time.perf_counter()
+        try:
+            self.sio.connect(f"{url}?token={token_for(self.idx)}", transports=transports, wait_timeout=30)
+        except Exception as e:
+            self.sink["connect_errors"] += 1
+            reason = f"{type(e).__name__}: {e}"[:120]
+            self.sink["connect_error_reasons"][reason] = self.sink["connect_error_reasons"].get(reason, 0) + 1
+            return
+        self.sink["connect_ms"].append(round((time.perf_counter() - t0) * 1000.0, 3))
+        self.connected = True
+        self.sio.emit("join_dm", {"other_uid": uid_for(self.partner)})
+        for gid in self.groups:
+            self.sio.emit("join_group", {"group_id": gid})
+
+    def send_loop(self, rate: float, group_ratio: float, start: float, end: float, seed: int):
+        rnd = random.Random(seed)
+        interval = 1.0 / rate
+        next_at = start + rnd.random() * interval
+        seq = 0
+        while next_at < end and self.connected:
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.time()
+            self.sink["send_lag_ms"].append(round((now - next_at) * 1000.0, 3))
+            text = f"lt {now:.6f} {self.idx} {seq}"
+            try:
+                if self.groups and rnd.random() < group_ratio:
+                    gid = rnd.choice(self.groups)
+                    self.sio.emit("send_group", {"group_id": gid, "text": text})
+                    key = f"g:{gid}"
+                else:
+                    self.sio.emit("send_dm", {"to_uid": uid_for(self.partner), "text": text})
+                    key = f"d:{min(self.idx, self.partner)}"
+                self.sink["sent"][key] = self.sink["sent"].get(key, 0) + 1
+            except Exception:
+                self.sink["send_errors"] += 1
+            seq += 1
+            next_at += interval
+
+
+def child_main():
+    """
+    stdin: plan JSON line, then "go <start epoch>".
+    stdout: {"ready": ...} once connected, {"result": ...} when done.
+    """
+    from eventlet import tpool
+
+    plan = json.loads(sys.stdin.readline())
+    sink = {
+        "connect_ms": [], "latency_ms": [], "send_lag_ms": [], "sent": {},
+        "received": 0, "connect_errors": 0, "connect_error_reasons": {}, "send_errors": 0, "disconnects": 0,
+        "stopping": False,
+    }
+    clients = [SimClient(spec, sink) for spec in plan["clients"]]
+
+    # ramp connects at connect_rate per second
+    threads = []
+    gap = 1.0 / plan["connect_rate"]
+    for c in clients:
+        t = threading.Thread(target=c.connect, args=(plan["url"], plan["transports"]))
+        t.start()
+        threads.append(t)
+        time.sleep(gap)
+    for t in threads:
+        t.join()
+    end = time.time() + 30
+    for c in clients:
+        while c.connected and c.joined < 1 + len(c.groups) and time.time() < end:
+            time.sleep(0.05)
+
+    live = [c.idx for c in clients if c.connected]
+    print(json.dumps({"ready": {"connected": live}}), flush=True)
+
+    line = tpool.execute(sys.stdin.readline)
+    start = float(line.split()[1])
+    stop = start + plan["duration"]
+    senders = []
+    for c in clients:
+        if c.connected:
+            t = threading.Thread(target=c.send_loop,
+                                 args=(plan["rate"], plan["group_ratio"], start, stop, plan["seed"] + c.idx))
+            t.start()
+            senders.append(t)
+    for t in senders:
+        t.join()
+    time.sleep(max(0.0, stop + plan["drain"] - time.time()))
+
+    sink["stopping"] = True
+    result = {k: v for k, v in sink.items() if k != "stopping"}
+    print(json.dumps({"result": result}), flush=True)
+    for c in clients:
+        if c.connected:
+            try:
+                c.sio.disconnect()
+            except Exception:
+                pass
+
+
+# -----------------------------
+# Driver
+# -----------------------------
+def build_plan(n: int, group_count: int, group_size: int):
+    """Pairs for DMs and contiguous blocks of clients for groups."""
+    groups = []
+    for g in range(group_count):
+        groups.append([(g * group_size + k) % n for k in range(min(group_size, n))])
+    return groups
+
+
+def create_groups(url: str, groups):
+    """Each group is created by its first member; returns group ids."""
+    import requests
+
+    ids = []
+    for i, members in enumerate(groups):
+        s = requests.Session()
+        s.post(f"{url}/session_login", json={"idToken": token_for(members[0])}).raise_for_status()
+        r = s.post(f"{url}/api/create_group",
+                   json={"name": f"load {i}", "members": [uid_for(m) for m in members]})
+        r.raise_for_status()
+        ids.append(r.json()["group_id"])
+    return ids
+
+
+def server_stats(url: str):
+    import requests
+
+    s = requests.Session()
+    try:
+        s.post(f"{url}/session_login", json={"idToken": token_for(0)}).raise_for_status()
+        return s.get(f"{url}/api/stats").json()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def proc_cpu_seconds(pid: int):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def proc_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def compare(base: dict, cur: dict):
+    def get(d, key):
+        for part in key.split("."):
+            d = d.get(part) if isinstance(d, dict) else None
+        return d
+
+    print(f"{'metric':32} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key in COMPARE_KEYS:
+        a, b = get(base, key), get(cur, key)
+        if a is None and b is None:
+            continue
+        change = f"{(b - a) / a * 100.0:+.1f}%" if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a else ""
+        print(f"{key:32} {a if a is not None else '-':>12} {b if b is not None else '-':>12} {change:>9}")
+
+
+def run(args) -> dict:
+    n = args.clients + (args.clients % 2)  # DMs need pairs
+    procs = args.procs or max(1, min(8, n // 250))
+    tmp = tempfile.mkdtemp(prefix="acertax-load-")
+    server = None
+    children = []
+    try:
+        url = args.url
+        if not url:
+            port = free_port()
+            env = {
+                **os.environ,
+                "ACERTAX_STORAGE": "local",
+                "ACERTAX_LOCAL_DB": os.path.join(tmp, "chat.db"),
+                "SEARCH_INDEX_PATH": os.path.join(tmp, "search.db"),
+                "ACERTAX_DEV_TOKENS": "1",
+                "RATE_LIMITS": '{"default": {}}',  # clients send faster than a person would
+                "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+                "FLASK_DEBUG": "0",
+                "HOST": "127.0.0.1",
+                "PORT": str(port),
+            }
+            env.pop("SOCKETIO_MESSAGE_QUEUE", None)
+            log = open(os.path.join(tmp, "server.log"), "w")
+            server = subprocess.Popen([sys.executable, "app.py"], cwd=ROOT, env=env, stdout=log, stderr=log)
+            wait_port(port)
+            url = f"http://127.0.0.1:{port}"
+
+        group_count = args.groups if args.groups is not None else n // max(1, args.group_size)
+        groups = build_plan(n, group_count, args.group_size)
+        t0 = time.time()
+        group_ids = create_groups(url, groups)
+        print(f"created {len(group_ids)} groups in {time.time() - t0:.1f}s", file=sys.stderr)
+
+        member_of = {i: [] for i in range(n)}
+        for gid, members in zip(group_ids, groups):
+            for m in set(members):
+                member_of[m].append(gid)
+
+        specs = [{"idx": i, "partner": i ^ 1, "groups": member_of[i]} for i in range(n)]
+        for k in range(procs):
+            plan = {
+                "url": url,
+                "transports": args.transport.split(",") if args.transport else None,
+                "clients": specs[k::procs],
+                "rate": args.rate,
+                "group_ratio": args.group_ratio,
+                "duration": args.duration,
+                "drain": args.drain,
+                "connect_rate": max(1.0, args.connect_rate / procs),
+                "seed": args.seed,
+            }
+            child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child"],
+                                     cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            child.stdin.write(json.dumps(plan) + "\n")
+            child.stdin.flush()
+            children.append(child)
+
+        t0 = time.time()
+        connected = set()
+        for child in children:
+            connected.update(json.loads(child.stdout.readline())["ready"]["connected"])
+        print(f"connected {len(connected)}/{n} clients in {time.time() - t0:.1f}s", file=sys.stderr)
+
+        cpu0, wall0 = (proc_cpu_seconds(server.pid) if server else None), time.time()
+        start = time.time() + 1.0
+        for child in children:
+            child.stdin.write(f"go {start}\n")
+            child.stdin.flush()
+        results = [json.loads(child.stdout.readline())["result"] for child in children]
+        cpu1, wall1 = (proc_cpu_seconds(server.pid) if server else None), time.time()
+        stats = server_stats(url)
+        rss = proc_rss_mb(server.pid) if server else None
+    finally:
+        for child in children:
+            child.stdin.close()
+            try:
+                child.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                child.kill()
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+
+    # expected deliveries: every connected member of the room, sender included
+    rooms = {f"d:{i}": {i, i + 1} for i in range(0, n, 2)}
+    rooms.update({f"g:{gid}": set(members) for gid, members in zip(group_ids, groups)})
+    sent_by_room = {}
+    for r in results:
+        for key, count in r["sent"].items():
+            sent_by_room[key] = sent_by_room.get(key, 0) + count
+    sent = sum(sent_by_room.values())
+    expected = sum(count * len(rooms[key] & connected) for key, count in sent_by_room.items())
+    received = sum(r["received"] for r in results)
+
+    def merged(name):
+        return [x for r in results for x in r[name]]
+
+    reasons = {}
+    for r in results:
+        for reason, count in r["connect_error_reasons"].items():
+            reasons[reason] = reasons.get(reason, 0) + count
+
+    cpu_pct = None
+    if cpu0 is not None and cpu1 is not None:
+        cpu_pct = round((cpu1 - cpu0) / max(wall1 - wall0, 1e-6) * 100.0, 1)
+    return {
+        "config": {
+            "clients": n, "procs": procs, "rate": args.rate, "duration": args.duration,
+            "group_ratio": args.group_ratio, "groups": len(group_ids), "group_size": args.group_size,
+            "transport": args.transport or "polling,websocket", "url": args.url or "spawned",
+        },
+        "clients": {
+            "planned": n,
+            "connected": len(connected),
+            "connect_errors": sum(r["connect_errors"] for r in results),
+            "connect_error_reasons": reasons,
+        },
+        "connect_ms": percentiles(merged("connect_ms")),
+        "latency_ms": percentiles(merged("latency_ms")),
+        "send_lag_ms": percentiles(merged("send_lag_ms")),
+        "messages": {
+            "sent": sent,
+            "send_errors": sum(r["send_errors"] for r in results),
+            "expected": expected,
+            "received": received,
+            "lost": max(0, expected - received),
+        },
+        "throughput": {
+            "sends_per_s": round(sent / args.duration, 1),
+            "deliveries_per_s": round(received / args.duration, 1),
+        },
+        "disconnects": sum(r["disconnects"] for r in results),
+        "server": {"cpu_pct": cpu_pct, "rss_mb": rss, "stats": stats},
+    }
+
+
+def main():
+    if "--child" in sys.argv:
+        return child_main()
+
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument("--procs", type=int, default=0, help="client processes (default: one per 250 clients, max 8)")
+    p.add_argument("--rate", type=float, default=0.5, help="messages per second per client")
+    p.add_argument("--duration", type=float, default=30.0, help="seconds of sending")
+    p.add_argument("--drain", type=float, default=5.0, help="seconds to wait for deliveries after sending")
+    p.add_argument("--group-ratio", type=float, default=0.2, help="fraction of sends that go to a group")
+    p.add_argument("--groups", type=int, default=None, help="default: clients / group-size")
+    p.add_argument("--group-size", type=int, default=10)
+    p.add_argument("--connect-rate", type=float, default=200.0, help="new connections per second, in total")
+    p.add_argument("--transport", default="", help="e.g. polling or websocket (default: polling, then upgrade)")
+    p.add_argument("--url", default="", help="use a running worker instead of starting one")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--compare", help="print the change against an earlier --json file")
+    args = p.parse_args()
+
+    result = run(args)
+    summary = {k: v for k, v in result.items() if k != "server"}
+    summary["server"] = {k: v for k, v in result["server"].items() if k != "stats"}
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
+    sys.exit(0 if result["messages"]["received"] else 1)
+
+
+if __name__ == "__main__":
+    main()
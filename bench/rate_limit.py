@@ -0,0 +1,120 @@
+"""
+One scripted client flooding send_group while another user sends at a
+human pace, with the default RATE_LIMITS.
+
+    python bench/rate_limit.py [--flood 500] [--members 50]
+
+Reports the acks each sender got, the storage writes the flood cost
+(STORAGE_TRACE=1), the rate_limit stats and the cost of one limiter
+check. Exits 1 if the flood got more sends through than its burst plus
+what refilled meanwhile, or the other user was limited at all.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scenario(n_flood: int, n_members: int) -> dict:
+    """Run in a child process (env already set)."""
+    sys.path.insert(0, ROOT)
+    import app as A
+    from ratelimit import RateLimiter
+
+    flask_app = A.create_app()
+    A.start_worker(flask_app)
+    uids = [f"u{i:03d}" for i in range(n_members)]
+    c = flask_app.test_client()
+    c.post("/session_login", json={"idToken": f"{uids[0]}:{uids[0]}@acertax.com"})
+    gid = c.post("/api/create_group", json={"name": "flood", "members": uids[1:]}).get_json()["group_id"]
+    bot = A.socketio.test_client(flask_app, query_string=f"token={uids[0]}:{uids[0]}@acertax.com")
+    person = A.socketio.test_client(flask_app, query_string=f"token={uids[1]}:{uids[1]}@acertax.com")
+
+    def send(sock, text):
+        ack = sock.emit("send_group", {"group_id": gid, "text": text}, callback=True)
+        return (ack or {}).get("error") or "ok"
+
+    writes = A.storage_tracer.stats()["handlers"].get("send_group", {}).get("writes", 0)
+    t0 = time.perf_counter()
+    bot_acks = Counter()
+    person_acks = Counter()
+    for i in range(n_flood):
+        bot_acks[send(bot, f"spam {i}")] += 1
+        if i % 50 == 0:
+            person_acks[send(person, f"hello {i}")] += 1
+    flood_ms = (time.perf_counter() - t0) * 1000.0
+    writes = A.storage_tracer.stats()["handlers"]["send_group"]["writes"] - writes
+
+    limiter = RateLimiter(A.RATE_LIMITS)
+    n = 200000
+    t0 = time.perf_counter()
+    for i in range(n):
+        limiter.check("u000", "employee", "typing_group")
+    check_ns = (time.perf_counter() - t0) * 1e9 / n
+
+    bot.disconnect()
+    person.disconnect()
+    return {
+        "bot_acks": dict(bot_acks),
+        "person_acks": dict(person_acks),
+        "flood_ms": round(flood_ms, 1),
+        "flood_storage_writes": writes,
+        "check_ns": round(check_ns, 1),
+        "limit": A.RATE_LIMITS["default"]["send_group"],
+        "rate_limit": A.rate_limiter.stats(),
+    }
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        print(json.dumps(scenario(*map(int, sys.argv[2:]))))
+        return
+
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--flood", type=int, default=500)
+    p.add_argument("--members", type=int, default=50)
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="acertax-ratelimit-")
+    env = {
+        **os.environ,
+        "ACERTAX_STORAGE": "local",
+        "ACERTAX_LOCAL_DB": os.path.join(tmp, "chat.db"),
+        "SEARCH_INDEX_PATH": os.path.join(tmp, "search.db"),
+        "ACERTAX_DEV_TOKENS": "1",
+        "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+        "FLASK_DEBUG": "0",
+        "STORAGE_TRACE": "1",
+    }
+    env.pop("SOCKETIO_MESSAGE_QUEUE", None)
+    env.pop("RATE_LIMITS", None)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", str(args.flood), str(args.members)],
+                          cwd=tmp, env=env, capture_output=True, text=True)
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit("scenario failed")
+    r = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    print(f"flood    {args.flood} sends in {r['flood_ms']}ms: {r['bot_acks']}, "
+          f"{r['flood_storage_writes']} storage writes")
+    print(f"person   {r['person_acks']}")
+    print(f"check    {r['check_ns']}ns")
+    print(f"stats    {r['rate_limit']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(r, f, indent=2)
+    rate, burst = r["limit"]
+    ok = (r["bot_acks"].get("ok", 0) <= burst + rate * r["flood_ms"] / 1000.0 + 1
+          and "rate_limited" not in r["person_acks"])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
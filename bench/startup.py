@@ -0,0 +1,129 @@
+"""
+Startup cost of one worker, measured in fresh processes.
+
+    python bench/startup.py [--runs 5] [--json out.json]
+
+For each run, a new interpreter reports
+
+  - import_ms        import app
+  - create_app_ms    create_app() (no I/O, no threads)
+  - firestore_ms     create_app() with ACERTAX_STORAGE=firestore and no
+                     credentials (must succeed: Firebase is not touched)
+  - first_request_ms first GET /, which builds the worker's state
+  - fork_ms          create_app() in a parent, then --forks children that
+                     each serve their first request with their own state
+
+and prints the median of each. Exits 1 if create_app() fails without
+credentials or a forked child does not build its own state.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(forks: int) -> dict:
+    """Run in a child process (env already set); returns timings in ms."""
+    sys.path.insert(0, ROOT)
+    out = {}
+    t0 = time.perf_counter()
+    import app as A
+    out["import_ms"] = (time.perf_counter() - t0) * 1000.0
+
+    t0 = time.perf_counter()
+    flask_app = A.create_app()
+    out["create_app_ms"] = (time.perf_counter() - t0) * 1000.0
+    out["threads_after_create_app"] = len(__import__("threading").enumerate())
+
+    os.environ["ACERTAX_STORAGE"] = "firestore"
+    A.STORAGE_BACKEND = "firestore"
+    t0 = time.perf_counter()
+    A.create_app()
+    out["firestore_ms"] = (time.perf_counter() - t0) * 1000.0
+    out["firebase_initialized"] = bool(A.firebase_admin._apps)
+    os.environ["ACERTAX_STORAGE"] = A.STORAGE_BACKEND = "local"
+    flask_app = A.create_app()
+
+    # fork before this process has any state of its own
+    t0 = time.perf_counter()
+    children = []
+    for _ in range(forks):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            status = flask_app.test_client().get("/").status_code
+            ok = status < 500 and A._worker == (os.getpid(), flask_app) and A.store is not None
+            os.write(w, b"1" if ok else b"0")
+            os._exit(0)
+        os.close(w)
+        children.append((pid, r))
+    out["fork_ok"] = 0
+    for pid, r in children:
+        out["fork_ok"] += os.read(r, 1) == b"1"
+        os.close(r)
+        os.waitpid(pid, 0)
+    out["fork_ms"] = (time.perf_counter() - t0) * 1000.0
+    out["forks"] = forks
+
+    t0 = time.perf_counter()
+    flask_app.test_client().get("/")
+    out["first_request_ms"] = (time.perf_counter() - t0) * 1000.0
+    return out
+
+
+def run_once(forks: int, tmp: str) -> dict:
+    env = {
+        **os.environ,
+        "ACERTAX_STORAGE": "local",
+        "ACERTAX_LOCAL_DB": os.path.join(tmp, "chat.db"),
+        "SEARCH_INDEX_PATH": os.path.join(tmp, "search.db"),
+        "ACERTAX_DEV_TOKENS": "1",
+        "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+        "FLASK_DEBUG": "0",
+    }
+    env.pop("SOCKETIO_MESSAGE_QUEUE", None)
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", str(forks)],
+                         cwd=tmp, env=env, capture_output=True, text=True)
+    if out.returncode:
+        sys.stderr.write(out.stderr)
+        raise SystemExit("startup run failed")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        print(json.dumps(measure(int(sys.argv[2]))))
+        return
+
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--forks", type=int, default=4)
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="acertax-startup-")
+    runs = [run_once(args.forks, tmp) for _ in range(args.runs)]
+    keys = ("import_ms", "create_app_ms", "firestore_ms", "first_request_ms", "fork_ms")
+    result = {k: round(statistics.median(r[k] for r in runs), 2) for k in keys}
+    result["threads_after_create_app"] = max(r["threads_after_create_app"] for r in runs)
+    result["firebase_initialized"] = any(r["firebase_initialized"] for r in runs)
+    result["fork_ok"] = f"{min(r['fork_ok'] for r in runs)}/{args.forks}"
+    for k, v in result.items():
+        print(f"{k:26} {v}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"runs": runs, "median": result}, f, indent=2)
+    failed = result["firebase_initialized"] or any(r["fork_ok"] != args.forks for r in runs)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
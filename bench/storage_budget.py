@@ -0,0 +1,133 @@
+"""
+Storage round-trip check for every route and socket event.
+
+    python bench/storage_budget.py [--sizes 3,40] [--json out.json]
+
+Runs the same scenario (N users log in, connect, share one group and a
+DM, send N messages each way, then read history/unread/members/search
+and delete the group) once per size, each on a fresh app with local
+storage and cold caches, with STORAGE_TRACE on. Prints the most storage
+calls each handler made at each size and exits 1 if a handler
+
+  - made more calls at the larger size (its I/O grows with the data), or
+  - went over its budget in app.STORAGE_BUDGETS / STORAGE_BUDGETS.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def token(uid: str) -> str:
+    return f"{uid}:{uid}@acertax.com"
+
+
+def scenario(n: int) -> dict:
+    """Run in a child process (env already set); returns tracer stats."""
+    sys.path.insert(0, ROOT)
+    import app as A
+
+    flask_app = A.create_app()
+    uids = [f"u{i:03d}" for i in range(n)]
+    http = {}
+    for uid in uids:
+        c = flask_app.test_client()
+        c.post("/session_login", json={"idToken": token(uid)})
+        http[uid] = c
+    sockets = {uid: A.socketio.test_client(flask_app, query_string=f"token={token(uid)}") for uid in uids}
+
+    me, other = uids[0], uids[1]
+    gid = http[me].post("/api/create_group", json={"name": "budget", "members": uids}).get_json()["group_id"]
+    for uid in uids:
+        sockets[uid].emit("join_group", {"group_id": gid})
+    sockets[me].emit("join_dm", {"other_uid": other})
+    sockets[me].emit("presence_subscribe", {"uids": uids})
+    for i in range(n):
+        sockets[me].emit("send_group", {"group_id": gid, "text": f"group message {i}"})
+        sockets[other].emit("send_dm", {"to_uid": me, "text": f"direct message {i}"})
+    sockets[me].emit("typing_group", {"group_id": gid, "is_typing": True})
+    sockets[me].emit("heartbeat")
+    A.search_index.flush()
+
+    c = http[me]
+    c.get("/api/users")
+    c.get("/api/groups")
+    c.get(f"/api/group/{gid}")
+    c.get(f"/api/history/dm/{other}")
+    c.get(f"/api/history/group/{gid}")
+    c.get("/api/unread")
+    c.get("/api/bootstrap")
+    c.post("/api/mark_read", json={"thread_id": A.thread_id_dm(me, other)})
+    c.get("/api/search?q=message")
+    c.post("/api/delete_chat", json={"type": "dm", "other_uid": other})
+    c.post("/api/delete_group", json={"group_id": gid})
+    for s in sockets.values():
+        s.disconnect()
+    return A.storage_tracer.stats()
+
+
+def run_size(n: int, tmp: str) -> dict:
+    env = {
+        **os.environ,
+        "ACERTAX_STORAGE": "local",
+        "ACERTAX_LOCAL_DB": os.path.join(tmp, f"chat{n}.db"),
+        "SEARCH_INDEX_PATH": os.path.join(tmp, f"search{n}.db"),
+        "ACERTAX_DEV_TOKENS": "1",
+        "RATE_LIMITS": '{"default": {}}',  # setup sends faster than a person would
+        "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+        "FLASK_DEBUG": "0",
+        "STORAGE_TRACE": "1",
+    }
+    env.pop("SOCKETIO_MESSAGE_QUEUE", None)
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", str(n)],
+                         cwd=tmp, env=env, capture_output=True, text=True)
+    if out.returncode:
+        sys.stderr.write(out.stderr)
+        raise SystemExit(f"scenario with {n} users failed")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        print(json.dumps(scenario(int(sys.argv[2]))))
+        return
+
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sizes", default="3,40", help="user counts, smallest first")
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args()
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    tmp = tempfile.mkdtemp(prefix="acertax-budget-")
+    runs = {n: run_size(n, tmp)["handlers"] for n in sizes}
+    names = sorted({name for handlers in runs.values() for name in handlers})
+
+    failures = []
+    rows = {}
+    print(f"{'handler':28} " + " ".join(f"{f'n={n}':>7}" for n in sizes) + f" {'budget':>7}")
+    for name in names:
+        calls = [runs[n].get(name, {}).get("max_calls") for n in sizes]
+        budget = next((runs[n][name]["budget"] for n in sizes if name in runs[n]), None)
+        over = sum(runs[n].get(name, {}).get("over_budget", 0) for n in sizes)
+        seen = [c for c in calls if c is not None]
+        grows = len(seen) > 1 and seen[-1] > seen[0]
+        flag = " grows with data" if grows else ""
+        flag += " over budget" if over else ""
+        if flag:
+            failures.append(name)
+        rows[name] = {"calls": dict(zip(map(str, sizes), calls)), "budget": budget, "grows": grows, "over_budget": over}
+        print(f"{name:28} " + " ".join(f"{'-' if c is None else c:>7}" for c in calls)
+              + f" {'-' if budget is None else budget:>7}{flag}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"sizes": sizes, "handlers": rows, "failures": failures}, f, indent=2)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
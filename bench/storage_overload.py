@@ -0,0 +1,218 @@
+"""
+A burst of send_group against slow storage, without the storage
+executor (STORAGE_EXECUTOR=0), with it, and with it in a monkey-patched
+process (as under gunicorn's eventlet worker).
+
+    python bench/storage_overload.py [--latency-ms 50] [--senders 60] [--concurrency 4] [--queue 16]
+
+Uses local storage behind a proxy that blocks --latency-ms in every
+storage call, patched or not (like a Firestore gRPC call). --senders
+sockets each send one group message at the same moment while a ticker
+greenlet measures how late the hub wakes it. Reports per mode the burst
+wall time, the worst hub lag, the acks by result and the most storage
+calls in flight.
+
+With the executor it then makes storage slower than STORAGE_SLOW_MS,
+checks that the circuit breaker opens and refuses sends fast, that it
+closes again once storage recovers, and that a half-open probe refused
+for a full queue does not keep it from closing. Exits 1 if either
+executor mode lets more than --concurrency calls run at once, blocks
+the hub for a whole storage call or makes hub calls inline, or the
+breaker does not open and close.
+"""
+import sys
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--child"] and sys.argv[-1] == "1":
+    import eventlet
+    eventlet.monkey_patch()
+
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+from eventlet import patcher
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SlowStorage:
+    """Storage proxy adding a blocking delay to every call; counts concurrent calls."""
+
+    def __init__(self, inner, delay: float):
+        self.inner = inner
+        self.delay = delay
+        self.lock = patcher.original("threading").Lock()
+        self.sleep = patcher.original("time").sleep  # blocks even when patched
+        self.active = 0
+        self.max_active = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr) or name in ("new_message_id", "watch_groups"):
+            return attr
+
+        def slow(*args, **kwargs):
+            with self.lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            try:
+                self.sleep(self.delay)
+                return attr(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+        return slow
+
+
+def scenario(latency_ms: int, n_senders: int) -> dict:
+    """Run in a child process (env already set)."""
+    sys.path.insert(0, ROOT)
+    import eventlet
+    import app as A
+    from storage import storage_from_env
+
+    slow = SlowStorage(storage_from_env(), latency_ms / 1000.0)
+    flask_app = A.create_app({"STORE": slow})
+    A.start_worker(flask_app)
+    uids = [f"u{i:03d}" for i in range(n_senders)]
+    slow.inner.set_users([(uid, {"email": f"{uid}@acertax.com", "display_name": uid, "online": False,
+                                 "role": "employee"}) for uid in uids])
+    c = flask_app.test_client()
+    c.post("/session_login", json={"idToken": f"{uids[0]}:{uids[0]}@acertax.com"})
+    gid = c.post("/api/create_group", json={"name": "burst", "members": uids[1:]}).get_json()["group_id"]
+    socks = [A.socketio.test_client(flask_app, query_string=f"token={uid}:{uid}@acertax.com") for uid in uids]
+    slow.max_active = 0
+
+    lag = []
+    stop = []
+
+    def ticker():
+        while not stop:
+            t0 = time.perf_counter()
+            eventlet.sleep(0.005)
+            lag.append((time.perf_counter() - t0 - 0.005) * 1000.0)
+
+    def send(sock, text):
+        ack = sock.emit("send_group", {"group_id": gid, "text": text}, callback=True)
+        return (ack or {}).get("error") or "ok"
+
+    tick = eventlet.spawn(ticker)
+    eventlet.sleep(0.02)
+    t0 = time.perf_counter()
+    acks = Counter(eventlet.GreenPool(n_senders).imap(lambda s: send(s, "burst"), socks))
+    out = {
+        "burst_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+        "max_hub_lag_ms": round(max(lag), 1),
+        "acks": dict(acks),
+        "max_in_flight": slow.max_active,
+    }
+    stop.append(1)
+    tick.wait()
+
+    if A.storage_executor is not None:
+        breaker = A.storage_executor.breaker
+        slow.delay = (breaker.slow_ms + 50) / 1000.0
+        trip = Counter(send(socks[i % n_senders], "slow") for i in range(breaker.window + 5))
+        t0 = time.perf_counter()
+        refused = send(socks[0], "refused")
+        out["breaker"] = {
+            "after_slow_calls": dict(trip),
+            "refused": refused,
+            "refused_ms": round((time.perf_counter() - t0) * 1000.0, 2),
+            "state_open": breaker.state,
+        }
+        slow.delay = latency_ms / 1000.0
+        eventlet.sleep(breaker.cooldown + 0.1)
+        out["breaker"]["after_cooldown"] = send(socks[0], "probe")
+        out["breaker"]["state_after"] = breaker.state
+
+        # a half-open probe refused as busy must not wedge the breaker
+        ex = A.storage_executor
+        for _ in range(breaker.window):
+            breaker.record(breaker.slow_ms + 1, True)
+        eventlet.sleep(breaker.cooldown + 0.1)
+        for _ in range(ex.max_concurrency):
+            ex.slots.acquire()
+        max_queue, ex.max_queue = ex.max_queue, 0
+        out["breaker"]["busy_probe"] = send(socks[0], "busy probe")
+        ex.max_queue = max_queue
+        for _ in range(ex.max_concurrency):
+            ex.slots.release()
+        out["breaker"]["after_busy_probe"] = send(socks[0], "probe again")
+        out["breaker"]["state_after_busy_probe"] = breaker.state
+        out["executor"] = A.storage_executor.stats()
+    for sock in socks:
+        sock.disconnect()
+    return out
+
+
+def run(args, executor: bool, patched: bool = False) -> dict:
+    tmp = tempfile.mkdtemp(prefix="acertax-executor-")
+    env = {
+        **os.environ,
+        "ACERTAX_STORAGE": "local",
+        "ACERTAX_LOCAL_DB": os.path.join(tmp, "chat.db"),
+        "SEARCH_INDEX_PATH": os.path.join(tmp, "search.db"),
+        "ACERTAX_DEV_TOKENS": "1",
+        "FIREBASE_SERVICE_ACCOUNT": os.path.join(tmp, "none.json"),
+        "FLASK_DEBUG": "0",
+        "STORAGE_EXECUTOR": "1" if executor else "0",
+        "STORAGE_MAX_CONCURRENCY": str(args.concurrency),
+        "STORAGE_MAX_QUEUE": str(args.queue),
+        "STORAGE_SLOW_MS": str(args.latency_ms * 4),
+        "STORAGE_BREAKER_COOLDOWN_SECONDS": "1",
+    }
+    env.pop("SOCKETIO_MESSAGE_QUEUE", None)
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child",
+                           str(args.latency_ms), str(args.senders), str(int(patched))],
+                          cwd=tmp, env=env, capture_output=True, text=True)
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit("scenario failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        print(json.dumps(scenario(*map(int, sys.argv[2:4]))))
+        return
+
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--latency-ms", type=int, default=50)
+    p.add_argument("--senders", type=int, default=60)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--queue", type=int, default=16)
+    p.add_argument("--json", help="write results to this file")
+    args = p.parse_args()
+
+    results = {"inline": run(args, False), "executor": run(args, True), "patched": run(args, True, patched=True)}
+    for mode, r in results.items():
+        print(f"{mode:9} burst {r['burst_ms']:>8.1f}ms  hub lag max {r['max_hub_lag_ms']:>7.1f}ms  "
+              f"in flight max {r['max_in_flight']:>3}  acks {r['acks']}")
+    ok = True
+    for mode in ("executor", "patched"):
+        r = results[mode]
+        b = r["breaker"]
+        print(f"{mode:9} breaker {b['after_slow_calls']} -> {b['state_open']}, refused {b['refused']} in "
+              f"{b['refused_ms']}ms, after cooldown {b['after_cooldown']} -> {b['state_after']}, "
+              f"probe {b['busy_probe']} then {b['after_busy_probe']} -> {b['state_after_busy_probe']}; "
+              f"{r['executor']['inline']} of {r['executor']['calls']} calls inline")
+        ok = ok and (r["max_in_flight"] <= args.concurrency
+                     and r["max_hub_lag_ms"] < args.latency_ms
+                     and r["executor"]["inline"] == 0
+                     and b["refused"] == "storage_unavailable" and b["after_cooldown"] == "ok"
+                     and b["state_after"] == "closed"
+                     and b["busy_probe"] == "storage_busy" and b["after_busy_probe"] == "ok"
+                     and b["state_after_busy_probe"] == "closed")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
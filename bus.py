@@ -0,0 +1,255 @@
+"""
+Cross-worker message bus.
+
+Socket.IO needs a message queue once there is more than one worker, so
+that an emit to a room reaches sockets held by the other workers.
+SOCKETIO_MESSAGE_QUEUE picks it:
+
+    redis://host:6379/0, kafka://..., zmq+tcp://..., amqp://...
+        the python-socketio managers (need the matching client library)
+    local://127.0.0.1:6390
+        the small broker below, for a single box / tests:
+            python bus.py --port 6390
+
+Whatever the queue, the same channel also carries this app's own
+messages (presence, typing and group changes) through publish() and
+subscribe(). With no queue configured there is only one worker and
+NullBus is used instead.
+"""
+import argparse
+import uuid
+from urllib.parse import urlparse
+
+import socketio
+from eventlet.semaphore import Semaphore
+
+APP_METHOD = "acertax"
+
+
+class BusMixin:
+    """
+    App-level pub/sub on top of any socketio.PubSubManager. App messages
+    use their own "method", which the Socket.IO handlers ignore; they are
+    taken out of the stream before _thread sees it. Messages are not
+    delivered back to the worker that published them.
+    """
+
+    def _init_bus(self):
+        self.handlers = {}
+        self.published = 0
+        self.received = 0
+        self.handler_errors = 0
+
+    @property
+    def worker_id(self) -> str:
+        return self.host_id
+
+    def after_fork(self):
+        """
+        In a forked child: a worker id of its own (messages carrying the
+        parent's id would be dropped as our own) and no connections or
+        listener inherited from the parent. The Socket.IO server must
+        initialize the manager again to start this process's listener.
+        """
+        self.host_id = uuid.uuid4().hex
+        self.thread = None
+        self._reset_connections()
+
+    def _reset_connections(self):
+        pass
+
+    def subscribe(self, kind: str, handler):
+        """handler(payload) is called for every `kind` message from other workers."""
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind: str, payload: dict):
+        self._publish({"method": APP_METHOD, "host_id": self.host_id, "kind": kind, "data": payload})
+        self.published += 1
+
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if not isinstance(message, dict):
+                try:
+                    data = self.json.loads(message)
+                except Exception:
+                    yield message
+                    continue
+            if isinstance(data, dict) and data.get("method") == APP_METHOD:
+                if data.get("host_id") != self.host_id:
+                    self._dispatch(data)
+                continue
+            yield message
+
+    def _dispatch(self, data):
+        self.received += 1
+        for handler in self.handlers.get(data.get("kind"), ()):
+            try:
+                handler(data.get("data") or {})
+            except Exception:
+                self.handler_errors += 1
+                self._get_logger().exception("bus handler failed for %r", data.get("kind"))
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "worker_id": self.host_id,
+            "published": self.published,
+            "received": self.received,
+            "handler_errors": self.handler_errors,
+        }
+
+
+class NullBus:
+    """Single worker: nobody to talk to."""
+
+    worker_id = "single"
+
+    def after_fork(self):
+        pass
+
+    def subscribe(self, kind: str, handler):
+        pass
+
+    def publish(self, kind: str, payload: dict):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": None, "worker_id": self.worker_id}
+
+
+# -----------------------------
+# local:// broker
+# -----------------------------
+class LocalSocketManager(socketio.PubSubManager):
+    """
+    PubSubManager for the local:// broker: newline-delimited JSON over
+    TCP, one connection to listen on and one to publish on. Every message
+    is relayed to every connection but the one it came in on, so the
+    publisher's listening connection gets it too (like Redis), and the
+    publish connection, which is never read, never fills up.
+    """
+
+    name = "local"
+
+    def __init__(self, url="local://127.0.0.1:6390", channel="socketio", write_only=False,
+                 logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        u = urlparse(url)
+        self.address = (u.hostname or "127.0.0.1", u.port or 6390)
+        self.pub_sock = None
+        # held across a green sendall: a real lock would block the hub
+        # when a second greenlet publishes meanwhile
+        self.pub_lock = Semaphore()
+
+    def _connect(self):
+        import eventlet
+        return eventlet.connect(self.address)
+
+    def _reset_connections(self):
+        # the parent keeps using its socket; the child opens its own
+        self.pub_sock = None
+        self.pub_lock = Semaphore()
+
+    def _publish(self, data):
+        line = (self.json.dumps([self.channel, data]) + "\n").encode()
+        with self.pub_lock:
+            for attempt in range(2):
+                try:
+                    if self.pub_sock is None:
+                        self.pub_sock = self._connect()
+                    self.pub_sock.sendall(line)
+                    return
+                except OSError:
+                    self.pub_sock = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        import eventlet
+
+        while True:
+            try:
+                sock = self._connect()
+                for line in sock.makefile("rb"):
+                    try:
+                        channel, data = self.json.loads(line)
+                    except ValueError:
+                        continue
+                    if channel == self.channel:
+                        yield data
+            except OSError:
+                self._get_logger().error("local bus connection lost; retrying")
+            eventlet.sleep(1)
+
+
+def serve(host: str = "127.0.0.1", port: int = 6390):
+    """Relay every line received on any connection to all the others."""
+    import eventlet
+
+    clients = {}  # socket -> send lock
+
+    def relay(line, origin):
+        for sock, lock in list(clients.items()):
+            if sock is origin:
+                continue
+            try:
+                with lock:
+                    sock.sendall(line)
+            except OSError:
+                clients.pop(sock, None)
+
+    def handle(sock):
+        clients[sock] = Semaphore()
+        try:
+            for line in sock.makefile("rb"):
+                relay(line, sock)
+        except OSError:
+            pass
+        finally:
+            clients.pop(sock, None)
+            sock.close()
+
+    server = eventlet.listen((host, port))
+    print(f"bus listening on {host}:{port}", flush=True)
+    while True:
+        sock, _ = server.accept()
+        eventlet.spawn_n(handle, sock)
+
+
+# -----------------------------
+# Factory
+# -----------------------------
+def _queue_class(url: str):
+    # same choices Flask-SocketIO makes for message_queue=, plus local://
+    if url.startswith("local://"):
+        return LocalSocketManager
+    if url.startswith(("redis://", "rediss://")):
+        return socketio.RedisManager
+    if url.startswith("kafka://"):
+        return socketio.KafkaManager
+    if url.startswith("zmq"):
+        return socketio.ZmqManager
+    return socketio.KombuManager
+
+
+def make_bus(url, channel: str = "acertax-connect"):
+    """
+    The client_manager to hand to SocketIO (None for the in-memory
+    default) and the bus app code publishes on; they are the same object
+    when a queue is configured.
+    """
+    if not url:
+        return None, NullBus()
+    base = _queue_class(url)
+    manager = type(f"Bus{base.__name__}", (BusMixin, base), {})(url, channel=channel)
+    manager._init_bus()
+    return manager, manager
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="local:// message bus for multi-worker dev/test setups")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=6390)
+    args = p.parse_args()
+    serve(args.host, args.port)
@@ -0,0 +1,98 @@
+"""
+gzip / brotli for large Flask responses (JSON, HTML, JS, CSS).
+
+Brotli is used when the client accepts it and the `brotli` package is
+installed, gzip otherwise. Bodies of responses that carry an ETag are
+kept compressed in a small LRU keyed by path, ETag and encoding, so the
+same /api/users or history page is compressed once per version rather
+than once per request. Socket.IO traffic does not pass through Flask and
+is not affected.
+"""
+import gzip
+import time
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+COMPRESSIBLE = ("application/json", "application/javascript", "text/")
+
+
+class Compressor:
+    def __init__(self, min_size: int = 1024, level: int = 6, cache_size: int = 256):
+        self.min_size = min_size
+        self.level = level
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (path, etag, encoding) -> bytes
+        self.encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+        self.compressed = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ms_total = 0.0
+
+    def instrument_app(self, app):
+        app.after_request(self.compress_response)
+
+    def _encoding(self):
+        best, best_q = None, 0
+        for enc in self.encodings:
+            q = request.accept_encodings[enc]
+            if q > best_q:
+                best, best_q = enc, q
+        return best
+
+    def _compress(self, data: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(data, quality=min(self.level, 11))
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def compress_response(self, response):
+        if (response.status_code != 200 or response.direct_passthrough
+                or "Content-Encoding" in response.headers
+                or not (response.mimetype or "").startswith(COMPRESSIBLE)):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = self._encoding()
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        etag = response.headers.get("ETag")
+        key = (request.full_path, etag, encoding) if etag else None
+        body = self.cache.get(key) if key else None
+        if body is not None:
+            self.cache.move_to_end(key)
+            self.cache_hits += 1
+        else:
+            t0 = time.perf_counter()
+            body = self._compress(data, encoding)
+            self.ms_total += (time.perf_counter() - t0) * 1000.0
+            self.compressed += 1
+            if key:
+                self.cache[key] = body
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        self.bytes_in += len(data)
+        self.bytes_out += len(body)
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "encodings": ",".join(self.encodings),
+            "compressed": self.compressed,
+            "cache_hits": self.cache_hits,
+            "cached": len(self.cache),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ms_avg": round(self.ms_total / self.compressed, 3) if self.compressed else 0.0,
+        }
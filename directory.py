@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+
+
+class Directory:
+    """
+    Materialized employee list behind /api/users.
+
+    A full rebuild (Firebase Auth accounts merged with `users` profiles)
+    runs at startup and then every `refresh_interval` seconds on a
+    background thread. Presence/profile changes made by this process are
+    applied incrementally with apply(). Requests get a pre-serialized,
+    pre-sorted JSON body plus an ETag, so serving /api/users does no
+    storage or Auth calls.
+    """
+
+    def __init__(self, store, list_auth_users=None, ensure_profile=None,
+                 domain: str = "@acertax.com", refresh_interval: float = 300.0):
+        self.store = store
+        # callable yielding (uid, email) for every Auth account; None means
+        # "profiles only" (local backend without Firebase)
+        self.list_auth_users = list_auth_users
+        self.ensure_profile = ensure_profile
+        self.domain = domain
+        self.refresh_interval = refresh_interval
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.version = 0
+        self.epoch = int(time.time())
+        self._body = None
+        self._users_json = None
+        self._body_version = -1
+        # changes applied while a refresh is reading storage; replayed
+        # over the rebuilt entries so they are not lost
+        self._pending = None
+        self.thread = None
+        self.running = False
+
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.last_refresh_ms = 0.0
+        self.served = 0
+        self.rebuilt = 0
+
+    # -----------------------------
+    # Lifecycle
+    # -----------------------------
+    def start(self):
+        self.refresh()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="directory-refresh", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception:
+                self.refresh_errors += 1
+
+    # -----------------------------
+    # Building entries
+    # -----------------------------
+    def _entry(self, uid: str, email: str, prof: dict) -> dict:
+        return {
+            "uid": uid,
+            "email": email,
+            "display_name": prof.get("display_name") or (email.split("@")[0]),
+            "online": bool(prof.get("online", False)),
+            "last_seen": prof.get("last_seen"),
+            "role": prof.get("role", "employee"),
+        }
+
+    def refresh(self):
+        t0 = time.time()
+        with self.lock:
+            self._pending = {}
+        profiles = dict(self.store.iter_users())
+
+        if self.list_auth_users is None:
+            accounts = [(uid, (p.get("email") or "").lower()) for uid, p in profiles.items()]
+        else:
+            accounts = list(self.list_auth_users())
+
+        entries = {}
+        for uid, email in accounts:
+            if not email.endswith(self.domain):
+                continue  # only company users
+            prof = profiles.get(uid)
+            # If profile missing, create a basic one (so it appears immediately)
+            if prof is None and self.ensure_profile:
+                self.ensure_profile(uid, email)
+            entries[uid] = self._entry(uid, email, prof or {})
+
+        with self.lock:
+            for uid, fields in self._pending.items():
+                if uid in entries:
+                    entries[uid] = self._entry(uid, entries[uid]["email"], {**entries[uid], **fields})
+                elif uid in self.entries:
+                    entries[uid] = self.entries[uid]
+            self._pending = None
+            self.entries = entries
+            self.version += 1
+        self.refreshes += 1
+        self.last_refresh_ms = (time.time() - t0) * 1000.0
+
+    def apply(self, uid: str, fields: dict):
+        """Merge a profile change (e.g. presence) into the snapshot."""
+        with self.lock:
+            if self._pending is not None:
+                self._pending.setdefault(uid, {}).update(fields)
+            cur = self.entries.get(uid)
+            if cur is None:
+                email = (fields.get("email") or "").lower()
+                if not email.endswith(self.domain):
+                    return
+                self.entries[uid] = self._entry(uid, email, fields)
+            else:
+                merged = {**cur, **fields}
+                self.entries[uid] = self._entry(uid, cur["email"], merged)
+            self.version += 1
+
+    # -----------------------------
+    # Serving
+    # -----------------------------
+    def _rebuild(self):
+        if self._body_version != self.version:
+            users = sorted(self.entries.values(),
+                           key=lambda x: (not x["online"], (x["display_name"] or "").lower()))
+            self._users_json = json.dumps(users, separators=(",", ":")).encode()
+            self._body = b'{"ok":true,"users":' + self._users_json + b"}"
+            self._body_version = self.version
+            self.rebuilt += 1
+        self.served += 1
+
+    def snapshot(self):
+        """(etag, JSON body bytes) for the current user list."""
+        with self.lock:
+            self._rebuild()
+            return f"users-{self.epoch}-{self._body_version}", self._body
+
+    def users_json(self):
+        """(etag, JSON array bytes): the "users" part of snapshot(), for embedding."""
+        with self.lock:
+            self._rebuild()
+            return f"users-{self.epoch}-{self._body_version}", self._users_json
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.entries),
+            "version": self.version,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "last_refresh_ms": round(self.last_refresh_ms, 2),
+            "served": self.served,
+            "rebuilt": self.rebuilt,
+        }
@@ -0,0 +1,117 @@
+import threading
+import time
+
+
+class GroupIndex:
+    """
+    Process-wide cache of group documents:
+      group_id -> group dict (name, members, created_by, ...)
+      uid      -> set of group_ids the user belongs to
+
+    Warmed from storage at startup and kept fresh through the storage
+    change feed (Firestore on_snapshot / LocalStorage watchers), so
+    membership checks on the message and typing paths never hit storage.
+    `version` changes whenever any group is added, changed or removed.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.by_member = {}
+        self.warm = False
+        self.watch = None
+        self.epoch = int(time.time() * 1000)
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def start(self):
+        for group_id, d in self.store.iter_groups():
+            self.put(group_id, d)
+        self.watch = self.store.watch_groups(self._on_changes)
+        self.warm = True
+
+    def stop(self):
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
+        self.warm = False
+
+    def _on_changes(self, changes):
+        """changes: iterable of (group_id, dict or None when removed)."""
+        for group_id, d in changes:
+            self.invalidations += 1
+            if d is None:
+                self.remove(group_id)
+            else:
+                self.put(group_id, d)
+
+    def put(self, group_id: str, d: dict):
+        with self.lock:
+            self._unlink(group_id)
+            self.groups[group_id] = d
+            self.version += 1
+            for m in d.get("members", []):
+                self.by_member.setdefault(m, set()).add(group_id)
+
+    def remove(self, group_id: str):
+        with self.lock:
+            self._unlink(group_id)
+            if self.groups.pop(group_id, None) is not None:
+                self.version += 1
+
+    def _unlink(self, group_id):
+        old = self.groups.get(group_id)
+        if not old:
+            return
+        for m in old.get("members", []):
+            ids = self.by_member.get(m)
+            if ids:
+                ids.discard(group_id)
+                if not ids:
+                    del self.by_member[m]
+
+    def get(self, group_id: str):
+        """Group dict or None if the group does not exist."""
+        if not group_id:
+            return None
+        d = self.groups.get(group_id)
+        if d is not None:
+            self.hits += 1
+            return d
+        self.misses += 1
+        d = self.store.get_group(group_id)
+        if d is not None:
+            self.put(group_id, d)
+        return d
+
+    def is_member(self, group_id: str, uid: str) -> bool:
+        """Membership check against the cache only (never reads storage)."""
+        with self.lock:
+            self.hits += 1
+            return group_id in self.by_member.get(uid, ())
+
+    def groups_for(self, uid: str):
+        """(group_id, group dict) pairs for every group uid is a member of."""
+        if self.warm:
+            self.hits += 1
+            with self.lock:
+                return [(gid, self.groups[gid]) for gid in self.by_member.get(uid, ())]
+        self.misses += 1
+        out = list(self.store.groups_for_member(uid))
+        for group_id, d in out:
+            self.put(group_id, d)
+        return out
+
+    def stats(self) -> dict:
+        return {
+            "groups": len(self.groups),
+            "members": len(self.by_member),
+            "warm": self.warm,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
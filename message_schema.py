@@ -0,0 +1,92 @@
+import time
+from datetime import datetime
+
+# -----------------------------
+# Message document schema
+# -----------------------------
+# v2 (current):
+#   {"v": 2, "thread": "dm_<a>_<b>" | "group_<id>", "from_uid": str,
+#    "text": str, "ts": int (epoch ms)}
+#
+# v1 (legacy, no "v" field):
+#   {"type": "dm" | "group", "room": str, "group_id": str, "to_uid": str,
+#    "from_uid": str, "text": str, "ts": int ms or ISO string,
+#    "deleted_for": [uid, ...]}
+#
+# Everything else about a message (type, group id, DM peer) is derived
+# from the thread key, so readers never need to normalize documents.
+# Per-user "delete chat" is a cleared_before watermark in storage, not a
+# field on messages; migrate_messages.py turns deleted_for lists into
+# watermarks and upgrade() drops them.
+#
+# threads/{id}.last holds a preview of the thread's newest message,
+# written with it, so the sidebar needs no per-thread message query.
+SCHEMA_VERSION = 2
+PREVIEW_CHARS = 100
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def new_message(thread_id: str, from_uid: str, text: str) -> dict:
+    return {
+        "v": SCHEMA_VERSION,
+        "thread": thread_id,
+        "from_uid": from_uid,
+        "text": text,
+        "ts": now_ms(),
+    }
+
+
+def preview(msg_id: str, msg: dict) -> dict:
+    return {
+        "id": msg_id,
+        "from_uid": msg.get("from_uid"),
+        "text": (msg.get("text") or "")[:PREVIEW_CHARS],
+        "ts": msg.get("ts"),
+    }
+
+
+def to_ms(ts) -> int:
+    """
+    Epoch ms from a legacy ts (int/float ms or ISO string); 0 if unparseable.
+    """
+    if isinstance(ts, (int, float)):
+        return int(ts)
+    if isinstance(ts, str):
+        try:
+            # handle "Z"
+            return int(datetime.fromisoformat(ts.replace("Z", "+00:00")).timestamp() * 1000)
+        except ValueError:
+            return 0
+    return 0
+
+
+def legacy_thread_id(d: dict):
+    if d.get("room"):
+        return d["room"]
+    if d.get("group_id"):
+        return f"group_{d['group_id']}"
+    return None
+
+
+def upgrade(d: dict):
+    """
+    The v2 form of a stored message, or None if it is already clean v2
+    (or is too broken to place in a thread).
+    """
+    if d.get("v") == SCHEMA_VERSION:
+        if "deleted_for" not in d:
+            return None
+        return {k: v for k, v in d.items() if k != "deleted_for"}
+    thread_id = legacy_thread_id(d)
+    if not thread_id:
+        return None
+    return {
+        "v": SCHEMA_VERSION,
+        "thread": thread_id,
+        "from_uid": d.get("from_uid"),
+        "text": d.get("text") or "",
+        "ts": to_ms(d.get("ts")),
+    }
@@ -0,0 +1,292 @@
+"""
+Prometheus metrics for one worker, served by app.py at /metrics in the
+text exposition format (no client library needed).
+
+    acertax_http_request_duration_seconds{endpoint,method}   histogram
+    acertax_http_responses_total{endpoint,method,status}      counter
+    acertax_socketio_event_duration_seconds{event}            histogram
+    acertax_socketio_event_errors_total{event}                counter
+    acertax_socketio_packets_sent_total{event}                counter
+    acertax_socketio_sent_bytes_total{event}                  counter
+    acertax_socketio_connected_sockets                        gauge
+    acertax_socketio_rooms{kind} / room_size{kind}            gauge / histogram
+    acertax_eventlet_loop_lag_seconds                         histogram
+    acertax_eventlet_hub_{readers,writers,timers}             gauge
+    acertax_<component>_<stat>                                 from /api/stats
+
+Recording is a dict lookup and a few integer adds per request, event or
+packet; gauges are computed only when /metrics is scraped. There is no
+lock: under eventlet nothing switches greenlets inside a record call.
+"""
+import time
+from bisect import bisect_left
+
+from flask import g, request
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+ROOM_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+ROOM_KINDS = ("dm", "group", "user")
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _fmt(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value == value and value not in (float("inf"), float("-inf")) else "NaN"
+    return str(int(value))
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{n}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _event_name(data) -> str:
+    """Event name of an encoded Socket.IO EVENT packet, e.g. '2["new_message",{...}]'."""
+    if not isinstance(data, str) or data[:1] != "2":
+        return "_other"
+    i = data.find('["')
+    j = data.find('"', i + 2) if i >= 0 else -1
+    return data[i + 2:j] if j > 0 else "_other"
+
+
+class Metrics:
+    """
+    Registry for this worker. Routes are timed by instrument_app(),
+    socket handlers report through observe_event() (app.socket_event),
+    and every packet the server sends is counted by instrument_socketio().
+    """
+
+    def __init__(self, loop_lag_interval: float = 1.0):
+        self.loop_lag_interval = loop_lag_interval
+        self.http = {}          # (endpoint, method) -> Histogram
+        self.http_status = {}   # (endpoint, method, status) -> count
+        self.events = {}        # event -> Histogram
+        self.event_errors = {}  # event -> count
+        self.packets = {}       # event -> [packets, bytes]
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.gauges = []        # (name, help, fn, label name)
+        self.collectors = []    # fn() -> list of exposition lines
+        self.scrapes = 0
+
+    # -----------------------------
+    # Recording
+    # -----------------------------
+    def observe_request(self, endpoint: str, method: str, status: int, seconds: float):
+        key = (endpoint, method)
+        h = self.http.get(key)
+        if h is None:
+            h = self.http[key] = Histogram()
+        h.observe(seconds)
+        key = (endpoint, method, status)
+        self.http_status[key] = self.http_status.get(key, 0) + 1
+
+    def observe_event(self, event: str, seconds: float, failed: bool = False):
+        h = self.events.get(event)
+        if h is None:
+            h = self.events[event] = Histogram()
+        h.observe(seconds)
+        if failed:
+            self.event_errors[event] = self.event_errors.get(event, 0) + 1
+
+    def count_packet(self, data):
+        name = _event_name(data)
+        item = self.packets.get(name)
+        if item is None:
+            item = self.packets[name] = [0, 0]
+        item[0] += 1
+        item[1] += len(data) if isinstance(data, (str, bytes)) else 0
+
+    # -----------------------------
+    # Hooks
+    # -----------------------------
+    def instrument_app(self, app):
+        """Time every Flask request (Socket.IO traffic does not reach Flask)."""
+        @app.before_request
+        def _metrics_start():
+            g.metrics_t0 = time.perf_counter()
+
+        @app.after_request
+        def _metrics_done(response):
+            t0 = g.pop("metrics_t0", None)
+            if t0 is not None:
+                self.observe_request(request.endpoint or "unmatched", request.method,
+                                     response.status_code, time.perf_counter() - t0)
+            return response
+
+    def instrument_socketio(self, server):
+        """
+        Count every packet server sends, per socket (a room emit to 50
+        sockets is 50), and register socket/room gauges. Wraps the
+        Engine.IO server's send_packet on this instance.
+        """
+        eio = server.eio
+        send_packet = eio.send_packet
+
+        def counted(sid, pkt):
+            self.count_packet(pkt.data)
+            return send_packet(sid, pkt)
+
+        eio.send_packet = counted
+        self.gauge("acertax_socketio_connected_sockets", "Engine.IO sockets held by this worker.",
+                   lambda: len(eio.sockets))
+        self.collectors.append(lambda: self._room_lines(server.manager))
+
+    def gauge(self, name: str, help_text: str, fn, label: str = None):
+        """fn() -> number, or {label value: number} when label is given; called per scrape."""
+        self.gauges.append((name, help_text, fn, label))
+
+    def stats_gauges(self, prefix: str, fn):
+        """Export every number in fn() -> {component: {stat: value}} (i.e. /api/stats)."""
+        self.collectors.append(lambda: self._stats_lines(prefix, fn()))
+
+    # -----------------------------
+    # Loop lag
+    # -----------------------------
+    def run(self, sleep):
+        """
+        How late the event loop wakes us up; anything blocking the hub
+        (sync I/O, long CPU work) shows up here. Start with
+        socketio.start_background_task.
+        """
+        while True:
+            t0 = time.perf_counter()
+            sleep(self.loop_lag_interval)
+            self.loop_lag.observe(max(0.0, time.perf_counter() - t0 - self.loop_lag_interval))
+
+    # -----------------------------
+    # Exposition
+    # -----------------------------
+    def render(self) -> str:
+        self.scrapes += 1
+        out = []
+        self._histograms(out, "acertax_http_request_duration_seconds", "Flask request latency.",
+                         ("endpoint", "method"), self.http)
+        self._counters(out, "acertax_http_responses_total", "Flask responses by status.",
+                       ("endpoint", "method", "status"), self.http_status)
+        self._histograms(out, "acertax_socketio_event_duration_seconds", "Socket.IO handler latency.",
+                         ("event",), {(k,): v for k, v in self.events.items()})
+        self._counters(out, "acertax_socketio_event_errors_total", "Socket.IO handlers that raised.",
+                       ("event",), {(k,): v for k, v in self.event_errors.items()})
+        self._counters(out, "acertax_socketio_packets_sent_total", "Socket.IO packets sent, one per socket.",
+                       ("event",), {(k,): v[0] for k, v in self.packets.items()})
+        self._counters(out, "acertax_socketio_sent_bytes_total", "Encoded Socket.IO payload bytes sent.",
+                       ("event",), {(k,): v[1] for k, v in self.packets.items()})
+        self._histograms(out, "acertax_eventlet_loop_lag_seconds", "Event loop wake-up delay.",
+                         (), {(): self.loop_lag})
+        self._hub_lines(out)
+
+        for name, help_text, fn, label in self.gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} gauge")
+            if label is None:
+                out.append(f"{name} {_fmt(value)}")
+            else:
+                for k, v in sorted(value.items()):
+                    out.append(f"{name}{_labels((label,), (k,))} {_fmt(v)}")
+        for collect in self.collectors:
+            try:
+                out.extend(collect())
+            except Exception:
+                continue
+        return "\n".join(out) + "\n"
+
+    def _histograms(self, out, name, help_text, label_names, series):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} histogram")
+        for key in sorted(series):
+            h = series[key]
+            cumulative = 0
+            for le, n in zip(h.buckets + ("+Inf",), h.counts):
+                cumulative += n
+                out.append(f"{name}_bucket{_labels(label_names + ('le',), key + (le,))} {cumulative}")
+            out.append(f"{name}_sum{_labels(label_names, key)} {_fmt(h.sum)}")
+            out.append(f"{name}_count{_labels(label_names, key)} {h.count}")
+
+    def _counters(self, out, name, help_text, label_names, series):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} counter")
+        for key in sorted(series):
+            out.append(f"{name}{_labels(label_names, key)} {_fmt(series[key])}")
+
+    def _hub_lines(self, out):
+        try:
+            from eventlet import hubs
+            hub = hubs.get_hub()
+            values = {
+                "readers": len(hub.get_readers()),
+                "writers": len(hub.get_writers()),
+                "timers": len(hub.timers) + len(hub.next_timers),
+            }
+        except Exception:
+            return
+        for k, v in values.items():
+            out.append(f"# HELP acertax_eventlet_hub_{k} Eventlet hub {k} at scrape time.")
+            out.append(f"# TYPE acertax_eventlet_hub_{k} gauge")
+            out.append(f"acertax_eventlet_hub_{k} {v}")
+
+    def _room_lines(self, manager):
+        """Rooms by kind (dm_/group_/user_ prefix) and a histogram of their sizes."""
+        rooms = manager.rooms.get("/", {})
+        sizes = {k: Histogram(ROOM_SIZE_BUCKETS) for k in ROOM_KINDS}
+        for room, members in list(rooms.items()):
+            kind = room.split("_", 1)[0] if isinstance(room, str) else None
+            if kind in sizes:
+                sizes[kind].observe(len(members))
+        out = [
+            "# HELP acertax_socketio_rooms Socket.IO rooms with at least one socket on this worker.",
+            "# TYPE acertax_socketio_rooms gauge",
+        ]
+        for kind, h in sizes.items():
+            out.append(f"acertax_socketio_rooms{_labels(('kind',), (kind,))} {h.count}")
+        self._histograms(out, "acertax_socketio_room_size", "Sockets per room on this worker.",
+                         ("kind",), {(k,): h for k, h in sizes.items()})
+        return out
+
+    def _stats_lines(self, prefix, stats):
+        out = []
+        for component, values in sorted(stats.items()):
+            if not isinstance(values, dict):
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{component}_{key}"
+                out.append(f"# TYPE {name} untyped")
+                out.append(f"{name} {_fmt(value)}")
+        return out
+
+    def stats(self) -> dict:
+        return {
+            "routes": len(self.http),
+            "events": len(self.events),
+            "packets_sent": sum(v[0] for v in self.packets.values()),
+            "bytes_sent": sum(v[1] for v in self.packets.values()),
+            "scrapes": self.scrapes,
+        }
@@ -0,0 +1,122 @@
+"""
+Rewrite legacy `messages` documents into the v2 schema (message_schema.py).
+
+    python migrate_messages.py [--page 2000] [--batch 250] [--workers 8]
+                               [--checkpoint PATH] [--restart] [--dry-run]
+
+Documents are scanned in id order, one page at a time. Each page's
+rewrites are split into batches that are committed in parallel, and the
+last id of the page is saved to the checkpoint file once they have all
+landed. A killed run resumes from the checkpoint. Already-v2 documents are
+skipped, so re-running with --restart (e.g. to catch documents written by
+an older deploy) is safe.
+
+Legacy per-message `deleted_for` lists are folded into per-user
+cleared_before watermarks (Storage.clear_thread): for every uid, the
+newest message they had hidden in a thread becomes their watermark.
+
+Uses the same ACERTAX_STORAGE / FIREBASE_SERVICE_ACCOUNT settings as app.py.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+from message_schema import upgrade
+from storage import storage_from_env
+
+SERVICE_ACCOUNT_PATH = os.environ.get("FIREBASE_SERVICE_ACCOUNT", "firebase_service_account.json")
+
+
+def firestore_client():
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(SERVICE_ACCOUNT_PATH))
+    return firestore.client()
+
+
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"last_id": None, "scanned": 0, "migrated": 0, "watermarks": 0}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, state: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def migrate(store, page_size=2000, batch_size=250, workers=8, checkpoint=None, dry_run=False, log=sys.stderr):
+    state = load_checkpoint(checkpoint) if checkpoint else {"last_id": None, "scanned": 0, "migrated": 0, "watermarks": 0}
+    t0 = time.time()
+    scanned_at_start = state["scanned"]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            page = store.scan_messages(start_after=state["last_id"], limit=page_size)
+            if not page:
+                break
+
+            todo = []
+            cleared = {}  # (uid, thread) -> newest hidden ts
+            for msg_id, d in page:
+                v2 = upgrade(d)
+                if v2 is not None:
+                    todo.append((msg_id, v2))
+                    for uid in d.get("deleted_for") or ():
+                        key = (uid, v2["thread"])
+                        cleared[key] = max(cleared.get(key, 0), v2["ts"])
+
+            if todo and not dry_run:
+                # watermarks first: once deleted_for is gone from a doc a
+                # rerun could not rebuild them. clear_thread never moves a
+                # watermark back, so pages may land in any order.
+                list(pool.map(lambda kv: store.clear_thread(kv[0][0], kv[0][1], kv[1]), cleared.items()))
+                chunks = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+                # list() re-raises the first failed batch; the checkpoint
+                # is not advanced, so the page is retried on the next run
+                list(pool.map(store.put_messages, chunks))
+
+            state["last_id"] = page[-1][0]
+            state["scanned"] += len(page)
+            state["migrated"] += len(todo)
+            state["watermarks"] = state.get("watermarks", 0) + len(cleared)
+            if checkpoint and not dry_run:
+                save_checkpoint(checkpoint, state)
+
+            elapsed = max(time.time() - t0, 1e-6)
+            rate = (state["scanned"] - scanned_at_start) / elapsed
+            print(f"scanned={state['scanned']} migrated={state['migrated']} "
+                  f"last_id={state['last_id']} rate={rate:.0f} docs/s", file=log, flush=True)
+
+    return state
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--page", type=int, default=2000, help="documents scanned per page")
+    p.add_argument("--batch", type=int, default=250, help="documents per write batch")
+    p.add_argument("--workers", type=int, default=8, help="batches committed in parallel")
+    p.add_argument("--checkpoint", default="migrate_messages.checkpoint")
+    p.add_argument("--restart", action="store_true", help="ignore the checkpoint and scan from the start")
+    p.add_argument("--dry-run", action="store_true", help="count documents that need rewriting; write nothing")
+    args = p.parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    store = storage_from_env(firestore_client)
+    state = migrate(store, page_size=args.page, batch_size=args.batch, workers=args.workers,
+                    checkpoint=args.checkpoint, dry_run=args.dry_run)
+    print(f"done: scanned={state['scanned']} migrated={state['migrated']} watermarks={state.get('watermarks', 0)}")
+
+
+if __name__ == "__main__":
+    main()
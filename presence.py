@@ -0,0 +1,388 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _parse_iso(s) -> float:
+    try:
+        return datetime.fromisoformat(str(s).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return 0.0
+
+
+class PresenceEngine:
+    """
+    Online/offline tracking for Socket.IO connections.
+
+    - Sockets are ref-counted per uid: a user with three tabs is online
+      until the last one goes away, so tabs don't flap presence.
+    - Only transitions (0 -> 1 sockets, 1 -> 0) call on_transition(uid,
+      online), which persists and broadcasts them.
+    - Heartbeats just update in-memory last_seen; flush() writes the
+      changed ones in one batched Storage.set_users() call.
+    - sweep() drops local sockets that stopped heartbeating, and marks
+      offline any user storage still has online whose last_seen is older
+      than heartbeat_timeout and who has no socket here. That covers
+      workers that crashed before their disconnects fired. Storage is
+      only asked for those stale users, and only by one worker: the one
+      with the lowest id among those heard from within heartbeat_timeout.
+
+    flush_interval must be well under heartbeat_timeout, or the sweeper
+    of one worker will mark users connected to another worker offline.
+
+    With several workers, pass the bus (bus.py): each worker announces
+    the uids it gains/loses and, every sweep_interval, the full list it
+    holds. A user is online while any worker has a socket for them, so
+    on_transition only fires for cluster-wide transitions, on the worker
+    that caused them; the others get on_remote(uid, online) to refresh
+    their caches and watchers. If a "down" that was persisted races with
+    a connect here, this worker persists online again.
+    """
+
+    def __init__(self, store, on_transition, flush_interval: float = 30.0,
+                 heartbeat_timeout: float = 90.0, sweep_interval: float = 30.0,
+                 bus=None, on_remote=None):
+        self.store = store
+        self.on_transition = on_transition
+        self.on_remote = on_remote
+        self.flush_interval = flush_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.sweep_interval = sweep_interval
+        self.bus = bus
+
+        self.lock = threading.Lock()
+        self.sockets = {}    # uid -> {sid: last heartbeat (epoch s)}
+        self.dirty = {}      # uid -> last_seen (epoch s) not yet written
+        self.remote = {}     # uid -> {worker_id: last announced (epoch s)}
+        self.workers = {}    # other worker_id -> last sync (epoch s)
+
+        self.connects = 0
+        self.disconnects = 0
+        self.transitions = 0
+        self.heartbeats = 0
+        self.flushes = 0
+        self.flushed_users = 0
+        self.swept_sockets = 0
+        self.swept_users = 0
+        self.storage_sweeps = 0
+        self.remote_events = 0
+        self.errors = 0
+        if bus is not None:
+            bus.subscribe("presence", self._on_bus)
+
+    # -----------------------------
+    # Socket events
+    # -----------------------------
+    def connect(self, uid: str, sid: str):
+        now = time.time()
+        with self.lock:
+            socks = self.sockets.setdefault(uid, {})
+            first = not socks
+            socks[sid] = now
+            self.connects += 1
+        if first:
+            self._announce("up", uid)
+            if not self.remote.get(uid):
+                self._transition(uid, True)
+
+    def disconnect(self, uid: str, sid: str):
+        with self.lock:
+            socks = self.sockets.get(uid)
+            if not socks or sid not in socks:
+                return
+            del socks[sid]
+            last = not socks
+            if last:
+                del self.sockets[uid]
+                self.dirty.pop(uid, None)
+            self.disconnects += 1
+        if last:
+            self._gone(uid)
+
+    def heartbeat(self, uid: str, sid: str):
+        now = time.time()
+        with self.lock:
+            socks = self.sockets.get(uid)
+            known = socks is not None and sid in socks
+            if known:
+                socks[sid] = now
+                self.dirty[uid] = now
+            self.heartbeats += 1
+        if not known:
+            # swept earlier (e.g. a stalled tab) but still alive
+            self.connect(uid, sid)
+
+    def is_online(self, uid: str) -> bool:
+        """uid has a socket on this worker."""
+        return uid in self.sockets
+
+    def online_anywhere(self, uid: str) -> bool:
+        return uid in self.sockets or bool(self.remote.get(uid))
+
+    def socket_count(self) -> int:
+        with self.lock:
+            return sum(len(s) for s in self.sockets.values())
+
+    def _transition(self, uid, online):
+        self.transitions += 1
+        self.on_transition(uid, online)
+
+    def _gone(self, uid):
+        """uid's last socket on this worker went away."""
+        persist = not self.remote.get(uid)
+        self._announce("down", uid, persisted=persist)
+        if persist:
+            self._transition(uid, False)
+
+    # -----------------------------
+    # Other workers
+    # -----------------------------
+    def _announce(self, op, uid=None, **extra):
+        if self.bus is not None:
+            self.bus.publish("presence", {"op": op, "uid": uid, "worker": self.bus.worker_id, **extra})
+
+    def _remote_changed(self, uid, before):
+        after = self.online_anywhere(uid)
+        if after != before and self.on_remote is not None:
+            self.on_remote(uid, after)
+
+    def _on_bus(self, msg):
+        worker = msg.get("worker")
+        op = msg.get("op")
+        now = time.time()
+        self.remote_events += 1
+        if op == "sync":
+            held = set(msg.get("uids") or ())
+            changed = []
+            with self.lock:
+                self.workers[worker] = now
+                for uid in held:
+                    changed.append((uid, self.online_anywhere(uid)))
+                    self.remote.setdefault(uid, {})[worker] = now
+                for uid, workers in list(self.remote.items()):
+                    if worker in workers and uid not in held:
+                        changed.append((uid, True))
+                        self._drop_remote(uid, worker)
+            for uid, before in changed:
+                self._remote_changed(uid, before)
+            return
+
+        uid = msg.get("uid")
+        if not uid:
+            return
+        with self.lock:
+            before = self.online_anywhere(uid)
+            if op == "up":
+                self.remote.setdefault(uid, {})[worker] = now
+            elif op == "down":
+                self._drop_remote(uid, worker)
+        if op == "down" and msg.get("persisted") and uid in self.sockets:
+            # they wrote offline without knowing about our sockets
+            self._transition(uid, True)
+            return
+        self._remote_changed(uid, before)
+
+    def _drop_remote(self, uid, worker):
+        workers = self.remote.get(uid)
+        if workers is not None:
+            workers.pop(worker, None)
+            if not workers:
+                del self.remote[uid]
+
+    # -----------------------------
+    # Periodic work
+    # -----------------------------
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        try:
+            self.store.set_users([(uid, {"last_seen": _iso(ts)}) for uid, ts in dirty.items()])
+        except Exception:
+            with self.lock:
+                for uid, ts in dirty.items():
+                    if uid in self.sockets:
+                        self.dirty.setdefault(uid, ts)
+            raise
+        self.flushes += 1
+        self.flushed_users += len(dirty)
+
+    def sweep(self):
+        now = time.time()
+        cutoff = now - self.heartbeat_timeout
+        gone = []
+        with self.lock:
+            for uid, socks in list(self.sockets.items()):
+                for sid, seen in list(socks.items()):
+                    if seen < cutoff:
+                        del socks[sid]
+                        self.swept_sockets += 1
+                if not socks:
+                    del self.sockets[uid]
+                    self.dirty.pop(uid, None)
+                    gone.append(uid)
+        for uid in gone:
+            self.swept_users += 1
+            self._gone(uid)
+
+        # workers that stopped announcing (crashed); storage is fixed below
+        dead = []
+        with self.lock:
+            for uid, workers in list(self.remote.items()):
+                for worker, seen in list(workers.items()):
+                    if seen < cutoff:
+                        dead.append((uid, self.online_anywhere(uid)))
+                        self._drop_remote(uid, worker)
+        for uid, before in dead:
+            self._remote_changed(uid, before)
+
+        # users left online by a worker that died
+        with self.lock:
+            for worker, seen in list(self.workers.items()):
+                if seen < cutoff:
+                    del self.workers[worker]
+        if not self.is_sweeper():
+            return
+        self.storage_sweeps += 1
+        for uid, prof in self.store.online_users(seen_before=_iso(cutoff)):
+            if self.online_anywhere(uid):
+                continue
+            if _parse_iso(prof.get("last_seen")) < cutoff:
+                self.swept_users += 1
+                self._transition(uid, False)
+
+    def is_sweeper(self) -> bool:
+        """This worker sweeps storage: no live worker has a lower id."""
+        if self.bus is None:
+            return True
+        return all(self.bus.worker_id < worker for worker in list(self.workers))
+
+    def run(self, sleep):
+        """Flush/sweep loop; start with socketio.start_background_task."""
+        next_flush = time.time() + self.flush_interval
+        next_sweep = time.time() + self.sweep_interval
+        while True:
+            sleep(min(self.flush_interval, self.sweep_interval, 5.0))
+            now = time.time()
+            try:
+                if now >= next_flush:
+                    next_flush = now + self.flush_interval
+                    self.flush()
+                if now >= next_sweep:
+                    next_sweep = now + self.sweep_interval
+                    self._announce("sync", uids=list(self.sockets))
+                    self.sweep()
+            except Exception:
+                self.errors += 1  # storage hiccup; try again next round
+
+    def stats(self) -> dict:
+        return {
+            "online_users": len(self.sockets),
+            "remote_users": len(self.remote),
+            "sockets": self.socket_count(),
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "transitions": self.transitions,
+            "heartbeats": self.heartbeats,
+            "pending_last_seen": len(self.dirty),
+            "flushes": self.flushes,
+            "flushed_users": self.flushed_users,
+            "swept_sockets": self.swept_sockets,
+            "swept_users": self.swept_users,
+            "storage_sweeps": self.storage_sweeps,
+            "sweeper": int(self.is_sweeper()),
+            "remote_events": self.remote_events,
+            "errors": self.errors,
+        }
+
+
+class PresenceFanout:
+    """
+    Delivers presence changes only to sockets that asked for them.
+
+    Each socket subscribes to the uids it shows (sidebar, group members).
+    Changes are coalesced per uid and flushed every `interval` seconds as
+    one "presence_delta" frame per interested socket:
+        {"updates": [{"uid": ..., "online": ...}, ...]}
+    so a login costs one frame per watcher instead of one message to
+    every connected socket.
+    """
+
+    def __init__(self, emit, interval: float = 0.5, max_interests: int = 5000):
+        self.emit = emit  # emit(event, payload, sid)
+        self.interval = interval
+        self.max_interests = max_interests
+        self.lock = threading.Lock()
+        self.watchers = {}   # uid -> set(sid)
+        self.interests = {}  # sid -> set(uid)
+        self.pending = {}    # uid -> online (latest wins)
+
+        self.published = 0
+        self.frames = 0
+        self.updates_sent = 0
+        self.errors = 0
+
+    def subscribe(self, sid: str, uids):
+        """Replace sid's interest set."""
+        new = set(list(uids)[:self.max_interests])
+        with self.lock:
+            old = self.interests.get(sid, set())
+            for uid in old - new:
+                self._unwatch(uid, sid)
+            for uid in new - old:
+                self.watchers.setdefault(uid, set()).add(sid)
+            self.interests[sid] = new
+
+    def unsubscribe(self, sid: str):
+        with self.lock:
+            for uid in self.interests.pop(sid, ()):
+                self._unwatch(uid, sid)
+
+    def _unwatch(self, uid, sid):
+        sids = self.watchers.get(uid)
+        if sids:
+            sids.discard(sid)
+            if not sids:
+                del self.watchers[uid]
+
+    def publish(self, uid: str, online: bool):
+        with self.lock:
+            self.pending[uid] = online
+            self.published += 1
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            frames = {}
+            for uid, online in pending.items():
+                for sid in self.watchers.get(uid, ()):
+                    frames.setdefault(sid, []).append({"uid": uid, "online": online})
+        for sid, updates in frames.items():
+            self.emit("presence_delta", {"updates": updates}, sid)
+            self.frames += 1
+            self.updates_sent += len(updates)
+
+    def run(self, sleep):
+        """Flush loop; start with socketio.start_background_task."""
+        while True:
+            sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.errors += 1  # a failed emit; keep flushing later changes
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.interests),
+            "watched_users": len(self.watchers),
+            "pending": len(self.pending),
+            "published": self.published,
+            "frames": self.frames,
+            "updates_sent": self.updates_sent,
+            "errors": self.errors,
+        }
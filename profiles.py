@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ProfileCache:
+    """
+    Bounded LRU of users/{uid} documents with a TTL.
+
+    get_many() resolves every uid that is not cached with a single
+    Storage.get_users() call (Firestore get_all, chunked), so per-member
+    lookups cost one round-trip instead of one per member. Entries expire
+    after `ttl` seconds so changes made by other workers show up.
+    Missing profiles are not cached.
+    """
+
+    def __init__(self, store, max_size: int = 5000, ttl: float = 60.0):
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # uid -> (expires_at, profile)
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def _lookup(self, uid, now):
+        item = self.items.get(uid)
+        if item is None:
+            return None
+        if item[0] < now:
+            del self.items[uid]
+            return None
+        self.items.move_to_end(uid)
+        return item[1]
+
+    def _store(self, uid, profile, now):
+        self.items[uid] = (now + self.ttl, profile)
+        self.items.move_to_end(uid)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, uid: str):
+        """Profile dict, or None if users/{uid} does not exist."""
+        return self.get_many([uid]).get(uid)
+
+    def get_many(self, uids) -> dict:
+        """uid -> profile for every uid that has a profile."""
+        now = time.time()
+        out = {}
+        missing = []
+        with self.lock:
+            for uid in uids:
+                prof = self._lookup(uid, now)
+                if prof is None:
+                    missing.append(uid)
+                else:
+                    out[uid] = prof
+            self.hits += len(out)
+            self.misses += len(missing)
+
+        if missing:
+            loaded = self.store.get_users(missing)
+            self.loads += 1
+            with self.lock:
+                for uid, prof in loaded.items():
+                    self._store(uid, prof, now)
+            out.update(loaded)
+        return out
+
+    def put(self, uid: str, profile: dict):
+        with self.lock:
+            self._store(uid, profile, time.time())
+
+    def update(self, uid: str, fields: dict):
+        """Merge fields into a cached profile (no-op if not cached)."""
+        with self.lock:
+            item = self.items.get(uid)
+            if item is not None:
+                self.items[uid] = (item[0], {**item[1], **fields})
+
+    def invalidate(self, uid: str):
+        with self.lock:
+            self.items.pop(uid, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,109 @@
+"""
+Token-bucket limits on Socket.IO events, per uid and event (all of a
+user's sockets share one bucket, so opening more tabs does not raise
+the limit).
+
+Limits come per role: {role: {event: [per_second, burst]}}; a role
+missing from the table uses "default", and events without a limit are
+not counted. A check is two dict lookups and some arithmetic; buckets
+that have refilled are dropped by prune() so memory follows the users
+who were active in the last few seconds.
+
+stats() reports per event how many were allowed and refused and, to
+size limits from real traffic, the lowest fill an allowed event left
+its bucket at (0.0 = someone used the whole burst); limited_uids is
+how many users were refused anything in the last prune_interval, and
+errors how many prune rounds failed (the loop carries on).
+"""
+import time
+
+
+class RateLimiter:
+    def __init__(self, limits: dict, prune_interval: float = 60.0):
+        self.limits = {role: {event: (float(rate), float(burst)) for event, (rate, burst) in events.items()}
+                       for role, events in limits.items()}
+        # per event, the slowest rate and largest burst of any role: a
+        # bucket refilled to that is full whoever it belongs to
+        self.refill = {}
+        for events in self.limits.values():
+            for event, (rate, burst) in events.items():
+                r, b = self.refill.get(event, (rate, burst))
+                self.refill[event] = (min(r, rate), max(b, burst))
+        self.prune_interval = prune_interval
+        self.buckets = {}  # (uid, event) -> [tokens, last refill (monotonic)]
+        self.allowed = {}  # event -> count
+        self.limited = {}
+        self.min_left = {}  # event -> lowest tokens / burst after an allowed event
+        self.limited_uids = {}  # uid -> when it was last refused (monotonic)
+        self.pruned = 0
+        self.errors = 0
+
+    def _limit(self, role, event):
+        events = self.limits.get(role)
+        if events is None:
+            events = self.limits.get("default", {})
+        return events.get(event)
+
+    def check(self, uid: str, role: str, event: str) -> float:
+        """0.0 if uid may send event now (and take a token), else seconds until it may."""
+        limit = self._limit(role, event)
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        now = time.monotonic()
+        bucket = self.buckets.get((uid, event))
+        if bucket is None:
+            bucket = self.buckets[(uid, event)] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1.0:
+            self.limited[event] = self.limited.get(event, 0) + 1
+            self.limited_uids[uid] = now
+            return (1.0 - bucket[0]) / rate if rate > 0 else 60.0
+        bucket[0] -= 1.0
+        self.allowed[event] = self.allowed.get(event, 0) + 1
+        left = bucket[0] / burst
+        if left < self.min_left.get(event, 1.0):
+            self.min_left[event] = left
+        return 0.0
+
+    def prune(self):
+        """
+        Drop buckets that would be full again by now (same as not having
+        one), and forget uids not refused within the last prune_interval.
+        """
+        now = time.monotonic()
+        full = []
+        for (uid, event), (tokens, stamp) in self.buckets.items():
+            rate, burst = self.refill[event]
+            if tokens + (now - stamp) * rate >= burst:
+                full.append((uid, event))
+        for key in full:
+            del self.buckets[key]
+        self.pruned += len(full)
+        cutoff = now - self.prune_interval
+        for uid in [uid for uid, at in self.limited_uids.items() if at < cutoff]:
+            del self.limited_uids[uid]
+
+    def run(self, sleep):
+        """Prune loop; start with socketio.start_background_task."""
+        while True:
+            sleep(self.prune_interval)
+            try:
+                self.prune()
+            except Exception:
+                self.errors += 1  # e.g. buckets changed under us; prune next round
+
+    def stats(self) -> dict:
+        out = {
+            "buckets": len(self.buckets),
+            "pruned": self.pruned,
+            "limited_uids": len(self.limited_uids),
+            "errors": self.errors,
+        }
+        for event in sorted(set(self.allowed) | set(self.limited)):
+            out[f"{event}_allowed"] = self.allowed.get(event, 0)
+            out[f"{event}_limited"] = self.limited.get(event, 0)
+            out[f"{event}_min_left"] = round(self.min_left.get(event, 1.0), 3)
+        return out
@@ -0,0 +1,253 @@
+import sys
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+# bytes charged per room / per cached watermark, on top of the messages
+ROOM_OVERHEAD = 400
+WATERMARK_OVERHEAD = 120
+
+
+def message_bytes(msg: dict) -> int:
+    """Rough size of a message dict and its keys/values."""
+    n = sys.getsizeof(msg)
+    for k, v in msg.items():
+        n += sys.getsizeof(k) + sys.getsizeof(v)
+    return n
+
+
+class Room:
+    __slots__ = ("keys", "msgs", "floor", "bytes", "cleared")
+
+    def __init__(self, floor):
+        self.keys = []      # (ts, id), oldest first
+        self.msgs = []      # same order as keys
+        # every message of the thread with ts > floor is in msgs;
+        # None = the whole thread is
+        self.floor = floor
+        self.bytes = ROOM_OVERHEAD
+        self.cleared = {}   # uid -> cleared_before watermark
+
+
+class RecentMessages:
+    """
+    The newest messages of each thread, kept in memory so opening a
+    thread does not re-read its latest page from storage.
+
+    A thread's ring is started by a message sent on this worker (add())
+    or by the first history read that misses it, and holds at most
+    `per_room` messages. Messages relayed from other workers
+    (add_relayed()) only go into rings that already exist: a relay the
+    bus dropped would otherwise leave a gap in a ring claiming to be
+    complete, until the ring is evicted.
+    Each ring knows the ts above which it is complete, so a page is only
+    served from memory when no stored message can be missing from it.
+    Users' "delete chat" watermarks are cached with the ring. Whole
+    rings are evicted least recently used first once the estimated size
+    of everything cached passes `max_bytes`.
+
+    With write-behind, a message that is still queued is only in the
+    ring if the ring existed when it was sent; a ring evicted and
+    refilled inside that window can miss it until the next eviction.
+    """
+
+    def __init__(self, store, per_room: int = 200, max_bytes: int = 64 * 1024 * 1024):
+        self.store = store
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.rooms = OrderedDict()  # thread_id -> Room
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.fallbacks = 0
+        self.watermark_loads = 0
+        self.evictions = 0
+
+    # -----------------------------
+    # Internals (lock held)
+    # -----------------------------
+    def _room(self, thread_id, floor=float("inf")):
+        room = self.rooms.get(thread_id)
+        if room is None:
+            room = self.rooms[thread_id] = Room(floor)
+            self.bytes += room.bytes
+        self.rooms.move_to_end(thread_id)
+        return room
+
+    def _insert(self, room, msg):
+        key = (int(msg.get("ts") or 0), msg["id"])
+        i = bisect_left(room.keys, key)
+        if i < len(room.keys) and room.keys[i] == key:
+            return
+        room.keys.insert(i, key)
+        room.msgs.insert(i, msg)
+        size = message_bytes(msg)
+        room.bytes += size
+        self.bytes += size
+
+    def _trim(self, room):
+        while len(room.msgs) > self.per_room:
+            key = room.keys.pop(0)
+            size = message_bytes(room.msgs.pop(0))
+            room.bytes -= size
+            self.bytes -= size
+            room.floor = key[0] if room.floor is None else max(room.floor, key[0])
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self.rooms) > 1:
+            _, room = self.rooms.popitem(last=False)
+            self.bytes -= room.bytes
+            self.evictions += 1
+
+    @staticmethod
+    def _serve(room, n, before, since):
+        """Newest-first page of up to n messages, or None if the ring may be missing some."""
+        end = len(room.keys) if before is None else bisect_left(room.keys, tuple(before))
+        out = []
+        for i in range(end - 1, -1, -1):
+            if room.keys[i][0] <= since or len(out) == n:
+                break
+            out.append(room.msgs[i])
+        if room.floor is None or room.floor <= since:
+            return out
+        if len(out) == n and room.keys[end - n][0] > room.floor:
+            return out
+        return None
+
+    # -----------------------------
+    # Writes
+    # -----------------------------
+    def add(self, thread_id: str, msg: dict):
+        """msg (with its "id") was just sent on this worker; a new ring starts complete above its ts."""
+        ts = int(msg.get("ts") or 0)
+        with self.lock:
+            room = self._room(thread_id, ts)
+            if room.floor == float("inf"):
+                room.floor = ts  # only a watermark was cached so far
+            self._insert(room, msg)
+            self._trim(room)
+            self._evict()
+
+    def add_relayed(self, thread_id: str, msg: dict):
+        """msg was sent on another worker; only added to a ring this worker already started."""
+        with self.lock:
+            room = self.rooms.get(thread_id)
+            if room is None or room.floor == float("inf"):
+                return
+            self._insert(room, msg)
+            self._trim(room)
+            self._evict()
+
+    def clear(self, uid: str, thread_id: str, ts: int):
+        """Mirror of Storage.clear_thread (never moves back); only for cached rings."""
+        with self.lock:
+            room = self.rooms.get(thread_id)
+            if room is not None and uid in room.cleared:
+                room.cleared[uid] = max(room.cleared[uid], int(ts))
+
+    def drop(self, thread_id: str):
+        with self.lock:
+            room = self.rooms.pop(thread_id, None)
+            if room is not None:
+                self.bytes -= room.bytes
+
+    # -----------------------------
+    # Reads
+    # -----------------------------
+    def cleared_before(self, uid: str, thread_id: str) -> int:
+        with self.lock:
+            room = self.rooms.get(thread_id)
+            if room is not None and uid in room.cleared:
+                return room.cleared[uid]
+        ts = self.store.cleared_before(uid, thread_id)
+        self.watermark_loads += 1
+        self.prime_watermarks(uid, {thread_id: ts})
+        return ts
+
+    def prime_watermarks(self, uid: str, marks: dict):
+        """Cache uid's watermarks, thread_id -> cleared_before (0 = none)."""
+        with self.lock:
+            for thread_id, ts in marks.items():
+                room = self._room(thread_id)
+                if uid not in room.cleared:
+                    room.bytes += WATERMARK_OVERHEAD
+                    self.bytes += WATERMARK_OVERHEAD
+                room.cleared[uid] = max(room.cleared.get(uid, 0), int(ts))
+            self._evict()
+
+    def newest(self, thread_id: str):
+        """The newest cached message of thread_id, or None."""
+        with self.lock:
+            room = self.rooms.get(thread_id)
+            return room.msgs[-1] if room is not None and room.msgs else None
+
+    def version(self, thread_id: str, uid: str):
+        """
+        The thread's newest message plus uid's watermark, e.g.
+        "1700000000000.<id>.0", or None if either is not cached. It
+        changes whenever a message is sent or uid clears the chat.
+        """
+        with self.lock:
+            room = self.rooms.get(thread_id)
+            if room is None or uid not in room.cleared:
+                return None
+            if room.keys:
+                ts, msg_id = room.keys[-1]
+                return f"{ts}.{msg_id}.{room.cleared[uid]}"
+            if room.floor is None:
+                return f"0.{room.cleared[uid]}"  # no messages at all
+            return None
+
+    def list_messages(self, thread_id: str, uid: str, limit: int, before=None):
+        """
+        Storage.list_messages(thread_id, limit, before=(ts, id),
+        since=uid's watermark), from memory when the ring covers it. A miss on the
+        newest page fills the ring with the same one read it would have
+        cost; older pages that are not cached go straight to storage.
+        """
+        since = self.cleared_before(uid, thread_id)
+        with self.lock:
+            room = self.rooms.get(thread_id)
+            page = self._serve(room, limit, before, since) if room is not None else None
+            if page is not None:
+                self.rooms.move_to_end(thread_id)
+                self.hits += 1
+                return page
+            self.misses += 1
+
+        if before is None:
+            loaded = self.store.list_messages(thread_id, limit=limit)
+            self.fills += 1
+            with self.lock:
+                room = self._room(thread_id)
+                for msg in loaded:
+                    self._insert(room, msg)
+                if len(loaded) < limit:
+                    room.floor = None
+                elif room.floor is not None:
+                    room.floor = min(room.floor, int(loaded[-1].get("ts") or 0))
+                self._trim(room)
+                page = self._serve(room, limit, None, since)
+                self._evict()
+            if page is not None:
+                return page
+
+        self.fallbacks += 1
+        return self.store.list_messages(thread_id, limit=limit, before=before, since=since)
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self.rooms),
+            "messages": sum(len(r.msgs) for r in self.rooms.values()),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "per_room": self.per_room,
+            "hits": self.hits,
+            "misses": self.misses,
+            "fills": self.fills,
+            "fallbacks": self.fallbacks,
+            "watermark_loads": self.watermark_loads,
+            "evictions": self.evictions,
+        }
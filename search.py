@@ -0,0 +1,279 @@
+"""
+Local full-text index over chat messages (SQLite, on disk).
+
+    postings(thread, term, ts, doc)   one row per distinct word per message
+    docs(doc, msg_id, thread, ts, from_uid, text)
+    dm_members(uid, thread)           which DM threads a user may search
+    cleared(uid, thread, before_ts)   mirror of "delete chat" watermarks
+
+Postings are keyed thread-first, so a query only touches the threads the
+user may read, and every query word is matched as a prefix with a range
+scan on term. Messages are added in batches from a background task as
+they are sent; build it from existing data with
+
+    python search.py --rebuild [--index PATH]
+
+which scans messages and watermarks through the same ACERTAX_STORAGE
+settings as app.py. With several workers on one host, point them all at
+the same SEARCH_INDEX_PATH (WAL mode lets them share it).
+"""
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+WORD = re.compile(r"\w+", re.UNICODE)
+MAX_TERM = 40
+MAX_TERMS_PER_QUERY = 8
+MAX_THREADS_PER_QUERY = 2000
+
+
+def tokenize(text: str):
+    """Distinct lowercase words of text, in first-seen order."""
+    seen = []
+    for w in WORD.findall((text or "").lower()):
+        w = w[:MAX_TERM]
+        if w not in seen:
+            seen.append(w)
+    return seen
+
+
+class SearchIndex:
+    """
+    Inverted index with batched writes.
+
+    add() only queues; flush() (run() calls it every `interval` seconds)
+    writes everything queued in one transaction. search() sees messages
+    once they are flushed.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS docs (
+        doc INTEGER PRIMARY KEY, msg_id TEXT UNIQUE NOT NULL, thread TEXT NOT NULL,
+        ts INTEGER NOT NULL, from_uid TEXT, text TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS postings (
+        thread TEXT NOT NULL, term TEXT NOT NULL, ts INTEGER NOT NULL, doc INTEGER NOT NULL,
+        PRIMARY KEY (thread, term, ts, doc)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc, term);
+    CREATE TABLE IF NOT EXISTS dm_members (
+        uid TEXT NOT NULL, thread TEXT NOT NULL, PRIMARY KEY (uid, thread)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS cleared (
+        uid TEXT NOT NULL, thread TEXT NOT NULL, before_ts INTEGER NOT NULL,
+        PRIMARY KEY (uid, thread)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str = "search.db", interval: float = 0.5):
+        self.path = path
+        self.interval = interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.Lock()       # guards the connection
+        self.queue_lock = threading.Lock()
+        self.pending = []                  # (msg_id, msg, thread meta)
+
+        self.indexed = 0
+        self.batches = 0
+        self.flush_ms = 0.0
+        self.searches = 0
+        self.search_ms_total = 0.0
+        self.search_ms_max = 0.0
+
+    # -----------------------------
+    # Writing
+    # -----------------------------
+    def add(self, msg_id: str, msg: dict, thread: dict):
+        with self.queue_lock:
+            self.pending.append((msg_id, msg, thread))
+
+    def flush(self):
+        with self.queue_lock:
+            items, self.pending = self.pending, []
+        if items:
+            self.add_many(items)
+
+    def add_many(self, items):
+        """Index (msg_id, msg, thread meta) items now, in one transaction."""
+        t0 = time.perf_counter()
+        with self.lock, self.conn:
+            for msg_id, msg, thread in items:
+                tid = msg.get("thread")
+                ts = int(msg.get("ts") or 0)
+                text = msg.get("text") or ""
+                cur = self.conn.execute(
+                    "INSERT OR IGNORE INTO docs (msg_id, thread, ts, from_uid, text) VALUES (?, ?, ?, ?, ?)",
+                    (msg_id, tid, ts, msg.get("from_uid"), text),
+                )
+                if not cur.rowcount:
+                    continue  # already indexed
+                doc = cur.lastrowid
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO postings (thread, term, ts, doc) VALUES (?, ?, ?, ?)",
+                    [(tid, term, ts, doc) for term in tokenize(text)],
+                )
+                if thread.get("type") == "dm":
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO dm_members (uid, thread) VALUES (?, ?)",
+                        [(m, tid) for m in thread.get("members", [])],
+                    )
+        self.indexed += len(items)
+        self.batches += 1
+        self.flush_ms = (time.perf_counter() - t0) * 1000.0
+
+    def clear(self, uid: str, thread_id: str, ts: int):
+        """Mirror of Storage.clear_thread (never moves back)."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO cleared (uid, thread, before_ts) VALUES (?, ?, ?) "
+                "ON CONFLICT (uid, thread) DO UPDATE SET before_ts = MAX(before_ts, excluded.before_ts)",
+                (uid, thread_id, int(ts)),
+            )
+
+    def drop_thread(self, thread_id: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM postings WHERE thread = ?", (thread_id,))
+            self.conn.execute("DELETE FROM docs WHERE thread = ?", (thread_id,))
+            self.conn.execute("DELETE FROM dm_members WHERE thread = ?", (thread_id,))
+            self.conn.execute("DELETE FROM cleared WHERE thread = ?", (thread_id,))
+
+    def run(self, sleep):
+        """Flush loop; start with socketio.start_background_task."""
+        while True:
+            sleep(self.interval)
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass  # items are lost from the index only; --rebuild restores them
+
+    # -----------------------------
+    # Reading
+    # -----------------------------
+    def search(self, uid: str, query: str, group_threads=(), limit: int = 20, before=None):
+        """
+        Newest-first messages uid may read (their DMs plus group_threads)
+        in which every query word appears as a word prefix, skipping what
+        uid cleared. before=(ts, doc) continues from an earlier page.
+        Returns (hits, next cursor or None).
+        """
+        terms = tokenize(query)[:MAX_TERMS_PER_QUERY]
+        if not terms:
+            return [], None
+        t0 = time.perf_counter()
+        with self.lock:
+            threads = [r[0] for r in self.conn.execute("SELECT thread FROM dm_members WHERE uid = ?", (uid,))]
+            threads += list(group_threads)
+            threads = threads[:MAX_THREADS_PER_QUERY]
+            if not threads:
+                return [], None
+            cleared = dict(self.conn.execute("SELECT thread, before_ts FROM cleared WHERE uid = ?", (uid,)))
+            allowed = [(t, cleared.get(t, 0)) for t in threads]
+
+            # rarest-looking (longest) word drives the scan, the rest are
+            # checked per candidate
+            terms.sort(key=len, reverse=True)
+            sql = [
+                "WITH allowed(thread, since) AS (VALUES " + ",".join(["(?, ?)"] * len(allowed)) + ")",
+                "SELECT DISTINCT p.doc, p.ts FROM allowed a JOIN postings p",
+                " ON p.thread = a.thread AND p.term >= ? AND p.term < ? AND p.ts > a.since",
+            ]
+            args = [x for pair in allowed for x in pair] + [terms[0], terms[0] + "\U0010ffff"]
+            if before is not None:
+                sql.append(" AND (p.ts < ? OR (p.ts = ? AND p.doc < ?))")
+                args += [before[0], before[0], before[1]]
+            for term in terms[1:]:
+                sql.append(" AND EXISTS (SELECT 1 FROM postings q WHERE q.doc = p.doc"
+                           " AND q.term >= ? AND q.term < ?)")
+                args += [term, term + "\U0010ffff"]
+            sql.append(" ORDER BY p.ts DESC, p.doc DESC LIMIT ?")
+            args.append(limit + 1)
+            rows = self.conn.execute("".join(sql), args).fetchall()
+
+            page = rows[:limit]
+            hits = []
+            if page:
+                marks = ",".join("?" * len(page))
+                docs = {r[0]: r for r in self.conn.execute(
+                    f"SELECT doc, msg_id, thread, ts, from_uid, text FROM docs WHERE doc IN ({marks})",
+                    [doc for doc, _ in page])}
+                for doc, _ in page:
+                    _, msg_id, thread, ts, from_uid, text = docs[doc]
+                    hits.append({"id": msg_id, "thread": thread, "ts": ts, "from_uid": from_uid, "text": text})
+
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.searches += 1
+        self.search_ms_total += ms
+        self.search_ms_max = max(self.search_ms_max, ms)
+        cursor = (page[-1][1], page[-1][0]) if len(rows) > limit else None
+        return hits, cursor
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "indexed": self.indexed,
+            "batches": self.batches,
+            "last_flush_ms": round(self.flush_ms, 2),
+            "searches": self.searches,
+            "search_ms_avg": round(self.search_ms_total / self.searches, 2) if self.searches else 0.0,
+            "search_ms_max": round(self.search_ms_max, 2),
+        }
+
+
+# -----------------------------
+# Rebuild from storage
+# -----------------------------
+def rebuild(store, index: SearchIndex, page_size: int = 2000, log=sys.stderr):
+    """Index every stored message and copy every watermark."""
+    last_id = None
+    total = 0
+    t0 = time.time()
+    while True:
+        page = store.scan_messages(start_after=last_id, limit=page_size)
+        if not page:
+            break
+        items = []
+        for msg_id, d in page:
+            tid = d.get("thread")
+            if not tid:
+                continue  # not migrated to v2 yet
+            thread = {"type": "dm", "members": tid[3:].split("_")} if tid.startswith("dm_") else {"type": "group"}
+            items.append((msg_id, d, thread))
+        index.add_many(items)
+        last_id = page[-1][0]
+        total += len(page)
+        print(f"scanned={total} rate={total / max(time.time() - t0, 1e-6):.0f} docs/s", file=log, flush=True)
+
+    marks = 0
+    for uid, thread_id, ts in store.iter_cleared():
+        index.clear(uid, thread_id, ts)
+        marks += 1
+    return total, marks
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--index", default=os.environ.get("SEARCH_INDEX_PATH", "search.db"))
+    p.add_argument("--rebuild", action="store_true", help="index all stored messages and watermarks")
+    p.add_argument("--page", type=int, default=2000)
+    args = p.parse_args()
+    if not args.rebuild:
+        p.print_help()
+        return
+
+    from migrate_messages import firestore_client
+    from storage import storage_from_env
+
+    store = storage_from_env(firestore_client)
+    total, marks = rebuild(store, SearchIndex(args.index), page_size=args.page)
+    print(f"done: messages={total} watermarks={marks}")
+
+
+if __name__ == "__main__":
+    main()
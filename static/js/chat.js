@@ -89,6 +89,11 @@ const typingPeers = new Map(); // chatKey -> Set(uid)
 const OPEN = new Map();
 // message cache: key -> array of messages
 const CACHE = new Map();
+// history paging: key -> {before, hasMore, loading}; before is the server's
+// opaque "ts:id" cursor, passed back as-is
+const PAGES = new Map();
+// sidebar previews: thread_id -> {from_uid, text, ts} of the newest message
+const PREVIEWS = new Map();
 
 function escapeHtml(s) {
   return (s || "").replace(/[&<>"']/g, c => ({
@@ -161,6 +166,18 @@ function userDisplay(u) {
 function dmKey(other_uid){ return `dm:${other_uid}`; }
 function groupKey(group_id){ return `group:${group_id}`; }
 
+// Messages carry only a thread key: "dm_<a>_<b>" (sorted uids) or "group_<id>"
+function parseThread(thread) {
+  thread = thread || "";
+  if (thread.startsWith("group_")) return { type: "group", group_id: thread.slice(6) };
+  if (!thread.startsWith("dm_")) return null;
+  const my = window.ACERTAX_USER.uid;
+  const pair = thread.slice(3);
+  if (pair.startsWith(`${my}_`)) return { type: "dm", other_uid: pair.slice(my.length + 1) };
+  if (pair.endsWith(`_${my}`)) return { type: "dm", other_uid: pair.slice(0, -(my.length + 1)) };
+  return null;
+}
+
 // -----------------------------
 // Unread persistence helpers
 // -----------------------------
@@ -185,35 +202,30 @@ async function markReadForKey(key) {
   });
 }
 
-async function loadUnread() {
-  const res = await fetch("/api/unread");
-  const j = await res.json();
-  const items = j.items || [];
+// items: [thread_id, count] pairs
+function applyUnread(items) {
+  for (const [thread_id, count] of items) {
+    if (!count || count <= 0) continue;
 
-  for (const it of items) {
-    const count = it.count || 0;
-    if (count <= 0) continue;
-
-    let key = null;
-    if (it.type === "dm" && it.other_uid) key = dmKey(it.other_uid);
-    if (it.type === "group" && it.group_id) key = groupKey(it.group_id);
-    if (!key) continue;
+    const t = parseThread(thread_id);
+    if (!t) continue;
+    const key = t.type === "dm" ? dmKey(t.other_uid) : groupKey(t.group_id);
 
     if (!OPEN.has(key)) {
-      if (it.type === "dm") {
-        const u = USERS.find(x => x.uid === it.other_uid);
+      if (t.type === "dm") {
+        const u = USERS.find(x => x.uid === t.other_uid);
         OPEN.set(key, {
           type: "dm",
-          other_uid: it.other_uid,
+          other_uid: t.other_uid,
           label: userDisplay(u || {display_name:"DM"}),
           unread: count,
           messagesLoaded: false
         });
       } else {
-        const g = GROUPS.find(x => x.group_id === it.group_id);
+        const g = GROUPS.find(x => x.group_id === t.group_id);
         OPEN.set(key, {
           type: "group",
-          group_id: it.group_id,
+          group_id: t.group_id,
           label: g?.name || "Group",
           unread: count,
           messagesLoaded: false
@@ -225,10 +237,6 @@ async function loadUnread() {
       OPEN.set(key, info);
     }
   }
-
-  renderTabs();
-  renderUsers();
-  renderGroups();
 }
 
 function markActiveLeft() {
@@ -265,14 +273,6 @@ function updateTypingLine() {
     `${names[0]} and others are typing…`;
 }
 
-function setPeerTyping(chatKey, uid, isTyping) {
-  let set = typingPeers.get(chatKey);
-  if (!set) { set = new Set(); typingPeers.set(chatKey, set); }
-  if (isTyping) set.add(uid);
-  else set.delete(uid);
-  updateTypingLine();
-}
-
 function keyRoomForCurrent() {
   const info = currentChatKey ? OPEN.get(currentChatKey) : null;
   if (!info) return null;
@@ -305,6 +305,7 @@ function renderTabs() {
       if (e.target && e.target.classList.contains("x")) {
         OPEN.delete(key);
         CACHE.delete(key);
+        PAGES.delete(key);
         clearTypingUIForChat(key);
 
         if (currentChatKey === key) {
@@ -424,6 +425,7 @@ async function switchToChat(key) {
       // close this chat and refresh
       OPEN.delete(key);
       CACHE.delete(key);
+      PAGES.delete(key);
       clearTypingUIForChat(key);
 
       if (currentChatKey === key) {
@@ -449,14 +451,50 @@ async function loadHistoryDM(other_uid) {
   const res = await fetch(`/api/history/dm/${other_uid}`);
   const j = await res.json();
   CACHE.set(dmKey(other_uid), j.messages || []);
+  PAGES.set(dmKey(other_uid), { before: j.before, hasMore: !!j.has_more, loading: false });
 }
 
 async function loadHistoryGroup(group_id) {
   const res = await fetch(`/api/history/group/${group_id}`);
   const j = await res.json();
   CACHE.set(groupKey(group_id), j.messages || []);
+  PAGES.set(groupKey(group_id), { before: j.before, hasMore: !!j.has_more, loading: false });
 }
 
+// Older pages are fetched when the user scrolls to the top of the thread
+async function loadOlder(key) {
+  const page = PAGES.get(key);
+  const info = OPEN.get(key);
+  if (!page || !info || !page.hasMore || page.loading) return;
+
+  const url = info.type === "dm"
+    ? `/api/history/dm/${info.other_uid}`
+    : `/api/history/group/${info.group_id}`;
+
+  page.loading = true;
+  try {
+    const res = await fetch(`${url}?before=${encodeURIComponent(page.before)}`);
+    const j = await res.json();
+    if (!j.ok) return;
+    CACHE.set(key, (j.messages || []).concat(CACHE.get(key) || []));
+    page.before = j.before;
+    page.hasMore = !!j.has_more;
+
+    if (key === currentChatKey) {
+      // keep the viewport where it was
+      const fromBottom = chatBodyEl.scrollHeight - chatBodyEl.scrollTop;
+      renderFromCache(key);
+      chatBodyEl.scrollTop = chatBodyEl.scrollHeight - fromBottom;
+    }
+  } finally {
+    page.loading = false;
+  }
+}
+
+chatBodyEl.addEventListener("scroll", () => {
+  if (currentChatKey && chatBodyEl.scrollTop < 40) loadOlder(currentChatKey);
+});
+
 async function ensureSocket() {
   const user = firebase.auth().currentUser;
   if (!user) throw new Error("Not signed in.");
@@ -465,61 +503,47 @@ async function ensureSocket() {
 
   socket = io({ transports: ["websocket"], query: { token } });
 
-  socket.on("presence_update", (p) => {
-    const u = USERS.find(x => x.uid === p.uid);
-    if (u) {
-      u.online = !!p.online;
-      renderUsers(); // update dots
-    }
-  });
+  // keeps our presence alive; the server sweeps sockets that go quiet
+  setInterval(() => { if (socket.connected) socket.emit("heartbeat"); }, 25000);
 
-  // Typing updates
-  socket.on("typing_update", (p) => {
-    let key = null;
-
-    if (p.type === "dm") {
-      const my = window.ACERTAX_USER.uid;
-      const other = (p.from_uid === my) ? null : p.from_uid;
-      if (other) key = dmKey(other);
-    } else if (p.type === "group") {
-      key = groupKey(p.group_id);
-    }
+  // (re)subscribe on every connect; the server forgets us on disconnect
+  socket.on("connect", subscribePresence);
 
-    if (!key) return;
+  socket.on("presence_delta", (p) => {
+    applyPresence(p.updates || []);
+  });
 
-    setPeerTyping(key, p.from_uid, !!p.is_typing);
+  // Typing updates: the full list of typers in a room, sent when it changes
+  socket.on("typing_update", (p) => {
+    const t = parseThread(p.room);
+    if (!t) return;
+    const key = t.type === "dm" ? dmKey(t.other_uid) : groupKey(t.group_id);
 
-    // safety auto-clear
-    if (p.is_typing) {
-      setTimeout(() => setPeerTyping(key, p.from_uid, false), 3500);
-    }
+    const my = window.ACERTAX_USER.uid;
+    typingPeers.set(key, new Set((p.uids || []).filter(uid => uid !== my)));
+    updateTypingLine();
   });
 
   socket.on("new_message", (msg) => {
     // Determine which chat key it belongs to
-    let key = null;
-    if (msg.type === "dm") {
-      const my = window.ACERTAX_USER.uid;
-      const other = (msg.from_uid === my) ? msg.to_uid : msg.from_uid;
-      key = dmKey(other);
-    } else if (msg.type === "group") {
-      key = groupKey(msg.group_id);
-    }
-    if (!key) return;
+    const t = parseThread(msg.thread);
+    if (!t) return;
+    const key = t.type === "dm" ? dmKey(t.other_uid) : groupKey(t.group_id);
 
     // cache it
     const arr = CACHE.get(key) || [];
     arr.push(msg);
     CACHE.set(key, arr);
+    PREVIEWS.set(msg.thread, { from_uid: msg.from_uid, text: msg.text, ts: msg.ts });
 
     // if chat not open, open it in background (tabs)
     if (!OPEN.has(key)) {
-      if (msg.type === "dm") {
-        const u = USERS.find(x => x.uid === ((msg.from_uid === window.ACERTAX_USER.uid) ? msg.to_uid : msg.from_uid));
-        OPEN.set(key, { type:"dm", other_uid: (u?.uid || ""), label: userDisplay(u || {display_name:"DM"}), unread:0, messagesLoaded:true });
+      if (t.type === "dm") {
+        const u = USERS.find(x => x.uid === t.other_uid);
+        OPEN.set(key, { type:"dm", other_uid: t.other_uid, label: userDisplay(u || {display_name:"DM"}), unread:0, messagesLoaded:true });
       } else {
-        const g = GROUPS.find(x => x.group_id === msg.group_id);
-        OPEN.set(key, { type:"group", group_id: msg.group_id, label: g?.name || "Group", unread:0, messagesLoaded:true });
+        const g = GROUPS.find(x => x.group_id === t.group_id);
+        OPEN.set(key, { type:"group", group_id: t.group_id, label: g?.name || "Group", unread:0, messagesLoaded:true });
       }
       renderTabs();
       renderUsers();
@@ -535,26 +559,83 @@ async function ensureSocket() {
       return;
     }
 
-    // otherwise unread + toast + desktop notify
+    // otherwise toast + desktop notify (the count comes via unread_delta)
     if (!isMine) {
-      info.unread = (info.unread || 0) + 1;
-      OPEN.set(key, info);
-      renderTabs();
-      renderUsers();
-      renderGroups();
-
       toast(info.label, msg.text);
       maybeDesktopNotify(info.label, msg.text);
     }
   });
+
+  // Unread counts pushed to all our tabs: {thread_id, delta} or {thread_id, count}
+  socket.on("unread_delta", (p) => {
+    const t = parseThread(p.thread_id);
+    if (!t) return;
+    const key = t.type === "dm" ? dmKey(t.other_uid) : groupKey(t.group_id);
+
+    // reading it right now: tell the server so other tabs clear too
+    if (key === currentChatKey) {
+      if (p.delta) markReadForKey(key).catch(() => {});
+      return;
+    }
+
+    if (!OPEN.has(key)) {
+      if (!p.delta) return;
+      if (t.type === "dm") {
+        const u = USERS.find(x => x.uid === t.other_uid);
+        OPEN.set(key, { type:"dm", other_uid: t.other_uid, label: userDisplay(u || {display_name:"DM"}), unread:0, messagesLoaded:false });
+      } else {
+        const g = GROUPS.find(x => x.group_id === t.group_id);
+        OPEN.set(key, { type:"group", group_id: t.group_id, label: g?.name || "Group", unread:0, messagesLoaded:false });
+      }
+    }
+
+    const info = OPEN.get(key);
+    info.unread = ("count" in p) ? p.count : (info.unread || 0) + (p.delta || 0);
+    OPEN.set(key, info);
+    renderTabs();
+    renderUsers();
+    renderGroups();
+  });
+}
+
+// -----------------------------
+// Presence: we only get updates for uids we subscribe to
+// -----------------------------
+function subscribePresence() {
+  if (!socket || !socket.connected) return;
+  const uids = new Set(USERS.map(u => u.uid));
+  GROUPS.forEach(g => (g.members || []).forEach(m => uids.add(m)));
+  socket.emit("presence_subscribe", { uids: Array.from(uids) }, (ack) => {
+    if (!ack || !ack.ok) return;
+    applyPresence(Object.entries(ack.online || {}).map(([uid, online]) => ({ uid, online })));
+  });
+}
+
+function applyPresence(updates) {
+  let changed = false;
+  for (const p of updates) {
+    const u = USERS.find(x => x.uid === p.uid);
+    if (u && u.online !== !!p.online) {
+      u.online = !!p.online;
+      changed = true;
+    }
+  }
+  if (changed) renderUsers(); // update dots
 }
 
-async function loadUsers() {
-  const res = await fetch("/api/users");
+// Users, groups, unread counts and previews in one round-trip
+async function loadBootstrap() {
+  const res = await fetch("/api/bootstrap");
   const j = await res.json();
   USERS = j.users || [];
+  GROUPS = j.groups || [];
+  for (const [tid, p] of Object.entries(j.previews || {})) PREVIEWS.set(tid, p);
+  applyUnread(Object.entries(j.unread || {}));
+  renderTabs();
   renderUsers();
+  renderGroups();
   renderGroupMemberChecklist();
+  subscribePresence();
 }
 
 async function loadGroups() {
@@ -562,6 +643,7 @@ async function loadGroups() {
   const j = await res.json();
   GROUPS = j.groups || [];
   renderGroups();
+  subscribePresence();
 }
 
 function renderUsers() {
@@ -575,12 +657,14 @@ function renderUsers() {
       item.dataset.key = key;
 
       const unread = (OPEN.get(key)?.unread) || 0;
+      const ids = [window.ACERTAX_USER.uid, u.uid].sort();
+      const preview = PREVIEWS.get(`dm_${ids[0]}_${ids[1]}`);
 
       item.innerHTML = `
         <div class="presence ${u.online ? "on" : "off"}"></div>
         <div class="li-main">
           <div class="li-title">${escapeHtml(userDisplay(u))}</div>
-          <div class="li-sub muted">${escapeHtml(u.email || "")}</div>
+          <div class="li-sub muted">${escapeHtml(preview ? preview.text : (u.email || ""))}</div>
         </div>
         ${unread ? `<div class="unread-badge">${unread}</div>` : ``}
       `;
@@ -609,12 +693,13 @@ function renderGroups() {
     item.dataset.key = key;
 
     const unread = (OPEN.get(key)?.unread) || 0;
+    const preview = PREVIEWS.get(`group_${g.group_id}`);
 
     item.innerHTML = `
       <div class="group-badge">#</div>
       <div class="li-main">
         <div class="li-title">${escapeHtml(g.name)}</div>
-        <div class="li-sub muted">${g.members.length} members</div>
+        <div class="li-sub muted">${preview ? escapeHtml(preview.text) : `${g.members.length} members`}</div>
       </div>
       ${unread ? `<div class="unread-badge">${unread}</div>` : ``}
     `;
@@ -643,10 +728,20 @@ document.getElementById("sendBtn").addEventListener("click", async () => {
   const info = OPEN.get(currentChatKey);
   if (!info) return;
 
+  // the ack says when the server refused the message (rate limit, overloaded storage)
+  const onAck = (ack) => {
+    if (!ack || ack.ok !== false) return;
+    if (!msgInputEl.value) msgInputEl.value = text;
+    const wait = Math.ceil((ack.retry_after_ms || 1000) / 1000);
+    toast("Message not sent",
+      ack.error === "rate_limited" ? `You're sending messages too fast; try again in ${wait}s.`
+      : ack.error === "storage_timeout" ? "The server is slow; check the chat before sending it again."
+      : "The server is busy; try again in a moment.");
+  };
   if (info.type === "dm") {
-    socket.emit("send_dm", { to_uid: info.other_uid, text });
+    socket.emit("send_dm", { to_uid: info.other_uid, text }, onAck);
   } else {
-    socket.emit("send_group", { group_id: info.group_id, text });
+    socket.emit("send_group", { group_id: info.group_id, text }, onAck);
   }
 
   // stop typing on send
@@ -704,6 +799,7 @@ deleteChatBtn.addEventListener("click", async () => {
 
   // clear local UI/cache for this chat
   CACHE.set(currentChatKey, []);
+  PAGES.delete(currentChatKey);
   renderFromCache(currentChatKey);
 });
 
@@ -786,9 +882,7 @@ if (closeGroupInfo) {
 async function boot() {
   setLoggedInAs();
   await ensureNotificationPermission();
-  await loadUsers();
-  await loadGroups();
-  await loadUnread(); // ✅ load persisted unread counts
+  await loadBootstrap();
   await ensureSocket();
   updateTypingLine();
   hide(groupInfoBtn);
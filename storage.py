@@ -0,0 +1,663 @@
+import json
+import os
+import sqlite3
+import uuid
+
+from eventlet.patcher import original
+from google.api_core.exceptions import InvalidArgument
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from message_schema import preview
+
+# Calls can run on eventlet's OS thread pool (storage_executor.py). In a
+# monkey-patched process threading's locks are green and deadlock when
+# shared between OS threads, so the backends use the real ones.
+threading = original("threading")
+
+
+# -----------------------------
+# Storage interface
+# -----------------------------
+class Storage:
+    """
+    Everything app.py reads or writes goes through one of these methods,
+    so the Firestore client can be swapped for a local backend
+    (benchmarks, load tests, CI boxes with no network).
+
+    Documents are plain dicts. Methods that return several documents
+    return (doc_id, dict) pairs unless noted otherwise.
+    """
+
+    # Exceptions meaning the call itself is bad (its data, not the
+    # backend), so retrying it cannot help; write_behind.py drops those.
+    PERMANENT_ERRORS = (ValueError, TypeError)
+
+    # users
+    def get_user(self, uid: str):
+        raise NotImplementedError
+
+    def get_users(self, uids) -> dict:
+        """uid -> profile for the uids that exist, in as few round-trips as possible."""
+        raise NotImplementedError
+
+    def set_user(self, uid: str, fields: dict):
+        """Merge `fields` into users/{uid}, creating it if needed."""
+        raise NotImplementedError
+
+    def update_user(self, uid: str, fields: dict):
+        """Update an existing users/{uid}."""
+        raise NotImplementedError
+
+    def set_users(self, items):
+        """Batched set_user: items is a list of (uid, fields)."""
+        raise NotImplementedError
+
+    def online_users(self, seen_before: str = None):
+        """
+        [(uid, profile)] for every user whose profile says online; with
+        seen_before (an ISO-8601 UTC timestamp, as last_seen is written)
+        only those whose last_seen is older than that.
+        """
+        raise NotImplementedError
+
+    # Reads of several docs return lists, not generators, so the whole
+    # read is one call the storage executor can bound (storage_executor.py)
+    def iter_users(self):
+        """[(uid, profile)] for every user."""
+        raise NotImplementedError
+
+    # groups
+    def get_group(self, group_id: str):
+        raise NotImplementedError
+
+    def create_group(self, data: dict) -> str:
+        raise NotImplementedError
+
+    def delete_group(self, group_id: str):
+        raise NotImplementedError
+
+    def groups_for_member(self, uid: str):
+        """[(group_id, group)] for every group uid is a member of."""
+        raise NotImplementedError
+
+    def iter_groups(self):
+        """[(group_id, group)] for every group."""
+        raise NotImplementedError
+
+    def watch_groups(self, callback):
+        """
+        Call callback([(group_id, dict or None), ...]) whenever groups are
+        created, changed or deleted (None = deleted). Returns a handle with
+        an unsubscribe() method.
+        """
+        raise NotImplementedError
+
+    # messages
+    def new_message_id(self) -> str:
+        """Allocate a message id without touching the network."""
+        raise NotImplementedError
+
+    def add_message(self, msg: dict, thread_id: str, thread: dict, msg_id: str = None) -> str:
+        """
+        Store msg and bump threads/{thread_id} in the same write:
+        seq += 1, sent[from_uid] += 1, last = preview(msg). `thread` holds
+        the thread's static fields (type, plus members for DMs or group_id
+        for groups).
+        One write no matter how many people are in the thread.
+        """
+        msg_id = msg_id or self.new_message_id()
+        self.add_messages([(msg_id, msg, thread_id, thread)])
+        return msg_id
+
+    def add_messages(self, items):
+        """
+        items: list of (msg_id, msg, thread_id, thread). Written as one
+        batch; rewriting an item with the same msg_id overwrites the message.
+        """
+        raise NotImplementedError
+
+    def list_messages(self, thread_id: str, limit: int = 200, before=None, after=None, since=None):
+        """
+        Messages of a thread, as dicts with an "id" key, keyset-paginated
+        on (ts, id) so messages sharing a millisecond are not skipped at a
+        page boundary:
+          - neither cursor: the newest `limit`, newest first
+          - before=(ts, id): the newest `limit` older than that, newest first
+          - after=(ts, id): the oldest `limit` newer than that, oldest first
+        since=ts additionally drops everything at or before ts (a user's
+        cleared_before watermark), as part of the query.
+        """
+        raise NotImplementedError
+
+    def scan_messages(self, start_after: str = None, limit: int = 500):
+        """(msg_id, dict) pairs ordered by id, for bulk jobs (migrations)."""
+        raise NotImplementedError
+
+    def put_messages(self, items):
+        """Replace whole message docs: items is a list of (msg_id, dict)."""
+        raise NotImplementedError
+
+    # threads / unread watermarks
+    def mark_read(self, uid: str, thread_id: str):
+        """Advance uid's read watermark for thread_id to the thread's current seq."""
+        raise NotImplementedError
+
+    def unread_counts(self, uid: str, thread_ids=()):
+        """
+        (thread_id, thread dict, unread count) for every DM thread uid is in,
+        plus the explicitly listed thread_ids (group threads).
+        """
+        raise NotImplementedError
+
+    def delete_thread(self, thread_id: str):
+        raise NotImplementedError
+
+    # "delete chat" watermarks
+    def clear_thread(self, uid: str, thread_id: str, ts: int):
+        """
+        Hide every message of thread_id with ts <= `ts` from uid: one write,
+        however long the thread is. Never moves an existing watermark back.
+        """
+        raise NotImplementedError
+
+    def cleared_before(self, uid: str, thread_id: str) -> int:
+        """uid's cleared_before watermark for thread_id (epoch ms), 0 if none."""
+        raise NotImplementedError
+
+    def cleared_map(self, uid: str) -> dict:
+        """thread_id -> cleared_before for every watermark uid has, in one query."""
+        raise NotImplementedError
+
+    def iter_cleared(self):
+        """(uid, thread_id, before_ts) for every watermark, for bulk jobs."""
+        raise NotImplementedError
+
+
+def unread_count(thread: dict, read: dict, uid: str) -> int:
+    """
+    Messages from other people since uid's watermark:
+      (seq - read.seq) - (sent[uid] - read.sent)
+    """
+    seq = int(thread.get("seq") or 0)
+    sent = int((thread.get("sent") or {}).get(uid) or 0)
+    n = (seq - int(read.get("seq") or 0)) - (sent - int(read.get("sent") or 0))
+    return max(n, 0)
+
+
+# -----------------------------
+# Firestore backend
+# -----------------------------
+class FirestoreStorage(Storage):
+    """
+    client is a firestore.Client, or a callable returning one. A callable
+    is only called on first use, and again in a forked child: gRPC
+    channels must not cross a fork.
+    """
+
+    # e.g. a message doc over the 1 MiB document limit
+    PERMANENT_ERRORS = Storage.PERMANENT_ERRORS + (InvalidArgument,)
+
+    def __init__(self, client):
+        self.client_factory = client if callable(client) else None
+        self._db = None if callable(client) else client
+        self._pid = os.getpid()
+        self._db_lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self.client_factory is not None and (self._db is None or self._pid != os.getpid()):
+            with self._db_lock:
+                if self._db is None or self._pid != os.getpid():
+                    self._db = self.client_factory()
+                    self._pid = os.getpid()
+        return self._db
+
+    def get_user(self, uid):
+        doc = self.db.collection("users").document(uid).get()
+        return (doc.to_dict() or {}) if doc.exists else None
+
+    # get_all() is chunked to keep each request a reasonable size
+    GET_ALL_CHUNK = 100
+
+    def get_users(self, uids):
+        uids = list(dict.fromkeys(uids))
+        out = {}
+        for i in range(0, len(uids), self.GET_ALL_CHUNK):
+            refs = [self.db.collection("users").document(uid) for uid in uids[i:i + self.GET_ALL_CHUNK]]
+            for doc in self.db.get_all(refs):
+                if doc.exists:
+                    out[doc.id] = doc.to_dict() or {}
+        return out
+
+    def set_user(self, uid, fields):
+        self.db.collection("users").document(uid).set(fields, merge=True)
+
+    def update_user(self, uid, fields):
+        self.db.collection("users").document(uid).update(fields)
+
+    def set_users(self, items):
+        for i in range(0, len(items), 2 * self.MAX_BATCH):
+            batch = self.db.batch()
+            for uid, fields in items[i:i + 2 * self.MAX_BATCH]:
+                batch.set(self.db.collection("users").document(uid), fields, merge=True)
+            batch.commit()
+
+    def online_users(self, seen_before=None):
+        # seen_before needs the (online, last_seen) index in firestore.indexes.json
+        q = self.db.collection("users").where(filter=FieldFilter("online", "==", True))
+        if seen_before is not None:
+            q = q.where(filter=FieldFilter("last_seen", "<", seen_before))
+        return [(doc.id, doc.to_dict() or {}) for doc in q.stream()]
+
+    def iter_users(self):
+        return [(doc.id, doc.to_dict() or {}) for doc in self.db.collection("users").stream()]
+
+    def get_group(self, group_id):
+        doc = self.db.collection("groups").document(group_id).get()
+        return (doc.to_dict() or {}) if doc.exists else None
+
+    def create_group(self, data):
+        doc_ref = self.db.collection("groups").document()
+        doc_ref.set(data)
+        return doc_ref.id
+
+    def delete_group(self, group_id):
+        self.db.collection("groups").document(group_id).delete()
+
+    def groups_for_member(self, uid):
+        q = self.db.collection("groups").where(filter=FieldFilter("members", "array_contains", uid))
+        return [(doc.id, doc.to_dict() or {}) for doc in q.stream()]
+
+    def iter_groups(self):
+        return [(doc.id, doc.to_dict() or {}) for doc in self.db.collection("groups").stream()]
+
+    def watch_groups(self, callback):
+        def on_snapshot(col_snapshot, changes, read_time):
+            callback([
+                (c.document.id, None if c.type.name == "REMOVED" else (c.document.to_dict() or {}))
+                for c in changes
+            ])
+        return self.db.collection("groups").on_snapshot(on_snapshot)
+
+    # Firestore allows 500 writes per batch; each message is two
+    MAX_BATCH = 250
+
+    def new_message_id(self):
+        return self.db.collection("messages").document().id
+
+    def add_messages(self, items):
+        from firebase_admin import firestore
+
+        for i in range(0, len(items), self.MAX_BATCH):
+            batch = self.db.batch()
+            for msg_id, msg, thread_id, thread in items[i:i + self.MAX_BATCH]:
+                batch.set(self.db.collection("messages").document(msg_id), msg)
+                batch.set(self.db.collection("threads").document(thread_id), {
+                    **thread,
+                    "seq": firestore.Increment(1),
+                    "sent": {msg["from_uid"]: firestore.Increment(1)},
+                    "last_ts": msg["ts"],
+                    "last": preview(msg_id, msg),
+                }, merge=True)
+            batch.commit()
+
+    def list_messages(self, thread_id, limit=200, before=None, after=None, since=None):
+        from firebase_admin import firestore
+
+        # Needs the composite indexes in firestore.indexes.json (they end
+        # in __name__ implicitly); `since` is on the same field as the
+        # cursors, so this stays one range query
+        q = self.db.collection("messages").where(filter=FieldFilter("thread", "==", thread_id))
+        if since:
+            q = q.where(filter=FieldFilter("ts", ">", since))
+        direction = firestore.Query.ASCENDING if after is not None else firestore.Query.DESCENDING
+        q = q.order_by("ts", direction=direction).order_by("__name__", direction=direction)
+        cursor = after if after is not None else before
+        if cursor is not None:
+            q = q.start_after({"ts": cursor[0], "__name__": cursor[1]})
+        q = q.limit(limit)
+        out = []
+        for doc in q.stream():
+            d = doc.to_dict() or {}
+            d["id"] = doc.id
+            out.append(d)
+        return out
+
+    def scan_messages(self, start_after=None, limit=500):
+        q = self.db.collection("messages").order_by("__name__")
+        if start_after:
+            q = q.start_after({"__name__": start_after})
+        return [(doc.id, doc.to_dict() or {}) for doc in q.limit(limit).stream()]
+
+    def put_messages(self, items):
+        for i in range(0, len(items), 2 * self.MAX_BATCH):
+            batch = self.db.batch()
+            for msg_id, d in items[i:i + 2 * self.MAX_BATCH]:
+                batch.set(self.db.collection("messages").document(msg_id), d)
+            batch.commit()
+
+    def _read_ref(self, uid, thread_id):
+        return self.db.collection("users").document(uid).collection("reads").document(thread_id)
+
+    def mark_read(self, uid, thread_id):
+        t = self.db.collection("threads").document(thread_id).get().to_dict() or {}
+        self._read_ref(uid, thread_id).set({
+            "seq": int(t.get("seq") or 0),
+            "sent": int((t.get("sent") or {}).get(uid) or 0),
+        })
+
+    def unread_counts(self, uid, thread_ids=()):
+        threads = {}
+        q = self.db.collection("threads").where(filter=FieldFilter("members", "array_contains", uid))
+        for doc in q.stream():
+            threads[doc.id] = doc.to_dict() or {}
+        refs = [self.db.collection("threads").document(tid) for tid in thread_ids]
+        if refs:
+            for doc in self.db.get_all(refs):
+                if doc.exists:
+                    threads[doc.id] = doc.to_dict() or {}
+
+        reads = {}
+        for doc in self.db.collection("users").document(uid).collection("reads").stream():
+            reads[doc.id] = doc.to_dict() or {}
+
+        return [(tid, t, unread_count(t, reads.get(tid, {}), uid)) for tid, t in threads.items()]
+
+    def delete_thread(self, thread_id):
+        self.db.collection("threads").document(thread_id).delete()
+
+    def _cleared_ref(self, uid, thread_id):
+        return self.db.collection("users").document(uid).collection("cleared").document(thread_id)
+
+    def clear_thread(self, uid, thread_id, ts):
+        ref = self._cleared_ref(uid, thread_id)
+        cur = ref.get()
+        if cur.exists and int((cur.to_dict() or {}).get("before_ts") or 0) >= ts:
+            return
+        ref.set({"before_ts": int(ts)})
+
+    def cleared_before(self, uid, thread_id):
+        doc = self._cleared_ref(uid, thread_id).get()
+        return int((doc.to_dict() or {}).get("before_ts") or 0) if doc.exists else 0
+
+    def cleared_map(self, uid):
+        return {
+            doc.id: int((doc.to_dict() or {}).get("before_ts") or 0)
+            for doc in self.db.collection("users").document(uid).collection("cleared").stream()
+        }
+
+    def iter_cleared(self):
+        for doc in self.db.collection_group("cleared").stream():
+            uid = doc.reference.parent.parent.id
+            yield uid, doc.id, int((doc.to_dict() or {}).get("before_ts") or 0)
+
+
+# -----------------------------
+# Local (SQLite) backend
+# -----------------------------
+def _new_id() -> str:
+    # Same length as Firestore auto ids
+    return uuid.uuid4().hex[:20]
+
+
+class _Watch:
+    def __init__(self, watchers, callback):
+        self.watchers = watchers
+        self.callback = callback
+        watchers.append(callback)
+
+    def unsubscribe(self):
+        if self.callback in self.watchers:
+            self.watchers.remove(self.callback)
+
+
+class LocalStorage(Storage):
+    """
+    In-process SQLite backend. path=":memory:" (the default) keeps
+    everything in RAM; pass a file path to keep data between runs.
+    Documents are stored as JSON; only the fields we query on get columns.
+    """
+
+    PERMANENT_ERRORS = Storage.PERMANENT_ERRORS + (sqlite3.IntegrityError, sqlite3.DataError)
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS groups (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS group_members (group_id TEXT NOT NULL, uid TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS group_members_uid ON group_members (uid);
+    CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, thread TEXT, ts, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS messages_thread_ts ON messages (thread, ts);
+    CREATE TABLE IF NOT EXISTS threads (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS thread_members (thread_id TEXT NOT NULL, uid TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS thread_members_uid ON thread_members (uid);
+    CREATE TABLE IF NOT EXISTS reads (
+        uid TEXT NOT NULL, thread_id TEXT NOT NULL, seq INTEGER NOT NULL, sent INTEGER NOT NULL,
+        PRIMARY KEY (uid, thread_id)
+    );
+    CREATE TABLE IF NOT EXISTS cleared (
+        uid TEXT NOT NULL, thread_id TEXT NOT NULL, before_ts INTEGER NOT NULL,
+        PRIMARY KEY (uid, thread_id)
+    );
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self.lock = threading.RLock()
+        self.group_watchers = []
+
+    def _one(self, sql, args):
+        with self.lock:
+            row = self.conn.execute(sql, args).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _all(self, sql, args=()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def _write(self, sql, args):
+        with self.lock, self.conn:
+            self.conn.execute(sql, args)
+
+    def _notify_groups(self, changes):
+        for callback in list(self.group_watchers):
+            callback(changes)
+
+    def get_user(self, uid):
+        return self._one("SELECT data FROM users WHERE uid = ?", (uid,))
+
+    def get_users(self, uids):
+        uids = list(dict.fromkeys(uids))
+        out = {}
+        # stay under SQLite's bound-parameter limit
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i + 500]
+            rows = self._all(f"SELECT uid, data FROM users WHERE uid IN ({','.join('?' * len(chunk))})", chunk)
+            for uid, data in rows:
+                out[uid] = json.loads(data)
+        return out
+
+    def set_user(self, uid, fields):
+        with self.lock:
+            d = self.get_user(uid) or {}
+            d.update(fields)
+            self._write("INSERT OR REPLACE INTO users (uid, data) VALUES (?, ?)", (uid, json.dumps(d)))
+
+    def update_user(self, uid, fields):
+        with self.lock:
+            if self.get_user(uid) is None:
+                raise KeyError(f"users/{uid} does not exist")
+            self.set_user(uid, fields)
+
+    def set_users(self, items):
+        with self.lock, self.conn:
+            for uid, fields in items:
+                self.set_user(uid, fields)
+
+    def online_users(self, seen_before=None):
+        sql = "SELECT uid, data FROM users WHERE json_extract(data, '$.online') = 1"
+        args = ()
+        if seen_before is not None:
+            sql += " AND json_extract(data, '$.last_seen') < ?"
+            args = (seen_before,)
+        return [(uid, json.loads(data)) for uid, data in self._all(sql, args)]
+
+    def iter_users(self):
+        return [(uid, json.loads(data)) for uid, data in self._all("SELECT uid, data FROM users")]
+
+    def get_group(self, group_id):
+        return self._one("SELECT data FROM groups WHERE id = ?", (group_id,))
+
+    def create_group(self, data):
+        group_id = _new_id()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO groups (id, data) VALUES (?, ?)", (group_id, json.dumps(data)))
+            self.conn.executemany(
+                "INSERT INTO group_members (group_id, uid) VALUES (?, ?)",
+                [(group_id, m) for m in data.get("members", [])],
+            )
+        self._notify_groups([(group_id, dict(data))])
+        return group_id
+
+    def delete_group(self, group_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM groups WHERE id = ?", (group_id,))
+            self.conn.execute("DELETE FROM group_members WHERE group_id = ?", (group_id,))
+        self._notify_groups([(group_id, None)])
+
+    def groups_for_member(self, uid):
+        rows = self._all(
+            "SELECT g.id, g.data FROM groups g JOIN group_members m ON m.group_id = g.id WHERE m.uid = ?",
+            (uid,),
+        )
+        return [(group_id, json.loads(data)) for group_id, data in rows]
+
+    def iter_groups(self):
+        return [(group_id, json.loads(data)) for group_id, data in self._all("SELECT id, data FROM groups")]
+
+    def watch_groups(self, callback):
+        return _Watch(self.group_watchers, callback)
+
+    def new_message_id(self):
+        return _new_id()
+
+    def _put_message(self, msg_id, msg):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO messages (id, thread, ts, data) VALUES (?, ?, ?, ?)",
+            (msg_id, msg.get("thread"), msg.get("ts"), json.dumps(msg)),
+        )
+
+    def add_messages(self, items):
+        with self.lock, self.conn:
+            for msg_id, msg, thread_id, thread in items:
+                self._put_message(msg_id, msg)
+                t = self._one("SELECT data FROM threads WHERE id = ?", (thread_id,))
+                if t is None:
+                    t = {"seq": 0, "sent": {}}
+                    self.conn.executemany(
+                        "INSERT INTO thread_members (thread_id, uid) VALUES (?, ?)",
+                        [(thread_id, m) for m in thread.get("members", [])],
+                    )
+                t.update(thread)
+                t["seq"] += 1
+                t["sent"][msg["from_uid"]] = t["sent"].get(msg["from_uid"], 0) + 1
+                t["last_ts"] = msg["ts"]
+                t["last"] = preview(msg_id, msg)
+                self.conn.execute("INSERT OR REPLACE INTO threads (id, data) VALUES (?, ?)", (thread_id, json.dumps(t)))
+
+    def list_messages(self, thread_id, limit=200, before=None, after=None, since=None):
+        sql = "SELECT id, data FROM messages WHERE thread = ?"
+        args = [thread_id]
+        if since:
+            sql += " AND ts > ?"
+            args.append(since)
+        if after is not None:
+            sql += " AND (ts > ? OR (ts = ? AND id > ?)) ORDER BY ts ASC, id ASC"
+            args += [after[0], after[0], after[1]]
+        else:
+            if before is not None:
+                sql += " AND (ts < ? OR (ts = ? AND id < ?))"
+                args += [before[0], before[0], before[1]]
+            sql += " ORDER BY ts DESC, id DESC"
+        out = []
+        for msg_id, data in self._all(sql + " LIMIT ?", args + [limit]):
+            d = json.loads(data)
+            d["id"] = msg_id
+            out.append(d)
+        return out
+
+    def scan_messages(self, start_after=None, limit=500):
+        rows = self._all(
+            "SELECT id, data FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+            (start_after or "", limit),
+        )
+        return [(msg_id, json.loads(data)) for msg_id, data in rows]
+
+    def put_messages(self, items):
+        with self.lock, self.conn:
+            for msg_id, d in items:
+                self._put_message(msg_id, d)
+
+    def mark_read(self, uid, thread_id):
+        with self.lock:
+            t = self._one("SELECT data FROM threads WHERE id = ?", (thread_id,)) or {}
+            self._write(
+                "INSERT OR REPLACE INTO reads (uid, thread_id, seq, sent) VALUES (?, ?, ?, ?)",
+                (uid, thread_id, int(t.get("seq") or 0), int((t.get("sent") or {}).get(uid) or 0)),
+            )
+
+    def unread_counts(self, uid, thread_ids=()):
+        threads = {}
+        rows = self._all(
+            "SELECT t.id, t.data FROM threads t JOIN thread_members m ON m.thread_id = t.id WHERE m.uid = ?",
+            (uid,),
+        )
+        for thread_id in thread_ids:
+            rows += self._all("SELECT id, data FROM threads WHERE id = ?", (thread_id,))
+        for thread_id, data in rows:
+            threads[thread_id] = json.loads(data)
+
+        reads = {}
+        for thread_id, seq, sent in self._all("SELECT thread_id, seq, sent FROM reads WHERE uid = ?", (uid,)):
+            reads[thread_id] = {"seq": seq, "sent": sent}
+
+        return [(tid, t, unread_count(t, reads.get(tid, {}), uid)) for tid, t in threads.items()]
+
+    def delete_thread(self, thread_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM threads WHERE id = ?", (thread_id,))
+            self.conn.execute("DELETE FROM thread_members WHERE thread_id = ?", (thread_id,))
+
+    def clear_thread(self, uid, thread_id, ts):
+        self._write(
+            "INSERT INTO cleared (uid, thread_id, before_ts) VALUES (?, ?, ?) "
+            "ON CONFLICT (uid, thread_id) DO UPDATE SET before_ts = MAX(before_ts, excluded.before_ts)",
+            (uid, thread_id, int(ts)),
+        )
+
+    def cleared_before(self, uid, thread_id):
+        row = self._all("SELECT before_ts FROM cleared WHERE uid = ? AND thread_id = ?", (uid, thread_id))
+        return row[0][0] if row else 0
+
+    def cleared_map(self, uid):
+        return dict(self._all("SELECT thread_id, before_ts FROM cleared WHERE uid = ?", (uid,)))
+
+    def iter_cleared(self):
+        return iter(self._all("SELECT uid, thread_id, before_ts FROM cleared"))
+
+
+# -----------------------------
+# Factory
+# -----------------------------
+def storage_from_env(firestore_client_factory=None) -> Storage:
+    """
+    ACERTAX_STORAGE=firestore (default) or local.
+    ACERTAX_LOCAL_DB picks the SQLite file for the local backend.
+    The Firestore client is created on first use, not here.
+    """
+    backend = os.environ.get("ACERTAX_STORAGE", "firestore").lower()
+    if backend == "local":
+        return LocalStorage(os.environ.get("ACERTAX_LOCAL_DB", ":memory:"))
+    if backend == "firestore":
+        return FirestoreStorage(firestore_client_factory)
+    raise ValueError(f"Unknown ACERTAX_STORAGE backend: {backend!r}")
@@ -0,0 +1,278 @@
+"""
+Bounded execution of Storage calls (STORAGE_EXECUTOR in app.py).
+
+A Firestore RPC made inline blocks the eventlet hub and every other
+socket with it: gRPC is not green, whether or not the process is
+monkey-patched (app.py is not; gunicorn's eventlet worker is).
+StorageExecutor wraps the store the way storage_trace.TracingStorage
+does and, for calls made on the hub's OS thread (any greenlet):
+
+  - runs them on eventlet's OS thread pool, at most `max_concurrency`
+    at a time; the calling greenlet waits without blocking the hub
+  - queues up to `max_queue` more and refuses the rest (StorageBusy)
+  - gives each call a deadline covering its queue wait and the call
+    itself: read ops `read_timeout`, writes `write_timeout`, unless
+    `timeouts` names the op (StorageTimeout)
+  - fails fast while the circuit breaker is open (CircuitOpen)
+
+Calls from other OS threads (the write-behind flusher, run_concurrently
+on the thread pool) are made inline; they pass the breaker and feed it
+but are not counted against the concurrency limit. Reads of many docs
+return lists, so they are bounded like any other call; only the bulk
+scans of offline jobs (STREAMS) pass through untouched.
+
+A call that timed out keeps its pool slot until the RPC really returns,
+so a slow backend cannot pile up more than max_concurrency RPCs. It may
+still complete: a StorageTimeout on a write means "unknown", not "not
+written".
+"""
+import time
+from collections import deque
+
+import eventlet
+from eventlet import patcher, tpool
+from eventlet.semaphore import Semaphore
+
+from storage_trace import OPS
+
+# bulk scans of offline jobs (migrate_messages, search reindex), which
+# run off the hub and page through storage themselves
+STREAMS = frozenset(("scan_messages", "iter_cleared"))
+
+# whole-collection reads (directory refresh, group index warm-up) may
+# take longer than a page read; STORAGE_TIMEOUTS can still override
+SCAN_TIMEOUTS = {"iter_users": 60.0, "iter_groups": 60.0}
+
+
+class StorageOverloaded(RuntimeError):
+    """The call was refused or abandoned; try again after `retry_after` seconds."""
+    code = "storage_overloaded"
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class StorageBusy(StorageOverloaded):
+    code = "storage_busy"
+
+
+class StorageTimeout(StorageOverloaded):
+    code = "storage_timeout"
+
+
+class CircuitOpen(StorageOverloaded):
+    code = "storage_unavailable"
+
+
+class CircuitBreaker:
+    """
+    Trips when at least `ratio` of the last `window` calls were slow
+    (over `slow_ms`) or failed. While open every call fails fast; after
+    `cooldown` seconds one probe call is let through, and its outcome
+    closes the breaker again or re-opens it for another cooldown.
+    """
+
+    def __init__(self, slow_ms: float = 1000.0, window: int = 20, ratio: float = 0.5, cooldown: float = 5.0):
+        self.slow_ms = slow_ms
+        self.window = window
+        self.ratio = ratio
+        self.cooldown = cooldown
+        self.lock = patcher.original("threading").Lock()
+        self.outcomes = deque(maxlen=window)  # True = slow or failed
+        self.bad = 0
+        self.state = "closed"
+        self.open_until = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() >= self.open_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def refusing(self) -> bool:
+        """allow() would say no right now; claims nothing."""
+        with self.lock:
+            if self.state == "open":
+                return time.monotonic() < self.open_until
+            return self.state == "half_open" and self.probing
+
+    def retry_after(self) -> float:
+        return max(0.1, self.open_until - time.monotonic())
+
+    def record(self, ms: float, ok: bool):
+        bad = not ok or ms > self.slow_ms
+        with self.lock:
+            if self.state == "half_open":
+                if bad:
+                    self._open()
+                else:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                    self.bad = 0
+                self.probing = False
+                return
+            if len(self.outcomes) == self.window:
+                self.bad -= self.outcomes[0]
+            self.outcomes.append(bad)
+            self.bad += bad
+            if self.state == "closed" and len(self.outcomes) == self.window and self.bad >= self.ratio * self.window:
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.open_until = time.monotonic() + self.cooldown
+        self.outcomes.clear()
+        self.bad = 0
+        self.trips += 1
+
+
+class StorageExecutor:
+    def __init__(self, max_concurrency: int = 16, max_queue: int = 256, read_timeout: float = 5.0,
+                 write_timeout: float = 10.0, timeouts=None, breaker: CircuitBreaker = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.timeouts = {**SCAN_TIMEOUTS, **(timeouts or {})}
+        self.breaker = breaker or CircuitBreaker()
+        self.slots = Semaphore(max_concurrency)
+        # OS thread ident of the hub (the executor is built on it). Under
+        # monkey-patching current_thread() names green threads, so compare
+        # real OS thread idents instead.
+        self.get_ident = patcher.original("threading").get_ident
+        self.hub_ident = self.get_ident()
+        self.in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.calls = 0
+        self.inline = 0
+        self.errors = 0
+        self.busy = 0
+        self.timed_out = 0
+        self.failed_fast = 0
+        self.ms_total = 0.0
+
+    def wrap(self, store):
+        return ExecutorStorage(store, self)
+
+    def timeout_for(self, op: str) -> float:
+        if op in self.timeouts:
+            return self.timeouts[op]
+        return self.read_timeout if OPS[op][2] == 0 else self.write_timeout
+
+    def call(self, op: str, fn, args, kwargs):
+        if self.get_ident() != self.hub_ident:
+            self._allow(op)
+            self.inline += 1
+            return self._timed(fn, args, kwargs)
+
+        # fail fast without queueing, but only claim the half-open probe
+        # once the call has a slot: a probe refused as busy would never
+        # be recorded and would leave the breaker half open for good
+        if self.breaker.refusing():
+            self._refuse(op)
+
+        deadline = time.monotonic() + self.timeout_for(op)
+        if self.queued >= self.max_queue:
+            self.busy += 1
+            raise StorageBusy(f"storage queue full ({op})")
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            got = self.slots.acquire(timeout=max(0.0, deadline - time.monotonic()))
+        finally:
+            self.queued -= 1
+        if not got:
+            self.busy += 1
+            raise StorageBusy(f"no storage slot within the {op} timeout")
+        try:
+            self._allow(op)
+        except CircuitOpen:
+            self.slots.release()
+            raise
+
+        self.in_flight += 1
+        gt = eventlet.spawn(self._run, fn, args, kwargs)
+        try:
+            with eventlet.Timeout(max(0.0, deadline - time.monotonic())):
+                return gt.wait()
+        except eventlet.Timeout:
+            self.timed_out += 1
+            raise StorageTimeout(f"storage {op} timed out") from None
+
+    def _allow(self, op):
+        if not self.breaker.allow():
+            self._refuse(op)
+
+    def _refuse(self, op):
+        self.failed_fast += 1
+        raise CircuitOpen(f"storage circuit open ({op})", self.breaker.retry_after())
+
+    def _run(self, fn, args, kwargs):
+        # owns the slot until the call returns, whether or not anyone still waits
+        try:
+            return tpool.execute(self._timed, fn, args, kwargs)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    def _timed(self, fn, args, kwargs):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            ms = (time.perf_counter() - t0) * 1000.0
+            self.calls += 1
+            self.errors += not ok
+            self.ms_total += ms
+            self.breaker.record(ms, ok)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "max_queue": self.max_queue,
+            "calls": self.calls,
+            "inline": self.inline,
+            "errors": self.errors,
+            "busy": self.busy,
+            "timed_out": self.timed_out,
+            "failed_fast": self.failed_fast,
+            "ms_avg": round(self.ms_total / self.calls, 3) if self.calls else 0.0,
+            "breaker_state": self.breaker.state,
+            "breaker_open": int(self.breaker.state != "closed"),
+            "breaker_trips": self.breaker.trips,
+        }
+
+
+class ExecutorStorage:
+    """Storage proxy sending each non-generator op through a StorageExecutor."""
+
+    def __init__(self, inner, executor: StorageExecutor):
+        self.inner = inner
+        for op in OPS:
+            if op not in STREAMS:
+                setattr(self, op, self._bounded(op, getattr(inner, op), executor))
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    @staticmethod
+    def _bounded(op, fn, executor):
+        def call(*args, **kwargs):
+            return executor.call(op, fn, args, kwargs)
+        call.__name__ = op
+        return call
@@ -0,0 +1,188 @@
+"""
+Opt-in tracing of Storage calls per HTTP request / Socket.IO event
+(STORAGE_TRACE=1 in app.py), for catching handlers whose number of
+round-trips grows with the data (N+1 lookups).
+
+Every call made while a trace is active is recorded as (operation,
+collection, ms, docs read, docs written); doc counts follow Firestore
+billing closely enough to compare runs (a get is one read whether or
+not the doc exists, a message write also bumps its thread). Each
+handler can have a budget of calls; in strict mode the call that goes
+over it raises StorageBudgetExceeded, so the traceback points at the
+loop that issues it.
+
+Calls made outside a trace (background tasks, other greenlets) are not
+recorded; with tracing off the store is not wrapped at all.
+"""
+import contextvars
+import time
+from collections import Counter
+
+# op -> (collection, docs read, docs written). "result" = documents
+# returned, "arg" = items passed in, "2arg" = two per item.
+OPS = {
+    "get_user": ("users", 1, 0),
+    "get_users": ("users", "arg", 0),
+    "set_user": ("users", 0, 1),
+    "update_user": ("users", 0, 1),
+    "set_users": ("users", 0, "arg"),
+    "online_users": ("users", "result", 0),
+    "iter_users": ("users", "result", 0),
+    "get_group": ("groups", 1, 0),
+    "create_group": ("groups", 0, 1),
+    "delete_group": ("groups", 0, 1),
+    "groups_for_member": ("groups", "result", 0),
+    "iter_groups": ("groups", "result", 0),
+    "add_message": ("messages", 0, 2),
+    "add_messages": ("messages", 0, "2arg"),
+    "list_messages": ("messages", "result", 0),
+    "scan_messages": ("messages", "result", 0),
+    "put_messages": ("messages", 0, "arg"),
+    "mark_read": ("reads", 1, 1),
+    "unread_counts": ("threads", "result", 0),
+    "delete_thread": ("threads", 0, 1),
+    "clear_thread": ("cleared", 1, 1),
+    "cleared_before": ("cleared", 1, 0),
+    "cleared_map": ("cleared", "result", 0),
+    "iter_cleared": ("cleared", "result", 0),
+}
+
+_current = contextvars.ContextVar("storage_trace", default=None)
+
+
+class StorageBudgetExceeded(RuntimeError):
+    pass
+
+
+def _docs(spec, args, n_result):
+    if spec == "result":
+        return n_result
+    if spec in ("arg", "2arg"):
+        n = len(args[0]) if args and hasattr(args[0], "__len__") else 0
+        return 2 * n if spec == "2arg" else n
+    return spec
+
+
+class Trace:
+    """The storage calls of one request or socket event."""
+
+    def __init__(self, name: str, budget=None, strict: bool = False):
+        self.name = name
+        self.budget = budget
+        self.strict = strict
+        self.calls = []  # (op, collection, ms, reads, writes)
+        self.refused = False
+
+    def record(self, op, collection, ms, reads, writes):
+        self.calls.append((op, collection, ms, reads, writes))
+
+    def check(self, op):
+        """Called before each call: strict mode refuses the one over budget."""
+        if self.strict and self.budget is not None and len(self.calls) >= self.budget:
+            self.refused = True
+            raise StorageBudgetExceeded(
+                f"{self.name}: storage call #{len(self.calls) + 1} ({op}) exceeds budget of {self.budget}")
+
+    @property
+    def over_budget(self) -> bool:
+        return self.refused or (self.budget is not None and len(self.calls) > self.budget)
+
+    def summary(self) -> str:
+        """e.g. 'calls=3 reads=41 writes=1 ms=6.2 ops=get_users*1,list_messages*1,mark_read*1'"""
+        reads = sum(c[3] for c in self.calls)
+        writes = sum(c[4] for c in self.calls)
+        ms = sum(c[2] for c in self.calls)
+        ops = Counter(c[0] for c in self.calls)
+        parts = [f"calls={len(self.calls)}", f"reads={reads}", f"writes={writes}", f"ms={ms:.1f}"]
+        if self.budget is not None:
+            parts.append(f"budget={self.budget}")
+        if ops:
+            parts.append("ops=" + ",".join(f"{op}*{n}" for op, n in sorted(ops.items())))
+        return " ".join(parts)
+
+
+class StorageTracer:
+    """
+    Starts/ends traces and keeps per-handler totals. budgets maps a
+    handler name (Flask endpoint or Socket.IO event) to the most storage
+    calls it may make.
+    """
+
+    def __init__(self, budgets=None, strict: bool = False):
+        self.budgets = dict(budgets or {})
+        self.strict = strict
+        self.handlers = {}  # name -> [traces, calls, max calls, reads, writes, over budget]
+
+    def wrap(self, store):
+        return TracingStorage(store)
+
+    def begin(self, name: str):
+        trace = Trace(name, self.budgets.get(name), self.strict)
+        return trace, _current.set(trace)
+
+    def end(self, trace: Trace, token) -> Trace:
+        _current.reset(token)
+        n = len(trace.calls)
+        h = self.handlers.get(trace.name)
+        if h is None:
+            h = self.handlers[trace.name] = [0, 0, 0, 0, 0, 0]
+        h[0] += 1
+        h[1] += n
+        h[2] = max(h[2], n)
+        h[3] += sum(c[3] for c in trace.calls)
+        h[4] += sum(c[4] for c in trace.calls)
+        h[5] += trace.over_budget
+        return trace
+
+    def stats(self) -> dict:
+        return {
+            "handlers": {
+                name: {"traces": h[0], "calls": h[1], "max_calls": h[2], "reads": h[3], "writes": h[4],
+                       "over_budget": h[5], "budget": self.budgets.get(name)}
+                for name, h in sorted(self.handlers.items())
+            },
+            "over_budget": sum(h[5] for h in self.handlers.values()),
+        }
+
+
+class TracingStorage:
+    """
+    Storage proxy that records each public call into the active Trace.
+    Generator results are recorded when they are exhausted or closed.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        for op, (collection, reads, writes) in OPS.items():
+            setattr(self, op, self._traced(op, collection, reads, writes, getattr(inner, op)))
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def _traced(self, op, collection, read_spec, write_spec, fn):
+        def call(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return fn(*args, **kwargs)
+            trace.check(op)
+            t0 = time.perf_counter()
+            result = fn(*args, **kwargs)
+            if hasattr(result, "__next__"):
+                return self._traced_iter(trace, op, collection, read_spec, write_spec, args, result, t0)
+            n = len(result) if isinstance(result, (list, dict)) and read_spec == "result" else 0
+            trace.record(op, collection, (time.perf_counter() - t0) * 1000.0,
+                         _docs(read_spec, args, n), _docs(write_spec, args, n))
+            return result
+        call.__name__ = op
+        return call
+
+    @staticmethod
+    def _traced_iter(trace, op, collection, read_spec, write_spec, args, it, t0):
+        n = 0
+        try:
+            for item in it:
+                n += 1
+                yield item
+        finally:
+            trace.record(op, collection, (time.perf_counter() - t0) * 1000.0,
+                         _docs(read_spec, args, n), _docs(write_spec, args, n))
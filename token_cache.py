@@ -0,0 +1,120 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    """
+    Bounded LRU of verified Firebase ID tokens.
+
+    Keyed by sha256(token) so raw tokens are never held as dict keys.
+    An entry is served until the token's own `exp` (minus `leeway`
+    seconds), so a reconnect storm with still-valid tokens costs one
+    dictionary lookup per socket instead of an RS256 verification.
+    Failed verifications are not cached.
+
+    Signature checks need Google's public keys; fetch_keys (if given) is
+    called by run() every `key_refresh_interval` seconds so the keys are
+    already in the HTTP cache when they rotate, instead of being fetched
+    on the request path.
+    """
+
+    def __init__(self, verify, fetch_keys=None, max_size: int = 10000,
+                 leeway: float = 30.0, key_refresh_interval: float = 3600.0):
+        self.verify = verify  # verify(token) -> decoded claims, raises if invalid
+        self.fetch_keys = fetch_keys
+        self.max_size = max_size
+        self.leeway = leeway
+        self.key_refresh_interval = key_refresh_interval
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # sha256 hex -> (exp, decoded)
+
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.expired = 0
+        self.evictions = 0
+        self.verify_ms_total = 0.0
+        self.verify_ms_max = 0.0
+        self.key_fetches = 0
+        self.key_fetch_errors = 0
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str):
+        """Decoded claims for a valid token, or None."""
+        if not token:
+            return None
+        key = self._key(token)
+        now = time.time()
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self.items[key]
+                self.expired += 1
+            self.misses += 1
+
+        t0 = time.perf_counter()
+        try:
+            decoded = self.verify(token)
+        except Exception:
+            decoded = None
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.verify_ms_total += ms
+        self.verify_ms_max = max(self.verify_ms_max, ms)
+        if not decoded:
+            self.failures += 1
+            return None
+
+        exp = float(decoded.get("exp") or 0) - self.leeway
+        if exp > now:
+            with self.lock:
+                self.items[key] = (exp, decoded)
+                self.items.move_to_end(key)
+                while len(self.items) > self.max_size:
+                    self.items.popitem(last=False)
+                    self.evictions += 1
+        return decoded
+
+    def invalidate(self, token: str):
+        with self.lock:
+            self.items.pop(self._key(token), None)
+
+    def refresh_keys(self):
+        if self.fetch_keys is None:
+            return
+        try:
+            self.fetch_keys()
+            self.key_fetches += 1
+        except Exception:
+            self.key_fetch_errors += 1
+
+    def run(self, sleep):
+        """Key refresh loop; start with socketio.start_background_task."""
+        while True:
+            self.refresh_keys()
+            sleep(self.key_refresh_interval)
+
+    def stats(self) -> dict:
+        verified = self.misses - self.failures
+        return {
+            "size": len(self.items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "verify_ms_avg": round(self.verify_ms_total / self.misses, 2) if self.misses else 0.0,
+            "verify_ms_max": round(self.verify_ms_max, 2),
+            "verified": verified,
+            "key_fetches": self.key_fetches,
+            "key_fetch_errors": self.key_fetch_errors,
+        }
@@ -0,0 +1,131 @@
+import threading
+import time
+
+
+class TypingState:
+    """
+    Who is typing where, kept in memory and broadcast in batches.
+
+    typing_dm/typing_group events only update a per-room {uid: expires_at}
+    map. Every `interval` seconds flush() sends one
+        "typing_update" {"room", "type", "group_id"?, "uids": [...]}
+    frame to each room whose set of typers changed (started, stopped or
+    expired), so a burst of keystroke toggles from many users becomes one
+    frame per room per interval. A typer that stops sending refreshes is
+    dropped after `ttl` seconds; refreshes from a user who is already
+    typing in the room are ignored for `throttle` seconds.
+
+    With several workers, pass the bus: updates that get past the
+    throttle are published, so every worker holds the same sets and
+    emits the frame to its own sockets only (emit must not go through
+    the message queue, or each frame is delivered once per worker).
+    """
+
+    def __init__(self, emit, interval: float = 0.3, ttl: float = 5.0, throttle: float = 1.0, bus=None):
+        self.emit = emit  # emit(event, payload, room)
+        self.interval = interval
+        self.ttl = ttl
+        self.throttle = throttle
+        self.bus = bus
+        self.lock = threading.Lock()
+        self.rooms = {}   # room -> {uid: [expires_at, last refresh]}
+        self.meta = {}    # room -> {"type": ..., "group_id": ...}
+        self.dirty = set()
+
+        self.events = 0
+        self.throttled = 0
+        self.expired = 0
+        self.frames = 0
+        self.errors = 0
+        if bus is not None:
+            bus.subscribe("typing", self._on_bus)
+
+    def set(self, room: str, uid: str, is_typing: bool, meta: dict):
+        if self._apply(room, uid, is_typing, meta, throttle=True) and self.bus is not None:
+            self.bus.publish("typing", {"room": room, "uid": uid, "is_typing": is_typing, "meta": meta})
+
+    def _apply(self, room, uid, is_typing, meta, throttle):
+        """False if nothing changed (throttled refresh, or a stop for a non-typer)."""
+        now = time.time()
+        with self.lock:
+            self.events += 1
+            typers = self.rooms.get(room)
+            cur = typers.get(uid) if typers else None
+            if is_typing:
+                if cur is not None:
+                    if throttle and now - cur[1] < self.throttle:
+                        self.throttled += 1
+                        return False
+                    cur[0] = now + self.ttl
+                    cur[1] = now
+                    return True
+                if typers is None:
+                    typers = self.rooms[room] = {}
+                typers[uid] = [now + self.ttl, now]
+                self.meta[room] = meta
+                self.dirty.add(room)
+                return True
+            if cur is not None:
+                del typers[uid]
+                self.dirty.add(room)
+                return True
+            return False
+
+    def _on_bus(self, msg):
+        if msg.get("drop"):
+            self._drop(msg["drop"])
+        elif msg.get("room") and msg.get("uid"):
+            self._apply(msg["room"], msg["uid"], bool(msg.get("is_typing")), msg.get("meta") or {}, throttle=False)
+
+    def drop(self, uid: str):
+        """Stop uid typing everywhere (their last socket went away)."""
+        self._drop(uid)
+        if self.bus is not None:
+            self.bus.publish("typing", {"drop": uid})
+
+    def _drop(self, uid):
+        with self.lock:
+            for room, typers in self.rooms.items():
+                if typers.pop(uid, None) is not None:
+                    self.dirty.add(room)
+
+    def flush(self):
+        now = time.time()
+        frames = []
+        with self.lock:
+            for room, typers in self.rooms.items():
+                for uid, (expires_at, _) in list(typers.items()):
+                    if expires_at < now:
+                        del typers[uid]
+                        self.expired += 1
+                        self.dirty.add(room)
+            for room in self.dirty:
+                typers = self.rooms.get(room, {})
+                frames.append((room, {**self.meta.get(room, {}), "room": room, "uids": sorted(typers)}))
+                if not typers:
+                    self.rooms.pop(room, None)
+                    self.meta.pop(room, None)
+            self.dirty = set()
+        for room, payload in frames:
+            self.emit("typing_update", payload, room)
+            self.frames += 1
+
+    def run(self, sleep):
+        """Flush loop; start with socketio.start_background_task."""
+        while True:
+            sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.errors += 1  # a failed emit; keep flushing later changes
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self.rooms),
+            "typers": sum(len(t) for t in self.rooms.values()),
+            "events": self.events,
+            "throttled": self.throttled,
+            "expired": self.expired,
+            "frames": self.frames,
+            "errors": self.errors,
+        }
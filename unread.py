@@ -0,0 +1,185 @@
+import threading
+import time
+from collections import OrderedDict
+
+from message_schema import to_ms
+
+
+class UnreadCache:
+    """
+    Per-user unread counts kept in memory.
+
+    A user's counts are loaded with one Storage.unread_counts() call the
+    first time they are needed and then maintained from the write path:
+    incr() when a message is delivered, clear() when the user reads a
+    thread. Entries expire after `ttl` seconds so anything missed (e.g. a
+    worker that restarted) is corrected from the thread/read watermarks.
+    Threads that are not cached yet start at 0 on incr(); they have no
+    unread messages from before the entry was loaded, or they would have
+    been loaded with it.
+
+    incr() and clear() calls made while a user's counts are being loaded
+    are recorded and replayed over the loaded counts, so they are not
+    lost (or undone) by a load that read storage before they happened.
+    An incr() for a message the load already saw (the thread's last
+    message is newer, or is that message) is dropped instead; one that
+    cannot be told apart (another message with the same ts) is kept, as
+    counting it twice until the entry expires beats hiding it.
+
+    Every change to a user's entry gives it a new version (unique within
+    this process), which /api/unread turns into an ETag.
+    """
+
+    def __init__(self, store, max_users: int = 5000, ttl: float = 300.0):
+        self.store = store
+        self.max_users = max_users
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # uid -> [expires_at, {thread_id: [thread, count]}, thread_ids asked for, version]
+        self.users = OrderedDict()
+        # uid -> one list per load in progress of the changes made since
+        # it started: (thread_id, thread, n, ts, msg_id), n=None for clear()
+        self.loading = {}
+        self.epoch = int(time.time() * 1000)
+        self.last_version = 0
+        self.hits = 0
+        self.misses = 0
+        self.incrs = 0
+        self.clears = 0
+        self.evictions = 0
+
+    def _next_version(self):
+        self.last_version += 1
+        return self.last_version
+
+    def _entry(self, uid, now):
+        item = self.users.get(uid)
+        if item is None:
+            return None
+        if item[0] < now:
+            del self.users[uid]
+            return None
+        self.users.move_to_end(uid)
+        return item
+
+    def get(self, uid: str, thread_ids=()):
+        """(thread_id, thread dict, count) like Storage.unread_counts()."""
+        now = time.time()
+        with self.lock:
+            item = self._entry(uid, now)
+            if item is not None:
+                _, threads, asked, _ = item
+                # asked covers group threads that have no messages (no doc) yet
+                if all(tid in threads or tid in asked for tid in thread_ids):
+                    self.hits += 1
+                    return [(tid, t, n) for tid, (t, n) in threads.items()]
+            self.misses += 1
+            changes = []
+            self.loading.setdefault(uid, []).append(changes)
+
+        try:
+            loaded = {tid: [t, n] for tid, t, n in self.store.unread_counts(uid, thread_ids)}
+        except BaseException:
+            with self.lock:
+                self._done_loading(uid, changes)
+            raise
+        with self.lock:
+            self._done_loading(uid, changes)
+            for tid, thread, n, ts, msg_id in changes:
+                if n is None:
+                    if tid in loaded:
+                        loaded[tid][1] = 0
+                elif tid in loaded:
+                    if not self._seen(loaded[tid][0], ts, msg_id):
+                        loaded[tid][1] += n
+                else:
+                    loaded[tid] = [thread, n]
+            cur = self._entry(uid, now)
+            if cur is not None:
+                # keep cached threads the load did not return
+                for tid, (t, n) in cur[1].items():
+                    if tid not in loaded:
+                        loaded[tid] = [t, n]
+            self.users[uid] = [now + self.ttl, loaded, set(thread_ids), self._next_version()]
+            self.users.move_to_end(uid)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+                self.evictions += 1
+            return [(tid, t, n) for tid, (t, n) in loaded.items()]
+
+    def _done_loading(self, uid, changes):
+        loads = self.loading[uid]
+        loads.remove(changes)
+        if not loads:
+            del self.loading[uid]
+
+    @staticmethod
+    def _seen(thread, ts, msg_id):
+        """The loaded thread doc already counts message (ts, msg_id)."""
+        last = (thread or {}).get("last") or {}
+        if ts is None or not last:
+            return False
+        return last.get("id") == msg_id or to_ms(last.get("ts")) > to_ms(ts)
+
+    def _record(self, uid, thread_id, thread, n, ts=None, msg_id=None):
+        for changes in self.loading.get(uid, ()):
+            changes.append((thread_id, thread, n, ts, msg_id))
+
+    def incr(self, uid: str, thread_id: str, thread: dict, n: int = 1, ts=None, msg_id: str = None):
+        """
+        Count n new messages in thread_id for uid; ts and msg_id are the
+        newest one's, so a load already counting it does not do so twice.
+        """
+        with self.lock:
+            self.incrs += 1
+            self._record(uid, thread_id, thread, n, ts, msg_id)
+            entry = self._entry(uid, time.time())
+            if entry is None:
+                return
+            entry[3] = self._next_version()
+            threads = entry[1]
+            item = threads.get(thread_id)
+            if item is None:
+                threads[thread_id] = [thread, n]
+            else:
+                item[1] += n
+
+    def clear(self, uid: str, thread_id: str):
+        with self.lock:
+            self.clears += 1
+            self._record(uid, thread_id, None, None)
+            entry = self._entry(uid, time.time())
+            if entry is not None and thread_id in entry[1] and entry[1][thread_id][1]:
+                entry[1][thread_id][1] = 0
+                entry[3] = self._next_version()
+
+    def drop_thread(self, thread_id: str):
+        with self.lock:
+            for entry in self.users.values():
+                if entry[1].pop(thread_id, None) is not None:
+                    entry[3] = self._next_version()
+
+    def version(self, uid: str, thread_ids=()):
+        """
+        Version of uid's cached counts, or None when get() would have to
+        load them (not cached, expired, or a thread_id not covered).
+        """
+        with self.lock:
+            item = self._entry(uid, time.time())
+            if item is None:
+                return None
+            _, threads, asked, version = item
+            if not all(tid in threads or tid in asked for tid in thread_ids):
+                return None
+            return f"{self.epoch}.{version}"
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.users),
+            "max_users": self.max_users,
+            "hits": self.hits,
+            "misses": self.misses,
+            "incrs": self.incrs,
+            "clears": self.clears,
+            "evictions": self.evictions,
+        }
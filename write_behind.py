@@ -0,0 +1,309 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Persists messages in the background so send_dm / send_group can emit
+    new_message without waiting for the storage write.
+
+    - submit() appends the message to an append-only journal (JSON lines)
+      and queues it; a flusher thread writes queued messages with
+      store.add_messages() in batches.
+    - Failed batches are retried with exponential backoff, unless the
+      error is one of store.PERMANENT_ERRORS (bad data, e.g. a document
+      over the size limit): then the batch is retried one message at a
+      time and a message failing that way on its own is dead-lettered,
+      i.e. logged, appended to `<journal_path>.dead` and counted in
+      stats() as "dead", instead of blocking the queue forever.
+    - Each process journals to its own file, `<journal_path>.<pid>.<start
+      ms>`, and holds an exclusive flock on it while it runs. On startup
+      it claims every other journal nobody holds a lock on (its process
+      died), re-journals and replays the entries without a matching
+      "done" record, and deletes the claimed files; journals of live
+      workers sharing the directory are left alone.
+
+    - after(thread_id, fn) runs fn on the flusher once every message
+      queued for thread_id so far is written (or dead-lettered), for
+      writes that read what those messages change (mark_read reads the
+      thread's seq).
+
+    A message whose batch was committed but whose "done" record was not
+    written before a crash is written again on replay. Message docs have
+    fixed ids, so only the thread counters can be bumped twice.
+    """
+
+    def __init__(self, store, journal_path: str, max_depth: int = 10000,
+                 batch_size: int = 200, flush_interval: float = 0.05,
+                 max_backoff: float = 5.0, compact_bytes: int = 8 * 1024 * 1024):
+        self.store = store
+        self.journal_path = journal_path
+        self.path = None  # this process's journal, set by start()
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.compact_bytes = compact_bytes
+
+        self.items = deque()
+        self.pending = {}  # thread_id -> messages queued and not yet written
+        self.waiting = {}  # thread_id -> [fn] for after()
+        self.cond = threading.Condition()
+        self.dead_path = journal_path + ".dead"
+        self.journal_lock = threading.Lock()
+        self.journal = None
+        self.thread = None
+        self.running = False
+
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.retries = 0
+        self.rejected = 0
+        self.replayed = 0
+        self.dead = 0
+        self.deferred = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+
+    # -----------------------------
+    # Lifecycle
+    # -----------------------------
+    def start(self):
+        self.path = f"{self.journal_path}.{os.getpid()}.{int(time.time() * 1000)}"
+        self.journal = open(self.path, "a", encoding="utf-8")
+        fcntl.flock(self.journal, fcntl.LOCK_EX)  # released when this process exits
+        orphans = self._claim_orphans()
+        pending = []
+        for _, f in orphans:
+            pending += self._read_journal(f)
+        for msg_id, msg, thread_id, thread in pending:
+            self._journal_write({"op": "put", "id": msg_id, "msg": msg, "thread_id": thread_id, "thread": thread})
+        os.fsync(self.journal.fileno())
+        for path, f in orphans:
+            os.remove(path)
+            f.close()
+        now = time.time()
+        for msg_id, msg, thread_id, thread in pending:
+            self.items.append((now, msg_id, msg, thread_id, thread))
+            self.pending[thread_id] = self.pending.get(thread_id, 0) + 1
+        self.replayed = len(pending)
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Flush what is queued (up to `timeout` seconds) and stop."""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join(timeout)
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+            if not self.items:
+                os.remove(self.path)  # everything was written
+
+    # -----------------------------
+    # Producer side
+    # -----------------------------
+    def submit(self, msg_id: str, msg: dict, thread_id: str, thread: dict) -> bool:
+        """
+        Queue a message for persistence. Returns False when the queue is
+        full; the caller should then write synchronously.
+        """
+        with self.cond:
+            if len(self.items) >= self.max_depth:
+                self.rejected += 1
+                return False
+            self._journal_write({"op": "put", "id": msg_id, "msg": msg, "thread_id": thread_id, "thread": thread})
+            self.items.append((time.time(), msg_id, msg, thread_id, thread))
+            self.pending[thread_id] = self.pending.get(thread_id, 0) + 1
+            self.enqueued += 1
+            self.cond.notify()
+        return True
+
+    def after(self, thread_id: str, fn) -> bool:
+        """
+        Run fn() on the flusher thread once the messages queued for
+        thread_id so far are written. Returns False when none are queued;
+        the caller should then call fn itself.
+        """
+        with self.cond:
+            if not self.pending.get(thread_id):
+                return False
+            self.waiting.setdefault(thread_id, []).append(fn)
+            self.deferred += 1
+        return True
+
+    # -----------------------------
+    # Flusher
+    # -----------------------------
+    def _run(self):
+        backoff = 0.1
+        permanent = getattr(self.store, "PERMANENT_ERRORS", ())
+        singles = 0  # after a permanent batch failure: flush this many one by one
+        while True:
+            with self.cond:
+                if not self.items and self.running:
+                    self.cond.wait(self.flush_interval)
+                if not self.items:
+                    if not self.running:
+                        return
+                    continue
+                n = 1 if singles else min(self.batch_size, len(self.items))
+                batch = [self.items[i] for i in range(n)]
+
+            t0 = time.time()
+            try:
+                self.store.add_messages([item[1:] for item in batch])
+            except permanent as e:
+                if len(batch) > 1:
+                    singles = len(batch)  # find the bad message
+                    continue
+                self._dead_letter(batch[0], e)
+                singles = max(0, singles - 1)
+                continue
+            except Exception:
+                self.retries += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = 0.1
+            singles = max(0, singles - len(batch))
+
+            done = time.time()
+            with self.cond:
+                for _ in batch:
+                    self.items.popleft()
+                ready = self._written(batch)
+                self._journal_write({"op": "done", "ids": [item[1] for item in batch]})
+                self.flushed += len(batch)
+                self.batches += 1
+                self.last_flush_ms = (done - t0) * 1000.0
+                self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+                self.last_lag_ms = (done - batch[0][0]) * 1000.0
+                self.max_lag_ms = max(self.max_lag_ms, self.last_lag_ms)
+                if not self.items:
+                    self._maybe_compact()
+            self._call(ready)
+
+    def _written(self, batch):
+        """Forget batch's messages (self.cond held); the after() callbacks now due."""
+        ready = []
+        for item in batch:
+            thread_id = item[3]
+            self.pending[thread_id] -= 1
+            if not self.pending[thread_id]:
+                del self.pending[thread_id]
+                ready += self.waiting.pop(thread_id, ())
+        return ready
+
+    @staticmethod
+    def _call(fns):
+        for fn in fns:
+            try:
+                fn()
+            except Exception:
+                log.exception("write-behind: after() callback failed")
+
+    def _dead_letter(self, item, error):
+        _, msg_id, msg, thread_id, thread = item
+        log.error("write-behind: dropping message %s for %s: %r", msg_id, thread_id, error)
+        with open(self.dead_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": msg_id, "msg": msg, "thread_id": thread_id, "thread": thread,
+                                "error": repr(error)}, separators=(",", ":"), default=str) + "\n")
+        with self.cond:
+            self.items.popleft()
+            ready = self._written([item])
+            self._journal_write({"op": "done", "ids": [msg_id]})
+            self.dead += 1
+            if not self.items:
+                self._maybe_compact()
+        self._call(ready)
+
+    # -----------------------------
+    # Journal
+    # -----------------------------
+    def _journal_write(self, rec: dict):
+        with self.journal_lock:
+            self.journal.write(json.dumps(rec, separators=(",", ":")) + "\n")
+            self.journal.flush()
+
+    def _claim_orphans(self):
+        """[(path, locked file)] for journals whose process is gone."""
+        # the bare journal_path is a single journal from before per-process files
+        base = glob.escape(self.journal_path)
+        paths = glob.glob(base) + sorted(glob.glob(base + ".[0-9]*"))
+        claimed = []
+        for path in paths:
+            if path == self.path:
+                continue
+            try:
+                f = open(path, encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # another starting worker may have claimed and deleted it meanwhile
+                ours = os.path.exists(path) and os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+            except OSError:
+                ours = False  # locked: its worker is alive
+            if ours:
+                claimed.append((path, f))
+            else:
+                f.close()
+        return claimed
+
+    @staticmethod
+    def _read_journal(f):
+        pending = {}
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # torn write at crash time
+            if rec.get("op") == "put":
+                pending[rec["id"]] = (rec["id"], rec["msg"], rec["thread_id"], rec["thread"])
+            elif rec.get("op") == "done":
+                for msg_id in rec.get("ids", []):
+                    pending.pop(msg_id, None)
+        return list(pending.values())
+
+    def _maybe_compact(self):
+        # Called with the queue empty and self.cond held: every put has a
+        # matching done, so the journal can start over.
+        with self.journal_lock:
+            if self.journal.tell() < self.compact_bytes:
+                return
+            self.journal.truncate(0)  # same file, so the flock stays held
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.items),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "replayed": self.replayed,
+            "dead": self.dead,
+            "deferred": self.deferred,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "last_lag_ms": round(self.last_lag_ms, 2),
+            "max_lag_ms": round(self.max_lag_ms, 2),
+        }